@@ -0,0 +1,420 @@
+"""Benchmarks for the ecg_analysis module
+
+Run this module to time each stage of the ECG analysis on the files in
+test_data/ and on synthetic recordings, and save the results as json so
+that they can be compared between commits, for example:
+
+    python benchmark_ecg_analysis.py --sizes 10000 1000000 --output new.json
+    python benchmark_ecg_analysis.py --compare old.json new.json
+"""
+import argparse
+import datetime
+import glob
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from time import perf_counter
+
+import numpy as np
+
+import ecg_analysis
+import ecg_synthetic
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STAGES = ('read_input', 'filter_data', 'calc_beats', 'group_similar_values',
+          'calc_metrics', 'output_file')
+DEFAULT_SIZES = (10000, 100000, 1000000)
+SYNTHETIC_RATE = 333.0
+
+
+def _time_command(command, repeats):
+    """Return the wall times of running command repeats times"""
+    times = list()
+    for i in range(repeats):
+        start = perf_counter()
+        subprocess.run(command, cwd=HERE, check=True)
+        times.append(perf_counter() - start)
+    return times
+
+
+def benchmark_import(repeats=10, python=sys.executable):
+    """This function measures the cold import time of ecg_analysis
+
+    A new interpreter is started for every repeat so that nothing is
+    already imported. The time to start an interpreter that imports nothing
+    is measured the same way and subtracted, leaving the cost of the import
+    itself.
+
+    Args:
+        repeats (int): number of interpreters to start for each measurement
+        python (str): the python executable to time
+
+    Returns:
+        dictionary : the median and min import seconds and the median
+        interpreter start up seconds
+    """
+    startup = _time_command([python, "-c", "pass"], repeats)
+    imports = _time_command([python, "-c", "import ecg_analysis"], repeats)
+    startup_median = statistics.median(startup)
+    return {"repeats": repeats,
+            "interpreter_seconds": startup_median,
+            "import_seconds_median": statistics.median(imports) -
+            startup_median,
+            "import_seconds_min": min(imports) - min(startup)}
+
+
+def measure(func, *args, memory=True):
+    """This function times one call of func and measures its peak memory
+
+    The call is timed on its own, then repeated under tracemalloc to find
+    the peak memory it allocates, because tracing slows the call down.
+
+    Args:
+        func (callable): the function to measure
+        *args: the arguments to call func with
+        memory (bool): measure the peak memory as well as the time
+
+    Returns:
+        float : seconds taken by the call
+        int : peak bytes allocated during the call, or None
+    """
+    start = perf_counter()
+    func(*args)
+    seconds = perf_counter() - start
+    if not memory:
+        return seconds, None
+    tracemalloc.start()
+    try:
+        func(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return seconds, peak
+
+
+def _filter_uncached(time, volt):
+    """Run filter_data without hitting the filter cache"""
+    ecg_analysis.clear_filter_cache()
+    return ecg_analysis.filter_data(time, volt)
+
+
+def _calc_metrics_uncached(time, volt, filename):
+    """Run calc_metrics without plotting or hitting the filter cache"""
+    ecg_analysis.clear_filter_cache()
+    return ecg_analysis.calc_metrics(time, volt, filename, plot='none')
+
+
+def _output_file_fresh(metrics, workdir):
+    """Write the json output into a new directory so it never exists"""
+    directory = tempfile.mkdtemp(dir=workdir)
+    ecg_analysis.output_file(metrics, os.path.join(directory, "out.csv"))
+
+
+def benchmark_file(filename, workdir, memory=True):
+    """This function times every stage of the analysis on one csv file
+
+    Args:
+        filename (str): the csv file to analyze
+        workdir (str): directory for the json files that are written
+        memory (bool): measure the peak memory of each stage
+
+    Returns:
+        list : a dictionary for each stage with the number of samples, the
+        seconds, the samples per second and the peak bytes
+    """
+    time, volt = ecg_analysis.read_input(filename)
+    filtered = ecg_analysis.filter_data(time, volt)
+    maximum = ecg_analysis.calc_voltage_extremes(filtered)[1]
+    above = np.asarray(time)[filtered > maximum / 2].tolist()
+    metrics = ecg_analysis.calc_metrics(time, volt, filename, plot='none')
+    calls = {'read_input': (ecg_analysis.read_input, filename),
+             'filter_data': (_filter_uncached, time, volt),
+             'calc_beats': (ecg_analysis.calc_beats, time, filtered),
+             'group_similar_values': (ecg_analysis.group_similar_values,
+                                      above),
+             'calc_metrics': (_calc_metrics_uncached, time, volt, filename),
+             'output_file': (_output_file_fresh, metrics, workdir)}
+    results = list()
+    for stage in STAGES:
+        func = calls[stage][0]
+        args = calls[stage][1:]
+        seconds, peak = measure(func, *args, memory=memory)
+        results.append({"stage": stage,
+                        "samples": len(time),
+                        "seconds": seconds,
+                        "samples_per_second": len(time) / seconds,
+                        "peak_bytes": peak})
+    return results
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, include_test_data=True,
+                   memory=True):
+    """This function benchmarks the test_data files and synthetic data
+
+    A synthetic csv file is written for each size in sizes by
+    ecg_synthetic.write_synthetic_csv() and removed afterwards.
+
+    Args:
+        sizes (list): numbers of samples of the synthetic recordings
+        include_test_data (bool): also benchmark the files in test_data/
+        memory (bool): measure the peak memory of each stage
+
+    Returns:
+        list : a dictionary for each stage of each source, see
+        benchmark_file()
+    """
+    results = list()
+    workdir = tempfile.mkdtemp()
+    try:
+        sources = list()
+        if include_test_data:
+            sources = sorted(glob.glob(os.path.join(HERE, "test_data",
+                                                    "*.csv")))
+        for size in sizes:
+            filename = os.path.join(workdir, "synthetic_{}.csv".format(size))
+            ecg_synthetic.write_synthetic_csv(filename, size, SYNTHETIC_RATE)
+            sources.append(filename)
+        for filename in sources:
+            for result in benchmark_file(filename, workdir, memory):
+                result["source"] = os.path.basename(filename)
+                results.append(result)
+    finally:
+        shutil.rmtree(workdir)
+    return results
+
+
+def beat_accuracy(found, expected, tolerance=0.05):
+    """This function scores detected beats against the true beat times
+
+    A true beat is found if a detected beat is within tolerance seconds of
+    it.
+
+    Args:
+        found (list): the detected beat times, in order
+        expected (list): the true beat times, in order
+        tolerance (float): largest error in seconds counted as a match
+
+    Returns:
+        float : sensitivity, the fraction of true beats that were found
+        float : positive predictivity, the fraction of detected beats that
+        are true beats
+    """
+    found = np.asarray(found, dtype=np.float64)
+    expected = np.asarray(expected, dtype=np.float64)
+    if found.size == 0 or expected.size == 0:
+        return 0.0, 0.0
+
+    def matched(times, reference):
+        index = np.searchsorted(reference, times)
+        before = reference[np.maximum(index - 1, 0)]
+        after = reference[np.minimum(index, reference.size - 1)]
+        error = np.minimum(np.abs(times - before), np.abs(times - after))
+        return np.count_nonzero(error <= tolerance)
+
+    return (float(matched(expected, found) / expected.size),
+            float(matched(found, expected) / found.size))
+
+
+def benchmark_engines(sizes=DEFAULT_SIZES, engines=None, artifact=True):
+    """This function compares the beat detector engines
+
+    Each engine is timed on the filtered voltages of a recording of each
+    size from ecg_synthetic.synthetic_recording() and its beats are scored
+    by beat_accuracy() against the true beat times. If artifact is True a
+    second copy of each recording has one artifact, shaped like an R wave
+    but ten times as tall, added half way through it.
+
+    Args:
+        sizes (list): numbers of samples of the synthetic recordings
+        engines (list): engine names, by default every registered engine
+        artifact (bool): also score the recordings with a spike added
+
+    Returns:
+        list : a dictionary for each engine and recording with the number
+        of samples, the seconds, the samples per second, the sensitivity
+        and the positive predictivity
+    """
+    if engines is None:
+        engines = sorted(ecg_analysis.DETECTORS)
+    results = list()
+    for size in sizes:
+        time, volt, expected = ecg_synthetic.synthetic_recording(
+            size, SYNTHETIC_RATE, 72.0)
+        recordings = [("synthetic_{}".format(size), volt)]
+        if artifact:
+            middle = time[size // 2]
+            spiked = volt + 10 * np.exp(-0.5 * ((time - middle) / 0.012) ** 2)
+            recordings.append(("synthetic_{}_artifact".format(size), spiked))
+        for source, raw_volt in recordings:
+            filtered = _filter_uncached(time, raw_volt)
+            for engine in engines:
+                detector = ecg_analysis.DETECTORS[engine]
+                seconds, peak = measure(detector, time, filtered,
+                                        memory=False)
+                beats = detector(time, filtered)
+                sensitivity, ppv = beat_accuracy(beats, expected)
+                results.append({"source": source,
+                                "engine": engine,
+                                "samples": size,
+                                "seconds": seconds,
+                                "samples_per_second": size / seconds,
+                                "sensitivity": sensitivity,
+                                "positive_predictivity": ppv})
+    return results
+
+
+def benchmark_writer(num_records=100000, num_beats=100, json_files=1000):
+    """This function measures how fast the metrics of many recordings are
+    written
+
+    The same metrics, with num_beats beats held in a numpy array, are
+    written num_records times to one NDJSON file by a ResultsWriter, and
+    json_files times to separate json files by output_file() for
+    comparison.
+
+    Args:
+        num_records (int): number of lines written to the NDJSON file
+        num_beats (int): number of beats in the metrics of each recording
+        json_files (int): number of separate json files written
+
+    Returns:
+        dictionary : the records, seconds, records per second and bytes
+        per second of the NDJSON file, and the files per second of the
+        separate json files
+    """
+    beats = np.arange(num_beats) * 0.8331
+    metrics = {"duration": float(num_beats), "voltage_extremes": (-0.5, 1.2),
+               "num_beats": num_beats, "mean_hr_bpm": 72.02, "beats": beats}
+    workdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(workdir, "results.ndjson")
+        start = perf_counter()
+        with ecg_analysis.ResultsWriter(filename) as writer:
+            for i in range(num_records):
+                writer.write("recording{}.csv".format(i), metrics)
+        seconds = perf_counter() - start
+        size = os.path.getsize(filename)
+        start = perf_counter()
+        for i in range(json_files):
+            ecg_analysis.output_file(
+                metrics, os.path.join(workdir, "recording{}.csv".format(i)))
+        json_seconds = perf_counter() - start
+    finally:
+        shutil.rmtree(workdir)
+    return {"records": num_records,
+            "seconds": seconds,
+            "records_per_second": num_records / seconds,
+            "bytes_per_second": size / seconds,
+            "json_files": json_files,
+            "json_files_per_second": json_files / json_seconds}
+
+
+def _git_commit():
+    """Return the current git commit, or None outside of a git checkout"""
+    try:
+        answer = subprocess.run(["git", "rev-parse", "HEAD"], cwd=HERE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL,
+                                universal_newlines=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return answer.stdout.strip()
+
+
+def environment():
+    """This function describes where the benchmarks were run
+
+    Returns:
+        dictionary : the git commit, the time, and the python, numpy and
+        platform versions
+    """
+    return {"commit": _git_commit(),
+            "date": datetime.datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform()}
+
+
+def compare_results(old, new):
+    """This function compares the stage timings of two benchmark runs
+
+    Args:
+        old (dict): results loaded from an earlier json file
+        new (dict): results loaded from a later json file
+
+    Returns:
+        list : (source, stage, old seconds, new seconds, speedup) for every
+        stage that is in both runs
+    """
+    old_times = {(result["source"], result["stage"]): result["seconds"]
+                 for result in old.get("stages", [])}
+    rows = list()
+    for result in new.get("stages", []):
+        key = (result["source"], result["stage"])
+        if key in old_times:
+            rows.append(key + (old_times[key], result["seconds"],
+                               old_times[key] / result["seconds"]))
+    return rows
+
+
+def main(argv=None):
+    """This function runs the benchmarks and prints or saves the results
+
+    Args:
+        argv (list): command line arguments, None uses sys.argv
+    """
+    parser = argparse.ArgumentParser(description="Benchmark ecg_analysis")
+    parser.add_argument("--sizes", type=int, nargs="*",
+                        default=list(DEFAULT_SIZES),
+                        help="samples in each synthetic recording")
+    parser.add_argument("--no-test-data", action="store_true",
+                        help="skip the files in test_data/")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="skip the peak memory measurements")
+    parser.add_argument("--import-repeats", type=int, default=10,
+                        help="interpreters started to time the import")
+    parser.add_argument("--no-engines", action="store_true",
+                        help="skip the comparison of the beat detectors")
+    parser.add_argument("--writer-records", type=int, default=100000,
+                        help="recordings written to time the NDJSON writer, "
+                             "0 skips it")
+    parser.add_argument("--output", metavar="FILE",
+                        help="json file to save the results in")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="compare two saved json files and exit")
+    args = parser.parse_args(argv)
+    logging.getLogger().addHandler(logging.NullHandler())
+    if args.compare is not None:
+        with open(args.compare[0], 'r') as f:
+            old = json.load(f)
+        with open(args.compare[1], 'r') as f:
+            new = json.load(f)
+        for row in compare_results(old, new):
+            print("{:<28} {:<22} {:>10.4f} {:>10.4f} {:>7.2f}x".format(*row))
+        return
+    results = {"environment": environment(),
+               "import": benchmark_import(args.import_repeats),
+               "stages": run_benchmarks(args.sizes, not args.no_test_data,
+                                        not args.no_memory)}
+    if args.writer_records > 0:
+        results["writer"] = benchmark_writer(args.writer_records)
+    if not args.no_engines:
+        results["engines"] = benchmark_engines(args.sizes)
+    text = json.dumps(results, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as out_file:
+            out_file.write(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,37 +1,659 @@
+import argparse
+import atexit
+import errno
+import functools
+import glob
+import hashlib
+import io
+import itertools
 import logging
+import logging.handlers
 import math
-import matplotlib.pyplot as plt
-import heartpy as hp
+import mmap
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import threading
+import warnings
+from collections import OrderedDict
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed, wait)
+from time import perf_counter, time as _now
 import numpy as np
 import json
 
 
-logging.basicConfig(filename='bad_data.log',
-                    filemode='w',
-                    level=logging.INFO)
+PLOT_MODES = ('none', 'png', 'interactive')
+DEFAULT_PLOT_NAME = "ecg"
+OUTPUT_POLICIES = ('overwrite', 'skip', 'error')
+BAD_ROW_REASONS = ('empty', 'non-numeric', 'nan')
+BAD_ROW_EMPTY = 0
+BAD_ROW_NON_NUMERIC = 1
+BAD_ROW_NAN = 2
+BAD_ROW_SAMPLE_LINES = 10
+CACHE_ARRAYS = ('time', 'volt', 'bad_lines', 'bad_reasons')
+DEFAULT_CACHE_BYTES = 2 * 1024 ** 3
+FILTER_BAND = (5, 20)
+FILTER_ORDER = 2
+FILTER_CACHE_BYTES = 256 * 1024 ** 2
+HRV_WINDOW = 300.0
+HRV_STEP = 30.0
+SAMPLE_RATE_INTERVALS = 65536
+GAP_FACTOR = 1.5
+BEAT_THRESHOLD = 0.5
+BEAT_GAP = 0.1
+PYRAMID_FACTOR = 4
+SEGMENT_OVERLAP = 10.0
+# The results store keys metrics by analysis_params(). A constant that
+# changes the metrics must be listed there, and any other change to the
+# metrics must increase ANALYSIS_VERSION, or stale metrics are returned.
+ANALYSIS_VERSION = 1
+SNIFF_STATUSES = ('ok', 'suspicious', 'unusable')
+SNIFF_BYTES = 16384
+SNIFF_STRIDES = 8
+SNIFF_BAD_FRACTION = 0.01
+DEFAULT_ENGINE = 'threshold'
+DETECTORS = dict()
+_filter_cache = OrderedDict()
+_filter_cache_lock = threading.Lock()
+_stage_hooks = list()
+_log_config = None
+_log_listener = None
+_plot_executor = None
+_pending_plots = list()
+
+
+def configure_logging(filename='bad_data.log', level=logging.INFO,
+                      asynchronous=True):
+    """This function sets up the log file for the ECG analysis
+
+    The log file is emptied once, so the log of the previous run is
+    replaced, and is then written in append mode. This is called by main()
+    when the module is run instead of when it is imported, so importing the
+    module does not touch the log file. Like logging.basicConfig(),
+    nothing is changed if the root logger already has handlers.
+
+    When asynchronous is True, records are put on a multiprocessing queue
+    by a logging.handlers.QueueHandler and written to the file by a
+    QueueListener thread, so the analysis never waits for the disk. The
+    worker processes of batch_analysis() and detect_beats_segments() put
+    their records on the same queue, so this process is the only one that
+    writes the file. The listener is stopped, and the queue flushed, by
+    stop_logging() or when the interpreter exits.
+
+    Args:
+        filename (str): name of the log file
+        level (int): the lowest logging level that is written
+        asynchronous (bool): write the log file from a background thread
+    """
+    global _log_config, _log_listener
+    root = logging.getLogger()
+    if root.handlers:
+        return
+    open(filename, 'w').close()
+    handler = logging.FileHandler(filename, mode='a')
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    root.setLevel(level)
+    if not asynchronous:
+        _log_config = (filename, level, None)
+        root.addHandler(handler)
+        return
+    log_queue = multiprocessing.Queue()
+    _log_config = (filename, level, log_queue)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    _log_listener = logging.handlers.QueueListener(log_queue, handler)
+    _log_listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """This function writes out any queued log records and stops the
+    background log writer started by configure_logging()
+    """
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        for handler in _log_listener.handlers:
+            handler.close()
+        _log_listener = None
+
+
+def _init_worker_logging(filename, level, log_queue):
+    """Send the log records of a worker process to the parent's log file
+
+    The handlers a forked worker inherits are replaced. If the parent
+    writes its log from a queue the records are put on that queue, so only
+    the parent's QueueListener writes the file; otherwise they are
+    appended to the file directly.
+    """
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    if log_queue is not None:
+        handler = logging.handlers.QueueHandler(log_queue)
+    else:
+        handler = logging.FileHandler(filename, mode='a')
+        handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    root.addHandler(handler)
+    root.setLevel(level)
+
+
+class _NullStage:
+    """Stand-in for _StageTimer used when no stage hooks are registered"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def count(self, **counts):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _StageTimer:
+    """Time one pipeline stage and pass the result to the stage hooks"""
+
+    def __init__(self, name):
+        self.name = name
+        self.counts = dict()
+
+    def __enter__(self):
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = perf_counter() - self._start
+        for hook in list(_stage_hooks):
+            hook(self.name, seconds, self.counts)
+        return False
+
+    def count(self, **counts):
+        self.counts.update(counts)
+
+
+def _stage(name):
+    """Return a context manager that times a stage if anyone is listening
+
+    When no hooks are registered the same do-nothing object is returned
+    every time, so instrumented code costs one list check.
+    """
+    if not _stage_hooks:
+        return _NULL_STAGE
+    return _StageTimer(name)
 
 
-def output_file(metrics, filename):
+def add_stage_hook(hook):
+    """This function registers a callback that is told about every stage
+
+    The pipeline is split into the stages 'read', 'validate', 'filter',
+    'detect', 'aggregate' and 'write'. Each time one of them finishes, hook
+    is called as hook(stage, seconds, counts), where counts is a dictionary
+    such as {'samples': 10000, 'bad_rows': 4} or {'beats': 34}. Hooks are
+    called in the process and thread that ran the stage.
+
+    Args:
+        hook (callable): function taking (stage, seconds, counts)
+    """
+    _stage_hooks.append(hook)
+
+
+def remove_stage_hook(hook):
+    """This function unregisters a callback added by add_stage_hook()
+
+    Args:
+        hook (callable): the function to remove
+    """
+    _stage_hooks.remove(hook)
+
+
+class StageStats:
+    """This class collects the timings and counts of the pipeline stages
+
+    An instance can be passed to add_stage_hook(). It keeps the number of
+    calls, the total seconds and the total of every count for each stage,
+    and can write them as json or in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.stages = dict()
+        self._lock = threading.Lock()
+
+    def __call__(self, stage, seconds, counts):
+        with self._lock:
+            totals = self.stages.setdefault(stage, {"calls": 0,
+                                                    "seconds": 0.0})
+            totals["calls"] += 1
+            totals["seconds"] += seconds
+            for name, value in counts.items():
+                totals[name] = totals.get(name, 0) + value
+
+    def to_json(self):
+        """str: the collected totals of each stage as json"""
+        with self._lock:
+            return json.dumps(self.stages, sort_keys=True)
+
+    def to_prometheus(self, prefix="ecg_stage"):
+        """This function writes the totals in the Prometheus text format
+
+        Every total becomes a counter named <prefix>_<name>_total with a
+        stage label, for example ecg_stage_seconds_total{stage="filter"}.
+
+        Args:
+            prefix (str): the start of every metric name
+
+        Returns:
+            str : the metrics in the Prometheus text exposition format
+        """
+        with self._lock:
+            names = sorted({name for totals in self.stages.values()
+                            for name in totals})
+            lines = list()
+            for name in names:
+                metric = "{}_{}_total".format(prefix, name)
+                lines.append("# TYPE {} counter".format(metric))
+                for stage in sorted(self.stages):
+                    if name in self.stages[stage]:
+                        lines.append('{}{{stage="{}"}} {}'.format(
+                            metric, stage, self.stages[stage][name]))
+        return "\n".join(lines) + "\n"
+
+
+def output_filename(filename):
+    """This function returns the name of the json output file for a csv file
+
+    Only the extension of the csv file is replaced, so directories and
+    other periods in the name are kept.
+
+    Args:
+        filename (str): the name of the csv file
+
+    Returns:
+        str : the name of the json file
+    """
+    return os.path.splitext(filename)[0] + ".json"
+
+
+def _json_default(value):
+    """Convert the numpy values that json cannot encode on its own"""
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("{!r} is not JSON serializable".format(value))
+
+
+def dumps_metrics(metrics):
+    """This function converts a dictionary of metrics into a json string
+
+    numpy arrays such as the beats are encoded straight from the array and
+    numpy scalars are encoded as plain numbers, so the metrics do not have
+    to be converted to lists first.
+
+    Args:
+        metrics (dict): Dictionary containing ECG metrics
+
+    Returns:
+        str : the metrics as json
+    """
+    return json.dumps(metrics, default=_json_default)
+
+
+def _temporary_name(filename):
+    """Return a name next to filename for writing it before a rename"""
+    return "{}.{}-{}.tmp".format(filename, os.getpid(), threading.get_ident())
+
+
+def _check_policy(policy, filename):
+    """Return True if filename should be skipped under the output policy"""
+    if policy not in OUTPUT_POLICIES:
+        raise ValueError("policy must be one of {}".format(OUTPUT_POLICIES))
+    if policy == 'overwrite' or not os.path.exists(filename):
+        return False
+    if policy == 'skip':
+        logging.info('Skipping {}, it already exists'.format(filename))
+        return True
+    raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), filename)
+
+
+def output_file(metrics, filename, policy='overwrite'):
     """This function writes the output json file for the ECG data
 
     This function takes the dictionary of ECG metrics and the name
-    of the csv file as inputs. The name of the csv file is split
-    into a list at the period and the first item of the list is
-    put into a string followed by .json to create the filename.
-    Using a with statement and a .dump() command the json file is
-    written.
+    of the csv file as inputs. The extension of the csv file is replaced
+    by .json to create the filename. The policy decides what happens if
+    the json file already exists: 'overwrite' replaces it, 'skip' leaves it
+    alone and 'error' raises FileExistsError. The json is written to a
+    temporary file next to the output which is then renamed over it, so
+    the output file is never left half written.
 
     Args:
         metrics (dict): Dictionary containing ECG metrics including
         the time duration, extreme values, number of beats,
         time points of beats, and mean heart rate in bpm.
+        filename (str): the name of the csv file the metrics are for
+        policy (str): one of 'overwrite', 'skip' or 'error'
+
+    Returns:
+        str : the name of the json file, or None if it was skipped
     """
     logging.info('Creating JSON output file')
-    filename_split = filename.split(".")
-    file = filename_split[0]
-    filename = file + ".json"
-    with open(filename, 'x') as out_file:
-        json.dump(metrics, out_file)
+    with _stage('write') as stage:
+        filename = output_filename(filename)
+        if _check_policy(policy, filename):
+            stage.count(skipped=1)
+            return None
+        temp_name = _temporary_name(filename)
+        try:
+            with open(temp_name, 'x') as out_file:
+                out_file.write(dumps_metrics(metrics))
+            os.replace(temp_name, filename)
+        except BaseException:
+            if os.path.exists(temp_name):
+                os.remove(temp_name)
+            raise
+    return filename
+
+
+class ResultsWriter:
+    """This class writes the metrics of many recordings to one NDJSON file
+
+    Each call to write() adds a line holding the name of the recording and
+    its metrics to a buffer. The buffer is written out once it holds
+    flush_records lines or flush_seconds have passed since it was last
+    written, so the file is not written to for every recording. The lines
+    go to a temporary file next to filename which is renamed to filename
+    when the writer is closed. If the writer is closed with commit False,
+    or left by an exception in a with block, the temporary file is deleted
+    instead, so a run that fails part way leaves any earlier file as it
+    was. The policy works the same way as in output_file(); if the file is
+    skipped nothing is written.
+
+    Args:
+        filename (str): the name of the NDJSON file
+        policy (str): one of 'overwrite', 'skip' or 'error'
+        flush_records (int): number of lines buffered before writing
+        flush_seconds (float): longest time lines are kept in the buffer
+
+    Attributes:
+        records (int): number of recordings written
+        skipped (bool): True if the file already existed and is skipped
+    """
+
+    def __init__(self, filename, policy='overwrite', flush_records=1000,
+                 flush_seconds=5.0):
+        self.filename = filename
+        self.flush_records = flush_records
+        self.flush_seconds = flush_seconds
+        self.records = 0
+        self.skipped = _check_policy(policy, filename)
+        self._buffer = list()
+        self._last_flush = perf_counter()
+        self._temp_name = _temporary_name(filename)
+        self._file = None
+        if not self.skipped:
+            self._file = open(self._temp_name, 'x')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(commit=exc_type is None)
+
+    def write(self, name, metrics):
+        """Add a line with the metrics of one recording
+
+        Args:
+            name (str): the name of the recording
+            metrics (dict): Dictionary containing ECG metrics
+        """
+        if self.skipped:
+            return
+        record = {"file": name}
+        record.update(metrics)
+        self._buffer.append(dumps_metrics(record))
+        self.records += 1
+        if (len(self._buffer) >= self.flush_records or
+                perf_counter() - self._last_flush >= self.flush_seconds):
+            self.flush()
+
+    def flush(self):
+        """Write the buffered lines to the temporary file"""
+        if self._buffer:
+            with _stage('write') as stage:
+                self._file.write("\n".join(self._buffer) + "\n")
+                self._file.flush()
+                stage.count(records=len(self._buffer))
+            self._buffer = list()
+        self._last_flush = perf_counter()
+
+    def close(self, commit=True):
+        """Write the buffered lines and rename the file into place
+
+        Args:
+            commit (bool): rename the file into place, or if False delete
+                it and leave filename as it was
+        """
+        if self._file is None:
+            return
+        try:
+            if commit:
+                self.flush()
+        except BaseException:
+            commit = False
+            raise
+        finally:
+            self._file.close()
+            self._file = None
+            if not commit:
+                os.remove(self._temp_name)
+        if commit:
+            os.replace(self._temp_name, self.filename)
+
+
+def file_digest(filename, chunk_bytes=1024 ** 2):
+    """This function hashes the contents of a file
+
+    The file is read chunk_bytes at a time, so hashing a file is much
+    quicker than parsing it and does not load it into memory.
+
+    Args:
+        filename (str): the string of the filename to be opened
+        chunk_bytes (int): number of bytes read at a time
+
+    Returns:
+        str : the blake2b hash of the contents of the file
+    """
+    digest = hashlib.blake2b()
+    with open(filename, 'rb') as f:
+        for chunk in iter(functools.partial(f.read, chunk_bytes), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def analysis_params(band=FILTER_BAND, order=FILTER_ORDER,
+                    engine=DEFAULT_ENGINE, hrv_window=None, hrv_step=HRV_STEP):
+    """This function lists everything that changes the metrics of a file
+
+    The heart rate variability windows are only listed when hrv_window is
+    given, so the keys of metrics without "hrv" are the same as before.
+
+    Args:
+        band (tuple): (low, high) cutoff frequencies of the filter in Hz
+        order (int): the order of the filter
+        engine (str): the name of the beat detector in DETECTORS
+        hrv_window (float): length in seconds of the heart rate variability
+            windows, or None to leave "hrv" out of the metrics
+        hrv_step (float): seconds between the starts of the windows
+
+    Returns:
+        dictionary : the analysis version and parameters
+    """
+    params = {"version": ANALYSIS_VERSION, "band": list(band),
+              "order": order, "engine": engine, "gap_factor": GAP_FACTOR,
+              "beat_threshold": BEAT_THRESHOLD, "beat_gap": BEAT_GAP}
+    if hrv_window is not None:
+        params["hrv"] = [hrv_window, hrv_step]
+    return params
+
+
+def results_key(digest, params):
+    """This function makes the ResultsStore key of a file
+
+    Args:
+        digest (str): the hash of the file from file_digest()
+        params (dict): the parameters from analysis_params()
+
+    Returns:
+        str : a hash of the contents of the file and the parameters
+    """
+    text = digest + json.dumps(params, sort_keys=True)
+    return hashlib.blake2b(text.encode()).hexdigest()
+
+
+class ResultsStore:
+    """This class keeps the metrics of analyzed files in a SQLite database
+
+    The metrics are stored under results_key(), a hash of the contents of
+    the file together with ANALYSIS_VERSION and the analysis parameters,
+    so a file that has not changed since it was analyzed with the same
+    parameters can be looked up with get() instead of being parsed again,
+    while an edited file, a new version or other parameters give a new key.
+    ANALYSIS_VERSION is increased whenever a change to the analysis changes
+    the metrics. Besides the metrics as json, the filename, duration,
+    number of beats, mean heart rate and voltage extremes are stored in
+    columns of the results table so that recordings can be compared with
+    query() without opening their json files. The metrics returned by
+    get() have been through json, so tuples come back as lists.
+
+    Args:
+        filename (str): the name of the database file, made if needed
+
+    Attributes:
+        filename (str): the name of the database file
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._connection = sqlite3.connect(filename)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, digest TEXT NOT NULL, "
+                "version INTEGER NOT NULL, params TEXT NOT NULL, "
+                "filename TEXT, analyzed REAL NOT NULL, duration REAL, "
+                "num_beats INTEGER, mean_hr_bpm REAL, min_volt REAL, "
+                "max_volt REAL, metrics TEXT NOT NULL)")
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS results_filename "
+                "ON results (filename)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self._connection.execute(
+            "SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def get(self, key):
+        """Return the metrics stored under key, or None if there are none"""
+        row = self._connection.execute(
+            "SELECT metrics FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def put(self, key, digest, params, filename, metrics):
+        """Store the metrics of a file, replacing any under the same key
+
+        Args:
+            key (str): the key from results_key()
+            digest (str): the hash of the file from file_digest()
+            params (dict): the parameters from analysis_params()
+            filename (str): the name of the analyzed file
+            metrics (dict): Dictionary containing ECG metrics
+        """
+        extremes = metrics.get("voltage_extremes") or (None, None)
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO results VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, digest, params["version"],
+                 json.dumps(params, sort_keys=True), filename,
+                 _now(), _float_or_none(metrics.get("duration")),
+                 metrics.get("num_beats"),
+                 _float_or_none(metrics.get("mean_hr_bpm")),
+                 _float_or_none(extremes[0]), _float_or_none(extremes[1]),
+                 dumps_metrics(metrics)))
+
+    def query(self, where=None, args=(), version=ANALYSIS_VERSION):
+        """Return the stored results that match an SQL condition
+
+        Args:
+            where (str): an SQL condition on the columns filename, digest,
+                params, analyzed, duration, num_beats, mean_hr_bpm,
+                min_volt and max_volt, for example "mean_hr_bpm > ?", or
+                None for every result
+            args (tuple): the values of the ? placeholders in where
+            version (int): only return results of this ANALYSIS_VERSION,
+                or None for every version
+
+        Returns:
+            list : a dictionary for each result with the columns and the
+            metrics, in the order of the filenames
+        """
+        conditions = list()
+        values = list()
+        if version is not None:
+            conditions.append("version = ?")
+            values.append(version)
+        if where is not None:
+            conditions.append("({})".format(where))
+            values.extend(args)
+        sql = "SELECT * FROM results"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        cursor = self._connection.execute(sql + " ORDER BY filename, key",
+                                          values)
+        columns = [column[0] for column in cursor.description]
+        results = list()
+        for row in cursor:
+            result = dict(zip(columns, row))
+            result["params"] = json.loads(result["params"])
+            result["metrics"] = json.loads(result["metrics"])
+            results.append(result)
+        return results
+
+    def close(self):
+        """Close the database"""
+        self._connection.close()
+
+
+def _float_or_none(value):
+    """Return value as a float for the ResultsStore, None stays None"""
+    return None if value is None else float(value)
+
+
+def _group_similar_times(beat_times):
+    """Return the median time of each group of close together times
+
+    A new group starts wherever the time between neighbouring values is
+    more than 0.1 s. The median of a group is picked by index arithmetic on
+    its start and end so that no per-group lists are made.
+    """
+    if beat_times.size == 0:
+        return beat_times
+    starts = np.flatnonzero(np.diff(beat_times) > BEAT_GAP) + 1
+    starts = np.concatenate(([0], starts))
+    ends = np.append(starts[1:], beat_times.size)
+    return beat_times[starts + (ends - starts) // 2]
 
 
 def group_similar_values(beat_list):
@@ -40,9 +662,11 @@ def group_similar_values(beat_list):
     The input argument beat_list contains a list of time values
     that correspond to voltages that are above half the max voltage.
     The list beat_list has groups of voltages that represent heart beats.
-    For each group of times the median time is selected to be the heart
-    beat and is appended to the list median_list which is returned and
-    used as the list of times when heart beats occur.
+    Groups are split wherever two neighbouring times are more than 0.1 s
+    apart, which is found for the whole list at once with numpy.diff. For
+    each group of times the median time is selected to be the heart
+    beat and these medians are returned as the list of times when heart
+    beats occur.
 
     Args:
         beat_list (list): This list contains all times that correspond
@@ -51,118 +675,669 @@ def group_similar_values(beat_list):
     Returns:
         list : a list of time points representing heart beats
     """
-    big_list = [[]]
-    x = 0
-    for i in range(len(beat_list)):
-        diff = beat_list[i] - beat_list[i - 1]
-        if diff > 0.1:
-            x += 1
-            big_list.append([])
-        big_list[x].append(beat_list[i])
-    median_list = list()
-    for i in range(len(big_list)):
-        val = math.floor(len(big_list[i])/2)
-        median_list.append(big_list[i][val])
-    return median_list
-
-
-def calc_beats(time, volts):
+    return _group_similar_times(np.asarray(beat_list)).tolist()
+
+
+class Recording:
+    """This class holds the time and voltage data of one ECG recording
+
+    The time values and voltages are kept in contiguous float64 numpy
+    arrays. Arrays that are already contiguous float64, including memory
+    mapped arrays from read_input_cached(), are used as they are without
+    being copied, and lists are converted once. The calc_* functions,
+    filter_data(), detect_beats() and calc_metrics() accept a Recording in
+    place of the time argument, and the sample rate stored here is used
+    to design the filter.
+
+    Attributes:
+        time (numpy.ndarray): time values for the ECG data
+        volt (numpy.ndarray): ECG voltage magnitudes
+        sample_rate (float): samples per second, or None for fewer than two
+            samples
+        metadata (dict): information about the recording, such as the
+            "filename" and the "bad_rows" summary
+    """
+
+    __slots__ = ('time', 'volt', 'sample_rate', 'metadata')
+
+    def __init__(self, time, volt, sample_rate=None, metadata=None):
+        self.time = np.ascontiguousarray(time, dtype=np.float64)
+        self.volt = np.ascontiguousarray(volt, dtype=np.float64)
+        if self.time.shape != self.volt.shape or self.time.ndim != 1:
+            raise ValueError("time and volt must be 1-D and the same length")
+        if sample_rate is None and self.time.size > 1:
+            sample_rate = estimate_sample_rate(self.time)
+        self.sample_rate = sample_rate
+        self.metadata = dict(metadata or {})
+
+    def __len__(self):
+        return self.time.size
+
+    def __repr__(self):
+        return "Recording({} samples at {} Hz, {!r})".format(
+            len(self), self.sample_rate, self.metadata.get("filename"))
+
+    @classmethod
+    def from_file(cls, filename, cached=False):
+        """Read a recording from a csv file
+
+        The file is parsed with read_input_arrays(), or read_input_cached()
+        if cached is True, so the data is never held in lists. The skipped
+        rows are logged by log_bad_rows() and voltages outside the normal
+        range by log_if_data_too_high(), the same as read_input().
+
+        Args:
+            filename (str): the string of the filename to be opened
+            cached (bool): use the memory mapped cache of parsed files
+
+        Returns:
+            Recording : the recording, with the filename and the summary of
+            the skipped rows in its metadata
+        """
+        reader = read_input_cached if cached else read_input_arrays
+        time, volt, bad_lines, bad_reasons = reader(filename)
+        bad_rows = summarize_bad_rows(bad_lines, bad_reasons)
+        log_bad_rows(filename, bad_rows)
+        log_if_data_too_high(volt)
+        return cls(time, volt,
+                   metadata={"filename": filename, "bad_rows": bad_rows})
+
+    def to_lists(self):
+        """Return the time values and voltages as lists like read_input()"""
+        return self.time.tolist(), self.volt.tolist()
+
+
+def as_recording(time, volt=None):
+    """This function returns the time and voltage data as a Recording
+
+    A Recording is returned as it is, so this is how functions that take
+    either a Recording or separate time and voltage sequences get a
+    Recording without copying data that is already in one.
+
+    Args:
+        time (list): list of time values for the ECG data, or a Recording
+        volt (list): list of ECG voltage magnitudes, not needed if time is a
+            Recording
+
+    Returns:
+        Recording : the recording
+    """
+    if isinstance(time, Recording):
+        return time
+    return Recording(time, volt)
+
+
+def _recording_arrays(time, volt):
+    """Return the time and voltage arrays of a Recording or of sequences
+
+    Unlike as_recording() the two sequences may have different lengths,
+    which detect_beats() has always allowed.
+    """
+    if isinstance(time, Recording):
+        return time.time, time.volt
+    return np.asarray(time), np.asarray(volt)
+
+
+class BeatDetection:
+    """This class holds the result of finding the heart beats in ECG data
+
+    The beat times, the time between consecutive beats and the voltage
+    extremes are found once by detect_beats() and stored in this object. The
+    functions calc_beats(), calc_num_beats() and calc_mean_hr_bpm() read
+    their answers from it instead of searching the data again.
+
+    Attributes:
+        beats (list): list of time values corresponding to heart beats
+        rr_intervals (numpy.ndarray): times between consecutive heart beats
+        voltage_extremes (tuple): (min, max) of the voltages searched
+    """
+
+    def __init__(self, beats, rr_intervals, voltage_extremes):
+        self.beats = beats
+        self.rr_intervals = rr_intervals
+        self.voltage_extremes = voltage_extremes
+
+    @property
+    def num_beats(self):
+        """int: the number of beats that were found"""
+        return len(self.beats)
+
+    @property
+    def mean_hr_bpm(self):
+        """float: the mean of the heart rates between consecutive beats"""
+        ave_hr = (1 / self.rr_intervals) * 60
+        return np.mean(ave_hr)
+
+
+def register_detector(name):
+    """This function returns a decorator that adds a beat detector to
+    DETECTORS
+
+    A detector is called as detector(time, volts) with numpy arrays of the
+    time values and the filtered voltages and returns a numpy array of the
+    beat times in order. detect_beats() and calc_metrics() use the detector
+    registered under the name given as their engine.
+
+    Args:
+        name (str): the engine name of the detector
+
+    Returns:
+        callable : decorator that registers a detector and returns it
+    """
+    def decorator(detector):
+        DETECTORS[name] = detector
+        return detector
+    return decorator
+
+
+@register_detector('threshold')
+def detect_threshold(time, volts):
+    """This function finds the beats where the voltage is over half its max
+
+    The time points where the voltage is greater than half of the max
+    voltage are picked out with a boolean mask and grouped into heart beats
+    the same way as group_similar_values(). This is the default engine.
+
+    Args:
+        time (numpy.ndarray): time values for the ECG data
+        volts (numpy.ndarray): ECG voltage magnitudes
+
+    Returns:
+        numpy.ndarray : the times of the heart beats
+    """
+    beat_index = np.flatnonzero(volts > (np.max(volts) * BEAT_THRESHOLD))
+    return _group_similar_times(time[beat_index])
+
+
+@register_detector('adaptive')
+def detect_adaptive(time, volts, integration=0.15, refractory=0.2,
+                    window=4.0, fraction=0.35):
+    """This function finds the beats with an adaptive threshold in the
+    style of the Pan-Tompkins detector
+
+    The voltages are differentiated and squared, then summed over a moving
+    window integration seconds long using numpy.cumsum. A peak of the
+    integrated signal is a beat if it is the largest value within the
+    refractory period on either side and is over fraction of the largest
+    value within window seconds. Because the threshold follows the local
+    size of the beats, a single artifact only hides the beats near it
+    instead of all of them, and a floor of half the typical local max
+    keeps noise between widely spaced beats from being counted. Each beat
+    is then placed at the highest voltage in the integration window that
+    ends at its peak. Every step is a numpy or scipy.ndimage operation over
+    the whole recording.
+
+    Args:
+        time (numpy.ndarray): time values for the ECG data
+        volts (numpy.ndarray): ECG voltage magnitudes
+        integration (float): length of the moving window in seconds
+        refractory (float): shortest time between beats in seconds
+        window (float): length of the window the threshold follows
+        fraction (float): fraction of the local max a beat must reach
+
+    Returns:
+        numpy.ndarray : the times of the heart beats
+    """
+    from scipy.ndimage import maximum_filter1d
+    if volts.size < 3:
+        return np.empty(0, dtype=np.float64)
+    sample_rate = estimate_sample_rate(time[:volts.size])
+    width = max(int(round(integration * sample_rate)), 1)
+    slope = np.gradient(volts)
+    sums = np.concatenate(([0.0], np.cumsum(slope * slope)))
+    ends = np.arange(1, volts.size + 1)
+    integrated = (sums[ends] - sums[np.maximum(ends - width, 0)]) / width
+    gap = max(int(refractory * sample_rate), 1)
+    local_max = maximum_filter1d(integrated, 2 * gap + 1)
+    envelope = maximum_filter1d(integrated,
+                                max(int(window * sample_rate), 1))
+    threshold = fraction * np.maximum(envelope, 0.5 * np.median(envelope))
+    peaks = np.flatnonzero((integrated == local_max) &
+                           (integrated > threshold))
+    peaks = peaks[np.diff(peaks, prepend=-gap - 1) > gap]
+    starts = np.maximum(peaks - width + 1, 0)
+    search = np.lib.stride_tricks.sliding_window_view(
+        np.concatenate((volts, np.full(width - 1, -np.inf))), width)
+    beat_index = np.unique(starts + np.argmax(search[starts], axis=1))
+    return time[beat_index]
+
+
+def detect_beats(time, volts=None, engine=DEFAULT_ENGINE):
+    """This function finds the heart beats in the ECG data once
+
+    The beats are found by the detector registered in DETECTORS under the
+    name engine, by default detect_threshold(). The voltage extremes are
+    found by calling calc_voltage_extremes() and the time between each pair
+    of beats is also stored so the heart rate can be calculated without
+    finding the beats again.
+
+    Args:
+        time (list): list of time values for the ECG data, or a Recording
+        volts (list): list of ECG voltage magnitudes, not needed if time is
+            a Recording
+        engine (str): the name of the detector to use
+
+    Returns:
+        BeatDetection : the beats, time between beats and voltage extremes
+    """
+    if engine not in DETECTORS:
+        raise ValueError("engine must be one of {}".format(
+            sorted(DETECTORS)))
+    logging.info('Finding the times that each '
+                 'heart beat occurred')
+    with _stage('detect') as stage:
+        time, volts = _recording_arrays(time, volts)
+        extremes = calc_voltage_extremes(volts)
+        beats = DETECTORS[engine](time, volts)
+        rr_intervals = np.diff(beats)
+        stage.count(samples=volts.size, beats=beats.size)
+    return BeatDetection(beats.tolist(), rr_intervals, extremes)
+
+
+def _attach_segments(name, num_samples):
+    """Attach to the shared memory made by detect_beats_segments()
+
+    Returns the SharedMemory and a (3, num_samples) array of the time
+    values, the raw voltages and the filtered voltages.
+    """
+    from multiprocessing.shared_memory import SharedMemory
+    shared = SharedMemory(name=name)
+    arrays = np.ndarray((3, num_samples), dtype=np.float64,
+                        buffer=shared.buf)
+    return shared, arrays
+
+
+def _filter_segment(name, num_samples, start, stop, pad, sample_rate, band,
+                    order):
+    """Filter one segment and its overlap into the shared filtered voltages
+
+    Only the samples from start to stop are written. Returns their min and
+    max.
+    """
+    from scipy.signal import filtfilt
+    shared, arrays = _attach_segments(name, num_samples)
+    try:
+        low = max(start - pad, 0)
+        b, a = filter_coefficients(sample_rate, band, order)
+        filtered = filtfilt(b, a, arrays[1, low:stop + pad])
+        arrays[2, start:stop] = filtered[start - low:stop - low]
+        extremes = (filtered[start - low:stop - low].min(),
+                    filtered[start - low:stop - low].max())
+    finally:
+        del arrays
+        shared.close()
+    return extremes
+
+
+def _detect_segment(name, num_samples, start, stop, pad, engine, threshold):
+    """Find the beats of one segment and its overlap in the shared filtered
+    voltages
+
+    Only the beats from the time of sample start up to the time of sample
+    stop are returned, so every beat belongs to exactly one segment.
+    """
+    shared, arrays = _attach_segments(name, num_samples)
+    time = volts = None
+    try:
+        low = max(start - pad, 0)
+        time = arrays[0, low:stop + pad]
+        volts = arrays[2, low:stop + pad]
+        if engine == 'threshold':
+            beats = _group_similar_times(
+                time[np.flatnonzero(volts > threshold)])
+        else:
+            beats = np.array(DETECTORS[engine](time, volts))
+        keep = beats >= arrays[0, start]
+        if stop < num_samples:
+            keep &= beats < arrays[0, stop]
+        beats = beats[keep]
+    finally:
+        del arrays, time, volts
+        shared.close()
+    return beats
+
+
+def detect_beats_segments(recording, segments, band=FILTER_BAND,
+                          order=FILTER_ORDER, engine=DEFAULT_ENGINE,
+                          workers=None, overlap=SEGMENT_OVERLAP):
+    """This function filters a recording and finds its beats in segments
+    on a pool of processes
+
+    The recording is split into segments of about the same length. The
+    time values and voltages are copied once into a
+    multiprocessing.shared_memory block, which the worker processes of a
+    concurrent.futures.ProcessPoolExecutor read instead of being sent
+    pickled copies. Each segment is filtered together with overlap seconds
+    of data on either side, which is long enough for the filter to settle,
+    and only the segment itself is written to the shared filtered
+    voltages. The largest filtered voltage gives the 'threshold' engine
+    the same threshold as the whole recording, and the beats of each
+    segment are then found with overlap seconds on either side and kept
+    only if they are inside the segment, so a beat in an overlap is not
+    counted twice. For the 'threshold' engine the beats and mean heart
+    rate are the same as filter_data() and detect_beats() give for the
+    whole recording, and the filtered voltages and extremes differ only by
+    rounding. Engines that look at the whole recording, such as
+    the noise floor of 'adaptive', may differ slightly. Engines registered
+    after the module is imported are only available to the workers when
+    processes are started by forking. Python 3.8 or newer is needed for
+    shared memory.
+
+    Args:
+        recording (Recording): the recording to analyze
+        segments (int): number of segments to split the recording into
+        band (tuple): (low, high) cutoff frequencies of the filter in Hz
+        order (int): the order of the filter
+        engine (str): the name of the beat detector in DETECTORS
+        workers (int): number of worker processes, None uses one per CPU
+        overlap (float): seconds of data either side of every segment
+
+    Returns:
+        numpy.ndarray : the filtered ECG voltage values
+        BeatDetection : the beats, time between beats and voltage extremes
+    """
+    from multiprocessing.shared_memory import SharedMemory
+    if engine not in DETECTORS:
+        raise ValueError("engine must be one of {}".format(
+            sorted(DETECTORS)))
+    if segments < 1:
+        raise ValueError("segments must be at least 1")
+    num_samples = len(recording)
+    pad = int(math.ceil(overlap * recording.sample_rate))
+    bounds = np.unique(np.linspace(0, num_samples, segments + 1)
+                       .astype(int)).tolist()
+    spans = list(zip(bounds[:-1], bounds[1:]))
+    initargs = _log_config if _log_config is not None else ()
+    initializer = _init_worker_logging if _log_config is not None else None
+    shared = SharedMemory(create=True, size=3 * max(num_samples, 1) * 8)
+    arrays = None
+    try:
+        arrays = np.ndarray((3, num_samples), dtype=np.float64,
+                            buffer=shared.buf)
+        arrays[0] = recording.time
+        arrays[1] = recording.volt
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=initializer,
+                                 initargs=initargs) as pool:
+            logging.info('Filtering Data in {} segments'.format(len(spans)))
+            with _stage('filter') as stage:
+                futures = [pool.submit(_filter_segment, shared.name,
+                                       num_samples, start, stop, pad,
+                                       recording.sample_rate, tuple(band),
+                                       order) for start, stop in spans]
+                extremes = [future.result() for future in futures]
+                stage.count(samples=num_samples)
+            logging.info('Finding the times that each '
+                         'heart beat occurred')
+            with _stage('detect') as stage:
+                voltage_extremes = (min(low for low, high in extremes),
+                                    max(high for low, high in extremes))
+                threshold = voltage_extremes[1] * BEAT_THRESHOLD
+                futures = [pool.submit(_detect_segment, shared.name,
+                                       num_samples, start, stop, pad, engine,
+                                       threshold)
+                           for start, stop in spans]
+                beats = np.concatenate([future.result()
+                                        for future in futures])
+                stage.count(samples=num_samples, beats=beats.size)
+        volt = arrays[2].copy()
+        volt.flags.writeable = False
+    finally:
+        del arrays
+        shared.close()
+        shared.unlink()
+    detection = BeatDetection(beats.tolist(), np.diff(beats),
+                              voltage_extremes)
+    return volt, detection
+
+
+def detect_beats_leads(time, volts):
+    """This function finds the heart beats in every lead of the ECG data
+
+    This is detect_beats() for a 2-D array of voltages with a column per
+    lead, done for all of the leads at once. The max of each lead is found
+    with one numpy call and the samples above half of their lead's max are
+    picked out with a single boolean mask. The samples are then grouped
+    into beats the same way as group_similar_values(), with a new group
+    also starting wherever the lead changes, so each lead gives the same
+    beats as calling detect_beats() on it alone.
+
+    Args:
+        time (list): list of time values for the ECG data
+        volts (numpy.ndarray): 2-D array of voltages with a column per lead
+
+    Returns:
+        list : a BeatDetection for each lead
+    """
+    logging.info('Finding the times that each '
+                 'heart beat occurred in each lead')
+    with _stage('detect') as stage:
+        time = np.asarray(time)
+        volts = np.asarray(volts)
+        num_leads = volts.shape[1]
+        minimum = volts.min(axis=0)
+        maximum = volts.max(axis=0)
+        lead, sample = np.nonzero((volts > maximum * BEAT_THRESHOLD).T)
+        beat_times = time[sample]
+        if beat_times.size == 0:
+            beats = beat_times
+            beat_lead = lead
+        else:
+            new_group = ((np.diff(beat_times) > BEAT_GAP) |
+                         (np.diff(lead) != 0))
+            starts = np.concatenate(([0], np.flatnonzero(new_group) + 1))
+            ends = np.append(starts[1:], beat_times.size)
+            beats = beat_times[starts + (ends - starts) // 2]
+            beat_lead = lead[starts]
+        same_lead = beat_lead[1:] == beat_lead[:-1]
+        rr_intervals = np.diff(beats)[same_lead]
+        counts = np.bincount(beat_lead, minlength=num_leads)
+        lead_beats = np.split(beats, np.cumsum(counts)[:-1])
+        lead_rr = np.split(rr_intervals,
+                           np.cumsum(np.maximum(counts - 1, 0))[:-1])
+        stage.count(samples=volts.size, beats=beats.size)
+    return [BeatDetection(lead_beats[i].tolist(), lead_rr[i],
+                          (minimum[i], maximum[i]))
+            for i in range(num_leads)]
+
+
+def consensus_beats(lead_beats, min_leads=None):
+    """This function finds the beats that most of the leads agree on
+
+    The beats of all of the leads are pooled and sorted, then grouped the
+    same way as group_similar_values() so that beats from different leads
+    less than 0.1 s apart fall in one group. A group is kept if it holds at
+    least min_leads beats, and its median time is the consensus beat.
+
+    Args:
+        lead_beats (list): a list of beat times for each lead
+        min_leads (int): the number of leads that must see a beat, by
+            default more than half of the leads
+
+    Returns:
+        numpy.ndarray : the times of the consensus beats
+    """
+    if min_leads is None:
+        min_leads = len(lead_beats) // 2 + 1
+    pooled = np.sort(np.concatenate([np.asarray(beats, dtype=np.float64)
+                                     for beats in lead_beats]))
+    if pooled.size == 0:
+        return pooled
+    starts = np.flatnonzero(np.diff(pooled) > BEAT_GAP) + 1
+    starts = np.concatenate(([0], starts))
+    ends = np.append(starts[1:], pooled.size)
+    keep = (ends - starts) >= min_leads
+    return pooled[starts[keep] + (ends[keep] - starts[keep]) // 2]
+
+
+def calc_beats(time, volts=None, detection=None):
     """This function returns the time points of heart beats by looking
     at the voltage values
 
-    This function takes the time and voltage lists as input. The max voltage
-    is stored in the variable maximum by calling the function
-    calc_voltage_extremes() and selecting the max value. A for
-    loop loops through the voltage values and stores the time points
-    where the voltage is greater than half of the max voltage. This list
-    of times is sent to the function group_similar_values() which
-    returns the list of times corresponding to heart beats.
+    This function takes the time and voltage lists as input and returns the
+    beat times found by detect_beats(). If the BeatDetection for this data
+    has already been made it can be passed in as detection so that the beats
+    are not searched for again.
 
     Args:
-        time (list): list of time values for the ECG data
-        volts (list): list of ECG voltage magnitudes
+        time (list): list of time values for the ECG data, or a Recording
+        volts (list): list of ECG voltage magnitudes, not needed if time is
+            a Recording
+        detection (BeatDetection): result of detect_beats() for this data
 
     Returns:
         list : list of time values corresponding to heart beats
     """
-    logging.info('Finding the times that each '
-                 'heart beat occurred')
-    beat_list = list()
-    extremes = calc_voltage_extremes(volts)
-    maximum = extremes[1]
-    for i in range(len(volts)):
-        if volts[i] > (maximum / 2):
-            beat_list.append(time[i])
-    beat_list = group_similar_values(beat_list)
-    return beat_list
+    if detection is None:
+        detection = detect_beats(time, volts)
+    return detection.beats
 
 
-def calc_mean_hr_bpm(time, volts):
+def calc_mean_hr_bpm(time, volts=None, detection=None):
     """This function returns the average heart rate over the ECG data
 
-    The two lists time and volts are used as input parameters and are sent
-    to the function calc_beats which returns the list of time points
-    corresponding to heart beats. Using a for loop the time between beats
-    are stored in the list hr_list. The inverse of the time between the
-    beats is multiplied by 60 to convert beats per second to beats per
-    minute. The average of this list of heart rates is calculated by
-    finding the mean of the heart rates.
+    The time between beats is taken from the BeatDetection made by
+    detect_beats(). The inverse of the time between the beats is multiplied
+    by 60 to convert beats per second to beats per minute. The average of
+    this list of heart rates is calculated by finding the mean of the heart
+    rates.
 
     Args:
-        time (list): list of time values for the ECG data
-        volts (list): list of ECG voltage magnitudes
+        time (list): list of time values for the ECG data, or a Recording
+        volts (list): list of ECG voltage magnitudes, not needed if time is
+            a Recording
+        detection (BeatDetection): result of detect_beats() for this data
 
     Returns:
         float : mean heart rate over the ECG data
     """
     logging.info('Calculating the mean heart rate '
                  'in beats-per-minute')
-    beat_list = calc_beats(time, volts)
-    hr_list = list()
-    for i in range(len(beat_list)):
-        if i > 0:
-            diff = beat_list[i] - beat_list[i-1]
-            hr_list.append(diff)
-    ave_hr = [(1/x)*60 for x in hr_list]
-    ave = np.mean(ave_hr)
-    return ave
-
-
-def calc_num_beats(time, volt):
+    if detection is None:
+        detection = detect_beats(time, volts)
+    return detection.mean_hr_bpm
+
+
+def calc_num_beats(time, volt=None, detection=None):
     """This returns the number of heart beats over the ECG data.
 
-    This function calls the function calc_beats to get the list
-    of heart beats for the ECG data. The length of this list
-    returned which is the number of beats in the list.
+    This function returns the number of beats in the BeatDetection made by
+    detect_beats() for the ECG data.
 
     Args:
-        time (list): list of time values for the ECG data
-        volts (list): list of ECG voltage magnitudes
+        time (list): list of time values for the ECG data, or a Recording
+        volts (list): list of ECG voltage magnitudes, not needed if time is
+            a Recording
+        detection (BeatDetection): result of detect_beats() for this data
 
     Returns:
         int : the number of beats in the ECG data
     """
     logging.info('Calculating the number of heart beats')
-    beats = calc_beats(time, volt)
-    return len(beats)
+    if detection is None:
+        detection = detect_beats(time, volt)
+    return detection.num_beats
+
+
+def calc_hrv(beats, window=HRV_WINDOW, step=HRV_STEP, start=None,
+             stop=None):
+    """This function calculates the heart rate and heart rate variability
+    in sliding windows
+
+    Windows window seconds long start every step seconds from start, and
+    every window that ends by stop is used. A window holds the beats at or
+    after its start and before its end, and the time between consecutive
+    beats in the window (the RR intervals) gives its metrics:
+
+    * mean_hr_bpm: the mean of 60 / RR, the same as calc_mean_hr_bpm()
+    * sdnn_ms: the standard deviation of the RR intervals
+    * rmssd_ms: the root mean square of the differences between
+      consecutive RR intervals
+    * pnn50: the percentage of those differences that are over 50 ms
+
+    Running sums of the RR intervals, their squares, the heart rates and the
+    squared and over 50 ms differences are made once with numpy.cumsum, and
+    the first and last beat of every window are found with
+    numpy.searchsorted. The sums for a window are then the difference of
+    two running sums, so the cost does not depend on how much the windows
+    overlap. Windows with too few beats for a metric give NaN.
+
+    Args:
+        beats (list): the times of the heart beats
+        window (float): the length of each window in seconds
+        step (float): the time between the starts of the windows
+        start (float): start of the first window, by default the first beat
+        stop (float): windows must end by this time, by default the last
+            beat
+
+    Returns:
+        dictionary : the window and step and, for each window, its start,
+        number of beats, mean_hr_bpm, sdnn_ms, rmssd_ms and pnn50
+    """
+    beats = np.asarray(beats, dtype=np.float64)
+    if start is None:
+        start = beats[0] if beats.size > 0 else 0.0
+    if stop is None:
+        stop = beats[-1] if beats.size > 0 else 0.0
+    num_windows = int(np.floor((stop - start - window) / step + 1e-9)) + 1
+    starts = start + step * np.arange(max(num_windows, 0), dtype=np.float64)
+    first = np.searchsorted(beats, starts, 'left')
+    last = np.searchsorted(beats, starts + window, 'left')
+    rr = np.diff(beats)
+    # Centering the intervals keeps the running sums of squares accurate
+    # over long recordings
+    centered = rr - (rr.mean() if rr.size > 0 else 0.0)
+    diffs = np.diff(rr)
+
+    def running(values):
+        return np.concatenate(([0.0], np.cumsum(values)))
+
+    def window_sums(sums, count):
+        begin = np.minimum(first, sums.size - 1)
+        return sums[begin + count] - sums[begin]
+
+    num_rr = np.maximum(last - first - 1, 0)
+    num_diffs = np.maximum(last - first - 2, 0)
+    rr_sum = window_sums(running(centered), num_rr)
+    rr_squares = window_sums(running(centered ** 2), num_rr)
+    hr_sum = window_sums(running(60 / rr), num_rr)
+    diff_squares = window_sums(running(diffs ** 2), num_diffs)
+    nn50 = window_sums(running(np.abs(diffs) > 0.05), num_diffs)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_hr_bpm = hr_sum / num_rr
+        variance = (rr_squares - rr_sum ** 2 / num_rr) / (num_rr - 1)
+        sdnn = np.sqrt(np.maximum(variance, 0)) * 1000
+        rmssd = np.sqrt(diff_squares / num_diffs) * 1000
+        pnn50 = nn50 / num_diffs * 100
+    sdnn[num_rr < 2] = np.nan
+    return {"window": window, "step": step,
+            "start": starts.tolist(),
+            "num_beats": (last - first).tolist(),
+            "mean_hr_bpm": mean_hr_bpm.tolist(),
+            "sdnn_ms": sdnn.tolist(),
+            "rmssd_ms": rmssd.tolist(),
+            "pnn50": pnn50.tolist()}
 
 
 def calc_voltage_extremes(volt):
     """This function calculates the extreme values in the ECG data.
 
     This functon takes the volt list as input which is the magnitude
-    of the ECG data, and finds the extreme values using the max() and
-    min() values. The max and min values are returned as a tuple.
+    of the ECG data, and finds the extreme values using numpy.max() and
+    numpy.min(). The max and min values are returned as a tuple.
 
     Args:
-        volts (list): list of ECG voltage magnitudes
+        volts (list): list of ECG voltage magnitudes, or a Recording
 
     Returns:
         tuple: (min, max)
     """
     logging.info('Finding max and min ECG values')
-    maximum = max(volt)
-    minimum = min(volt)
+    if isinstance(volt, Recording):
+        volt = volt.volt
+    volt = np.asarray(volt)
+    maximum = np.max(volt)
+    minimum = np.min(volt)
     ans = (minimum, maximum)
     return ans
 
@@ -174,44 +1349,220 @@ def calc_duration(time):
     value from the last time value.
 
     Args:
-        time (list): list of time values for the ECG data
+        time (list): list of time values for the ECG data, or a Recording
 
     Returns:
         float : duration of ECG data in seconds
     """
     logging.info('Calculating ECG duration')
+    if isinstance(time, Recording):
+        time = time.time
     first = time[0]
     last = time[-1]
     return last - first
 
 
-def filter_data(time, raw_volt):
-    """This function filters out noise below 10 Hz and above 50Hz
+def estimate_sample_rate(time, max_intervals=SAMPLE_RATE_INTERVALS):
+    """This function estimates the sample rate of the ECG data
 
-    This filter takes the time and raw_volt data as input and
-    filters out noises below 10 Hz and above 50 Hz using the heartpy
-    function filter_signal. See documentation on the filter_signal function
-    at: https://python-heart-rate-analysis-toolkit.readthedocs.io/en/
-    latest/_modules/heartpy/filtering.html
+    Only the first max_intervals intervals between time values are used so
+    that the estimate does not depend on the length of the recording, which
+    keeps stream_metrics() and calc_metrics() in agreement. A rough sample
+    period is found first from the median time taken by 16 samples, which
+    is not thrown off by gaps or by time values that have been rounded,
+    for example 720 Hz data with time in whole milliseconds. The sample
+    rate is then one over the mean of the positive intervals shorter than
+    GAP_FACTOR rough periods, so that gaps and time values that go back are
+    left out. A ValueError is raised if the time values never increase,
+    for example if they are all the same, because such data has no sample
+    rate.
 
     Args:
         time (list): list of time values for the ECG data
-        volts (list): list of ECG voltage magnitudes
+        max_intervals (int): number of intervals to look at
+
+    Returns:
+        float : samples per second
+    """
+    time = np.asarray(time[:max_intervals + 1], dtype=np.float64)
+    if time.size < 2:
+        raise ValueError("at least two time values are needed to find the "
+                         "sample rate")
+    span = min(16, time.size - 1)
+    period = np.median(time[span:] - time[:-span]) / span
+    intervals = np.diff(time)
+    intervals = intervals[intervals > 0]
+    regular = intervals[intervals < GAP_FACTOR * period]
+    if regular.size == 0:
+        regular = intervals
+    mean = np.mean(regular) if regular.size else np.nan
+    if not np.isfinite(mean):
+        raise ValueError("the time values do not increase, so there is no "
+                         "sample rate")
+    return float(1 / mean)
+
+
+def find_gaps(time, sample_rate=None, factor=GAP_FACTOR):
+    """This function finds the gaps in the ECG data
+
+    A gap is an interval between neighbouring time values more than factor
+    times as long as one sample period, for example where rows were skipped
+    by read_input() or the recorder stopped.
+
+    Args:
+        time (list): list of time values for the ECG data
+        sample_rate (float): samples per second, by default
+            estimate_sample_rate() of time
+        factor (float): how many sample periods make a gap
+
+    Returns:
+        numpy.ndarray : an array of (start, end) times, one row per gap
+    """
+    time = np.asarray(time, dtype=np.float64)
+    if time.size < 2:
+        return np.empty((0, 2))
+    if sample_rate is None:
+        sample_rate = estimate_sample_rate(time)
+    index = np.flatnonzero(np.diff(time) > factor / sample_rate)
+    return np.column_stack((time[index], time[index + 1]))
+
+
+def resample_uniform(time, volt=None, sample_rate=None):
+    """This function resamples the ECG data onto evenly spaced times
+
+    The new times start at the first time value and are one sample period
+    apart up to the last time value, and the voltages at them are linearly
+    interpolated with numpy.interp. Gaps are bridged by a straight line.
+
+    Args:
+        time (list): list of time values for the ECG data, or a Recording
+        volt (list): list of ECG voltage magnitudes, not needed if time is a
+            Recording
+        sample_rate (float): samples per second of the new times, by
+            default the sample rate of the recording
+
+    Returns:
+        Recording : the resampled recording, with the same metadata
+    """
+    recording = as_recording(time, volt)
+    if sample_rate is None:
+        sample_rate = recording.sample_rate
+    start = recording.time[0]
+    num_samples = int(np.floor((recording.time[-1] - start) * sample_rate
+                               + 1e-6)) + 1
+    new_time = start + np.arange(num_samples) / sample_rate
+    new_volt = np.interp(new_time, recording.time, recording.volt)
+    metadata = dict(recording.metadata, resampled=True)
+    return Recording(new_time, new_volt, sample_rate, metadata)
+
+
+@functools.lru_cache(maxsize=64)
+def filter_coefficients(sample_rate, band=FILTER_BAND, order=FILTER_ORDER):
+    """This function designs the Butterworth band-pass filter
+
+    The coefficients are designed with scipy.signal.butter() with the band
+    given as fractions of the Nyquist frequency, the same design as
+    heartpy's butter_bandpass(), which filter_signal() uses. heartpy is not
+    imported because it imports matplotlib.pyplot, which is slow and picks
+    a GUI backend in workers that have no display. The coefficients are
+    cached for each sample rate, band and order so that the filter is only
+    designed once, and since every caller shares the cached arrays they are
+    read-only.
+
+    Args:
+        sample_rate (float): samples per second of the ECG data
+        band (tuple): (low, high) cutoff frequencies in Hz
+        order (int): the order of the filter
+
+    Returns:
+        tuple : (b, a) numerator and denominator of the filter
+    """
+    from scipy.signal import butter
+    nyquist = 0.5 * sample_rate
+    b, a = butter(order, [band[0] / nyquist, band[1] / nyquist], btype='band')
+    b.flags.writeable = False
+    a.flags.writeable = False
+    return b, a
+
+
+def clear_filter_cache():
+    """This function empties the cache of filtered voltages"""
+    with _filter_cache_lock:
+        _filter_cache.clear()
+
+
+def filter_data(time, raw_volt=None, band=FILTER_BAND, order=FILTER_ORDER):
+    """This function filters out noise outside of a frequency band
+
+    This filter takes the time and raw_volt data as input and removes the
+    frequencies outside of band with a forward-backward Butterworth filter,
+    the same filter as the heartpy function filter_signal. See documentation
+    on the filter_signal function at:
+    https://python-heart-rate-analysis-toolkit.readthedocs.io/en/
+    latest/_modules/heartpy/filtering.html
+
+    The sample rate is found by estimate_sample_rate(). The filter
+    coefficients are designed once per sample rate, band and order by
+    filter_coefficients(). The filtered voltages are kept in a cache of at
+    most FILTER_CACHE_BYTES, keyed by a hash of the raw voltages together
+    with the sample rate, band and order, so filtering the same data again
+    returns the cached result. The returned array is shared with the cache
+    and is read-only. scipy takes a long time to import, so it is only
+    imported the first time the data is filtered. raw_volt may
+    also be a 2-D array with a column per lead, in which case every lead is
+    filtered by the same call. If time is a Recording its voltages and
+    sample rate are used.
+
+    Args:
+        time (list): list of time values for the ECG data, or a Recording
+        raw_volt (list): list of ECG voltage magnitudes, or a 2-D array of
+            voltages with a column per lead, not needed if time is a
+            Recording
+        band (tuple): (low, high) cutoff frequencies in Hz
+        order (int): the order of the filter
 
     Returns:
-        list : the filtered ECG voltage values
+        numpy.ndarray : the filtered ECG voltage values
     """
+    from scipy.signal import filtfilt
     logging.info('Filtering Data')
-    sample_rate = 1 / (time[1] - time[0])
-    volt = hp.filter_signal(raw_volt, [5, 20], sample_rate, 2, 'bandpass')
+    with _stage('filter') as stage:
+        if isinstance(time, Recording):
+            sample_rate = time.sample_rate
+            raw_volt = time.volt
+        else:
+            sample_rate = estimate_sample_rate(time)
+        band = tuple(band)
+        raw_volt = np.ascontiguousarray(raw_volt, dtype=np.float64)
+        digest = hashlib.blake2b(raw_volt).digest()
+        key = (digest, raw_volt.shape, sample_rate, band, order)
+        stage.count(samples=raw_volt.size)
+        with _filter_cache_lock:
+            cached = _filter_cache.get(key)
+            if cached is not None:
+                _filter_cache.move_to_end(key)
+                stage.count(cache_hits=1)
+                return cached
+        b, a = filter_coefficients(sample_rate, band, order)
+        volt = filtfilt(b, a, raw_volt, axis=0)
+        volt.flags.writeable = False
+    with _filter_cache_lock:
+        _filter_cache[key] = volt
+        total = sum(cached.nbytes for cached in _filter_cache.values())
+        while total > FILTER_CACHE_BYTES and len(_filter_cache) > 1:
+            old_key, cached = _filter_cache.popitem(last=False)
+            total -= cached.nbytes
     return volt
 
 
-def make_dictionary(duration, voltage_extremes, num_beats, mean_hr_bpm, beats):
+def make_dictionary(duration, voltage_extremes, num_beats, mean_hr_bpm, beats,
+                    hrv=None, gaps=None):
     """This function returns a dictionary of ECG metric data
 
     This function makes a dictionary containing all of the ECG metric data,
     which is passed into the function as the function's input parameters.
+    The sliding window heart rate variability is only added under "hrv" and
+    the gaps in the data under "gaps" if they are given.
 
     Args:
         duration (float): the time duration of the ECG data
@@ -219,6 +1570,8 @@ def make_dictionary(duration, voltage_extremes, num_beats, mean_hr_bpm, beats):
         num_beats (int): the number of heart beats in the ECG data
         mean_hr_bpm (float): the mean heart rate in beats per minutes
         beats (list): the list of times corresponding to heart beats
+        hrv (dict): the windowed metrics made by calc_hrv()
+        gaps (list): [start, end] times of each gap found by find_gaps()
 
     Returns:
         dictionary : dictionary containing ecg metrics
@@ -226,61 +1579,440 @@ def make_dictionary(duration, voltage_extremes, num_beats, mean_hr_bpm, beats):
     metrics = {"duration": duration, "voltage_extremes": voltage_extremes,
                "num_beats": num_beats, "mean_hr_bpm": mean_hr_bpm,
                "beats": beats}
+    if hrv is not None:
+        metrics["hrv"] = hrv
+    if gaps is not None:
+        metrics["gaps"] = gaps
     return metrics
 
 
-def plot_data(time, volt, filename):
+class DecimationPyramid:
+    """This class holds a min/max decimation of ECG data for plotting
+
+    Level 0 holds the smallest and largest voltage of every factor samples,
+    and every level above it holds the smallest and largest voltage of
+    factor buckets of the level below, up to a single bucket for the whole
+    recording. The levels together take about two thirds of the memory of
+    the voltages. envelope() picks the level with about one bucket per pixel
+    for a range of time, so drawing any part of a recording of any length
+    takes a number of points set by the width of the plot and not by the
+    number of samples, while every spike is still drawn at its full
+    height. volt may have a column per lead.
+
+    Attributes:
+        time (numpy.ndarray): time values for the ECG data
+        volt (numpy.ndarray): ECG voltage magnitudes
+        factor (int): number of buckets of a level in a bucket of the next
+        levels (list): (minimums, maximums) of every level, finest first
+    """
+
+    __slots__ = ('time', 'volt', 'factor', 'levels')
+
+    def __init__(self, time, volt, factor=PYRAMID_FACTOR):
+        self.time = np.asarray(time, dtype=np.float64)
+        self.volt = np.asarray(volt, dtype=np.float64)
+        if factor < 2:
+            raise ValueError("factor must be at least 2")
+        self.factor = factor
+        self.levels = list()
+        minimums = maximums = self.volt
+        while len(minimums) > 1:
+            starts = np.arange(0, len(minimums), factor)
+            minimums = np.minimum.reduceat(minimums, starts, axis=0)
+            maximums = np.maximum.reduceat(maximums, starts, axis=0)
+            self.levels.append((minimums, maximums))
+
+    def envelope(self, start=None, stop=None, width=1000):
+        """Return the points to draw for a range of time
+
+        If the range holds no more than two samples per pixel the samples
+        are returned as they are. Otherwise the finest level with no more
+        than width buckets in the range is used and every bucket is drawn
+        as a vertical line from its minimum to its maximum at the time of
+        its first sample.
+
+        Args:
+            start (float): first time to draw, or None for the beginning
+            stop (float): last time to draw, or None for the end
+            width (int): width of the plot in pixels
+
+        Returns:
+            numpy.ndarray : time of every point
+            numpy.ndarray : voltage of every point
+        """
+        low = 0 if start is None else np.searchsorted(self.time, start)
+        high = len(self.time) if stop is None else np.searchsorted(
+            self.time, stop, side='right')
+        count = high - low
+        if count <= 2 * width:
+            return self.time[low:high], self.volt[low:high]
+        size = self.factor
+        for minimums, maximums in self.levels:
+            if count <= width * size:
+                break
+            size *= self.factor
+        first = low // size
+        last = (high - 1) // size + 1
+        bucket_times = self.time[np.arange(first, last) * size]
+        bucket_times[0] = self.time[low]
+        times = np.repeat(bucket_times, 2)
+        volts = np.stack((minimums[first:last], maximums[first:last]),
+                         axis=1)
+        return times, volts.reshape((-1,) + self.volt.shape[1:])
+
+
+def _visible_beats(beats, start, stop, width):
+    """Return the beats between start and stop, at most one per pixel"""
+    beats = np.asarray(beats, dtype=np.float64)
+    beats = beats[(beats >= start) & (beats <= stop)]
+    if len(beats) > width and stop > start:
+        pixels = ((beats - start) * (width / (stop - start))).astype(int)
+        beats = beats[np.r_[True, np.diff(pixels) > 0]]
+    return beats
+
+
+def _draw_range(ax, pyramid, beats, start, stop, width):
+    """Draw a range of the ECG data and its beats on a matplotlib Axes"""
+    times, volts = pyramid.envelope(start, stop, width)
+    lines = ax.plot(times, volts, linewidth=0.5)
+    marks = None
+    if beats is not None and len(times):
+        marks = ax.vlines(_visible_beats(beats, times[0], times[-1], width),
+                          0, 1, transform=ax.get_xaxis_transform(),
+                          colors='r', linewidth=0.5, alpha=0.5)
+    ax.set_xlabel("Time (s)")
+    ax.set_ylabel("Voltage (mV)")
+    return lines, marks
+
+
+def save_plots(time, volt, filename, beats=None, zooms=(), pyramid=None):
+    """This function saves an overview and zoomed plots of the ECG data
+
+    The overview of the whole recording is saved next to the input file
+    with a '.png' extension and each (start, stop) range of time in zooms
+    is saved with the range added to the name, for example
+    'data_10-20s.png'. The data is drawn from a DecimationPyramid, so the
+    time and memory taken to draw each plot do not depend on the length of
+    the recording, and the beat times are marked with red lines. The
+    plots are drawn on matplotlib Figures that are not attached to pyplot,
+    which need no display. The plots of data with no filename are saved
+    in the working directory under DEFAULT_PLOT_NAME, for example
+    'ecg.png' and 'ecg_10-20s.png'.
+
+    Args:
+        time (list): list of time values for the ECG data
+        volts (list): list of ECG voltage magnitudes
+        filename (str): the string of the filename to be opened, or None
+        beats (list): the beat times to mark, or None
+        zooms (list): (start, stop) ranges of time to save plots of
+        pyramid (DecimationPyramid): the decimation of time and volt, made
+            here if it is None
+
+    Returns:
+        list : the names of the saved png files, the overview first
+    """
+    from matplotlib.figure import Figure
+    if pyramid is None:
+        pyramid = DecimationPyramid(time, volt)
+    filename = filename or DEFAULT_PLOT_NAME
+    base = os.path.splitext(filename)[0]
+    png_filenames = list()
+    for window in [(None, None)] + list(zooms):
+        fig = Figure()
+        ax = fig.subplots()
+        width = int(fig.get_figwidth() * fig.dpi)
+        _draw_range(ax, pyramid, beats, window[0], window[1], width)
+        if window[0] is None:
+            ax.set_title(filename)
+            png_filename = base + ".png"
+        else:
+            ax.set_title("{} ({:g} to {:g} s)".format(filename, *window))
+            png_filename = "{}_{:g}-{:g}s.png".format(base, *window)
+        fig.savefig(png_filename)
+        png_filenames.append(png_filename)
+    return png_filenames
+
+
+def plot_data(time, volt, filename, mode='interactive', beats=None,
+              zooms=()):
     """This function plots the ECG data for a file
 
-    This function takes three arguments as inputs: time, volt,
-    and filename. It uses matplotlib.pyplot to plot the time and
-    voltage pairs and uses the filename as the title.
+    This function takes the time and volt data and the filename and plots
+    the time and voltage pairs with the filename as the title. The mode
+    decides what happens to the plot. 'interactive' shows it with
+    matplotlib.pyplot and waits for the window to be closed. 'png' saves
+    it and the zoomed plots in zooms with save_plots(), which needs no
+    display. 'none' does not plot anything. matplotlib is only imported
+    when a plot is made. The data is drawn from a DecimationPyramid, and in
+    the interactive window it is drawn again in more detail whenever the
+    plot is zoomed, so long recordings can be plotted and explored
+    quickly. The beat times, if given, are marked with red lines.
 
     Args:
         time (list): list of time values for the ECG data
         volts (list): list of ECG voltage magnitudes
         filename (str): the string of the filename to be opened
+        mode (str): one of 'none', 'png' or 'interactive'
+        beats (list): the beat times to mark, or None
+        zooms (list): (start, stop) ranges of time to save plots of in the
+            'png' mode
+
+    Returns:
+        str : the name of the saved overview png file, or None if nothing
+        was saved
     """
-    plt.plot(time, volt)
-    plt.title(filename)
-    plt.xlabel("Time (s)")
-    plt.ylabel("Voltage (mV)")
+    if mode not in PLOT_MODES:
+        raise ValueError("mode must be one of {}".format(PLOT_MODES))
+    if mode == 'none':
+        return None
+    pyramid = DecimationPyramid(time, volt)
+    if mode == 'png':
+        return save_plots(time, volt, filename, beats, zooms, pyramid)[0]
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots()
+    width = int(fig.get_figwidth() * fig.dpi)
+    drawn = [_draw_range(ax, pyramid, beats, None, None, width)]
+
+    def redraw(ax):
+        lines, marks = drawn.pop()
+        for line in lines:
+            line.remove()
+        if marks is not None:
+            marks.remove()
+        start, stop = ax.get_xlim()
+        ax.set_autoscalex_on(False)
+        drawn.append(_draw_range(ax, pyramid, beats, start, stop, width))
+
+    ax.set_title(filename)
+    ax.callbacks.connect('xlim_changed', redraw)
     plt.show()
+    plt.close(fig)
+    return None
+
+
+def plot_data_in_background(time, volt, filename, beats=None, zooms=()):
+    """This function saves the plot of the ECG data without waiting for it
+
+    The plot is saved as a png by plot_data() on a background thread so
+    that the caller can carry on calculating metrics while the plot is being
+    drawn. Only the 'png' mode can be used because interactive windows have
+    to be made on the main thread. wait_for_plots() waits for the plots that
+    are still being drawn.
+
+    Args:
+        time (list): list of time values for the ECG data
+        volts (list): list of ECG voltage magnitudes
+        filename (str): the string of the filename to be opened
+        beats (list): the beat times to mark, or None
+        zooms (list): (start, stop) ranges of time to save plots of
+
+    Returns:
+        concurrent.futures.Future : future holding the png filename
+    """
+    global _plot_executor
+    if _plot_executor is None:
+        _plot_executor = ThreadPoolExecutor(max_workers=1)
+    future = _plot_executor.submit(plot_data, time, volt, filename, 'png',
+                                   beats, zooms)
+    _pending_plots.append(future)
+    return future
 
 
-def calc_metrics(time, volt, filename):
+def wait_for_plots():
+    """This function waits for all plots started in the background
+
+    Returns:
+        list : the png filenames of the plots that were saved
+    """
+    done = wait(_pending_plots).done
+    _pending_plots.clear()
+    return [future.result() for future in done]
+
+
+def calc_metrics(time, volt=None, filename=None, plot='interactive',
+                 plot_in_background=False, band=FILTER_BAND,
+                 order=FILTER_ORDER, names=None, hrv_window=None,
+                 hrv_step=HRV_STEP, engine=DEFAULT_ENGINE, resample=False,
+                 zooms=(), segments=None):
     """This function calls the functions necessary to calculate the
     ECG metrics
 
     This function takes the time and volt lists as inputs and calls several
     functions to return a dictionary of ECG metrics. First filter_data() is
     called to get the voltage data without the high and low noise. Then the
-    duration is calculated using the function calc_duration(), the voltage
-    extremes are calculated by calling the function calc_voltage_extremes(),
-    the number of beats is calculated by calling the function
-    calc_num_beats(), the average heart rate is calculated by calling the
-    function calc_mean_hr_bpm(), the list of times corresponding to heart
-    beats is calculated by calling the function calc_beats(). All of the
-    metric data is put into a dictionare by calling the function
-    make_dictionary.
+    duration is calculated using the function calc_duration() and the beats
+    are found once by calling detect_beats() with the detector engine. The
+    voltage extremes, the number of beats, the average heart rate and the
+    list of times corresponding to heart beats are all read from that one
+    BeatDetection through calc_num_beats(), calc_mean_hr_bpm() and
+    calc_beats(). All of
+    the metric data is put into a dictionary by calling the function
+    make_dictionary. The filtered data is plotted by plot_data() using the
+    plot mode, or by plot_data_in_background() if plot_in_background is
+    True, with the beats marked and a png of every range of time in zooms.
+    time may be a Recording instead of separate time and voltage
+    sequences, in which case its filename is used if none is given. If volt
+    is a 2-D array with a column per lead the metrics of every lead are
+    calculated by calc_metrics_leads() instead. If hrv_window is
+    given, the heart rate and heart rate variability in windows of that
+    many seconds are calculated by calc_hrv() and added under "hrv".
+
+    The gaps in the time values are found by find_gaps() and, if there are
+    any, listed under "gaps". If resample is True the data is moved onto
+    evenly spaced times by resample_uniform() before it is filtered, so the
+    filter and the beat times are not thrown off by the gaps or by an
+    uneven sample rate.
+
+    If segments is given, a long recording is filtered and its beats are
+    found in that many overlapping segments on a pool of processes by
+    detect_beats_segments() instead of by filter_data() and
+    detect_beats(), which gives the same metrics for the 'threshold'
+    engine.
 
     Args:
-        time (list): list of time values for the ECG data
-        volts (list): list of ECG voltage magnitudes
+        time (list): list of time values for the ECG data, or a Recording
+        volts (list): list of ECG voltage magnitudes, not needed if time is
+            a Recording
+        filename (str): the string of the filename to be opened
+        plot (str): one of 'none', 'png' or 'interactive'
+        plot_in_background (bool): save the png plot on a background thread
+        band (tuple): (low, high) cutoff frequencies of the filter in Hz
+        order (int): the order of the filter
+        names (list): the name of each lead if volt has a column per lead
+        hrv_window (float): length in seconds of the heart rate variability
+            windows, for example HRV_WINDOW, or None to leave them out
+        hrv_step (float): seconds between the starts of the windows
+        engine (str): the name of the beat detector in DETECTORS, only
+            'threshold' can be used with more than one lead
+        resample (bool): resample the data onto evenly spaced times
+        zooms (list): (start, stop) ranges of time to save zoomed png plots
+            of when plot is 'png'
+        segments (int): number of segments to analyze in parallel, or None
+            to analyze the recording in this process
 
     Returns:
         dictionary : dictionary containing ecg metrics
     """
+    if np.ndim(volt) == 2:
+        if engine != 'threshold':
+            raise ValueError("only the 'threshold' engine can be used "
+                             "with more than one lead")
+        return calc_metrics_leads(time, volt, filename, names, plot=plot,
+                                  plot_in_background=plot_in_background,
+                                  band=band, order=order, zooms=zooms)
+    if plot not in PLOT_MODES:
+        raise ValueError("plot must be one of {}".format(PLOT_MODES))
+    if plot_in_background and plot != 'png':
+        raise ValueError("only png plots can be made in the background")
     logging.info('Beginning analysis of ECG data.')
-    volt = filter_data(time, volt)
+    detection = None
+    if isinstance(time, Recording) or resample or segments:
+        recording = as_recording(time, volt)
+        if filename is None:
+            filename = recording.metadata.get("filename", "")
+        gaps = find_gaps(recording.time, recording.sample_rate)
+        if resample:
+            recording = resample_uniform(recording)
+        if segments:
+            volt, detection = detect_beats_segments(recording, segments,
+                                                    band, order, engine)
+        else:
+            volt = filter_data(recording, band=band, order=order)
+        time = recording.time
+    else:
+        gaps = find_gaps(time)
+        volt = filter_data(time, volt, band, order)
+    duration = calc_duration(time)
+    if detection is None:
+        detection = detect_beats(time, volt, engine)
+    voltage_extremes = detection.voltage_extremes
+    num_beats = calc_num_beats(time, volt, detection)
+    mean_hr_bpm = calc_mean_hr_bpm(time, volt, detection)
+    beats = calc_beats(time, volt, detection)
+    with _stage('aggregate') as stage:
+        hrv = None
+        if hrv_window is not None:
+            hrv = calc_hrv(beats, hrv_window, hrv_step, time[0], time[-1])
+        metrics = make_dictionary(duration, voltage_extremes, num_beats,
+                                  mean_hr_bpm, beats, hrv,
+                                  gaps.tolist() if len(gaps) else None)
+        stage.count(beats=num_beats)
+    if plot_in_background:
+        plot_data_in_background(time, volt, filename, beats, zooms)
+    else:
+        plot_data(time, volt, filename, plot, beats, zooms)
+    return metrics
+
+
+def calc_metrics_leads(time, volts, filename, names=None, plot='interactive',
+                       plot_in_background=False, band=FILTER_BAND,
+                       order=FILTER_ORDER, zooms=()):
+    """This function calculates the ECG metrics of every lead of a
+    recording
+
+    The voltages are a 2-D array with a column per lead, as returned by
+    read_input_leads(). All of the leads are filtered by one call to
+    filter_data() and their beats are found by one call to
+    detect_beats_leads(). The metrics of each lead are put in a dictionary
+    by make_dictionary() and the beats the leads agree on are found by
+    consensus_beats(). Any gaps found by find_gaps() are listed under
+    "gaps". The filtered leads are plotted together the same way as
+    calc_metrics(), with the consensus beats marked.
+
+    Args:
+        time (list): list of time values for the ECG data
+        volts (numpy.ndarray): 2-D array of voltages with a column per lead
+        filename (str): the string of the filename to be opened
+        names (list): the name of each lead, by default 'lead1', 'lead2'...
+        plot (str): one of 'none', 'png' or 'interactive'
+        plot_in_background (bool): save the png plot on a background thread
+        band (tuple): (low, high) cutoff frequencies of the filter in Hz
+        order (int): the order of the filter
+        zooms (list): (start, stop) ranges of time to save zoomed png plots
+            of when plot is 'png'
+
+    Returns:
+        dictionary : the duration, a dictionary of metrics for each lead
+        under "leads" and the consensus beats under "consensus"
+    """
+    if plot not in PLOT_MODES:
+        raise ValueError("plot must be one of {}".format(PLOT_MODES))
+    if plot_in_background and plot != 'png':
+        raise ValueError("only png plots can be made in the background")
+    volts = np.asarray(volts)
+    if names is None:
+        names = ['lead{}'.format(i) for i in range(1, volts.shape[1] + 1)]
+    if len(names) != volts.shape[1]:
+        raise ValueError("there must be one name for each lead")
+    logging.info('Beginning analysis of multi-lead ECG data.')
+    gaps = find_gaps(time)
+    volts = filter_data(time, volts, band, order)
     duration = calc_duration(time)
-    voltage_extremes = calc_voltage_extremes(volt)
-    num_beats = calc_num_beats(time, volt)
-    mean_hr_bpm = calc_mean_hr_bpm(time, volt)
-    beats = calc_beats(time, volt)
-    plot_data(time, volt, filename)
-    metrics = make_dictionary(duration, voltage_extremes, num_beats,
-                              mean_hr_bpm, beats)
+    detections = detect_beats_leads(time, volts)
+    with _stage('aggregate') as stage:
+        leads = dict()
+        for name, detection in zip(names, detections):
+            leads[name] = make_dictionary(duration,
+                                          detection.voltage_extremes,
+                                          detection.num_beats,
+                                          detection.mean_hr_bpm,
+                                          detection.beats)
+        beats = consensus_beats([detection.beats
+                                 for detection in detections])
+        consensus = BeatDetection(beats.tolist(), np.diff(beats), None)
+        metrics = {"duration": duration,
+                   "leads": leads,
+                   "consensus": {"num_beats": consensus.num_beats,
+                                 "mean_hr_bpm": consensus.mean_hr_bpm,
+                                 "beats": consensus.beats}}
+        if len(gaps):
+            metrics["gaps"] = gaps.tolist()
+        stage.count(beats=consensus.num_beats)
+    if plot_in_background:
+        plot_data_in_background(time, volts, filename, consensus.beats,
+                                zooms)
+    else:
+        plot_data(time, volts, filename, plot, consensus.beats, zooms)
     return metrics
 
 
@@ -390,20 +2122,322 @@ def log_if_data_too_high(volt):
     Args:
         volt (list): list of ECG voltage magnitudes
     """
-    maximum = max(volt)
-    minimum = min(volt)
+    if np.size(volt) == 0:
+        return
+    maximum = np.max(volt)
+    minimum = np.min(volt)
     if maximum > 300 or minimum < -300:
         logging.warning("This file contains a value outside the "
                         "normal operating range of +/- 300 mV.")
     return
 
 
+def _load_clean_rows(source, num_lines, first_line, num_columns=2):
+    """Parse rows with numpy.loadtxt, returning None if any row is malformed
+
+    The good rows are returned as one 2-D array with a column per field. NaN
+    rows are still accepted by loadtxt, so they are dropped here and
+    reported as bad rows with the 'nan' reason.
+    """
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)
+            data = np.loadtxt(source, delimiter=',', comments=None,
+                              dtype=np.float64, ndmin=2)
+    except ValueError:
+        return None
+    if data.shape != (num_lines, num_columns):
+        return None
+    good = ~np.isnan(data).any(axis=1)
+    bad_lines = np.flatnonzero(~good) + first_line
+    bad_reasons = np.full(bad_lines.size, BAD_ROW_NAN, dtype=np.int8)
+    return data[good], bad_lines, bad_reasons
+
+
+def _empty_table(num_columns=2):
+    """Return the arrays _parse_table() gives for no lines"""
+    return (np.empty((0, num_columns), dtype=np.float64),
+            np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int8))
+
+
+def _split_columns(table):
+    """Split a two column table into contiguous time and voltage arrays"""
+    data, bad_lines, bad_reasons = table
+    return (np.ascontiguousarray(data[:, 0]),
+            np.ascontiguousarray(data[:, 1]), bad_lines, bad_reasons)
+
+
+def _empty_rows():
+    """Return the arrays parse_rows() gives for no lines"""
+    return _split_columns(_empty_table())
+
+
+def _parse_table(lines, num_columns, first_line):
+    """Parse csv lines with num_columns values each into a 2-D array
+
+    This is parse_rows() for any number of columns: loadtxt is tried first
+    and the lines are only checked one at a time if it fails.
+    """
+    if len(lines) == 0:
+        return _empty_table(num_columns)
+    table = _load_clean_rows(lines, len(lines), first_line, num_columns)
+    if table is not None:
+        return table
+    rows = list()
+    bad_lines = list()
+    bad_reasons = list()
+    for i, line in enumerate(lines):
+        fields = line.split(",")
+        if len(fields) != num_columns:
+            bad_lines.append(first_line + i)
+            bad_reasons.append(BAD_ROW_EMPTY)
+            continue
+        fields = [field.strip(" ") for field in fields]
+        if '' in fields:
+            bad_lines.append(first_line + i)
+            bad_reasons.append(BAD_ROW_EMPTY)
+            continue
+        try:
+            values = [float(field) for field in fields]
+        except ValueError:
+            bad_lines.append(first_line + i)
+            bad_reasons.append(BAD_ROW_NON_NUMERIC)
+            continue
+        if any(math.isnan(value) for value in values):
+            bad_lines.append(first_line + i)
+            bad_reasons.append(BAD_ROW_NAN)
+            continue
+        rows.append(values)
+    data = np.array(rows, dtype=np.float64).reshape(len(rows), num_columns)
+    return (data, np.array(bad_lines, dtype=np.int64),
+            np.array(bad_reasons, dtype=np.int8))
+
+
+def parse_rows(lines, first_line=1):
+    """This function converts a block of csv lines into time and voltage
+    arrays
+
+    The whole block is first handed to numpy.loadtxt, which parses it in
+    compiled code. If that fails, or if loadtxt quietly skipped blank lines,
+    the block is parsed again one line at a time using the same rules as
+    split_data() and check_data(): a row is bad if it does not have exactly
+    two columns or if either value is empty, non-numeric, or NaN. Each field
+    is only converted with float() once. The reason each bad row was
+    skipped is returned as an index into BAD_ROW_REASONS; a row without two
+    columns is missing a value, so its reason is 'empty'.
+
+    Args:
+        lines (list): list of csv lines without their newline characters
+        first_line (int): the line number of the first line in the file
+
+    Returns:
+        numpy.ndarray : float64 array of time values
+        numpy.ndarray : float64 array of voltages
+        numpy.ndarray : line numbers of the rows that were skipped
+        numpy.ndarray : int8 reason codes of the rows that were skipped
+    """
+    return _split_columns(_parse_table(lines, 2, first_line))
+
+
+def read_input_arrays(filename, block_rows=65536):
+    """This function reads the data from an input file into numpy arrays
+
+    The whole file is read in one go and parsed by numpy.loadtxt. Files with
+    bad rows make loadtxt fail, so in that case the lines are parsed in
+    blocks of block_rows lines with parse_rows(). Clean blocks still take the
+    fast path and only the blocks that contain bad rows are parsed line by
+    line. Bad rows are dropped and their line numbers and reasons are
+    returned instead of being logged one at a time.
+
+    Args:
+        filename (str): the string of the filename to be opened
+        block_rows (int): number of lines handed to parse_rows() at a time
+
+    Returns:
+        numpy.ndarray : float64 array of time values
+        numpy.ndarray : float64 array of voltages
+        numpy.ndarray : line numbers (starting at 1) of the skipped rows
+        numpy.ndarray : reason codes of the skipped rows, see parse_rows()
+    """
+    with _stage('read') as stage:
+        with open(filename, 'r', errors='replace') as f:
+            text = f.read()
+        stage.count(characters=len(text))
+    with _stage('validate') as stage:
+        arrays = _split_columns(_parse_text(text, block_rows))
+        stage.count(samples=arrays[0].size, bad_rows=arrays[2].size)
+    return arrays
+
+
+def _parse_text(text, block_rows, num_columns=2, first_line=1):
+    """Parse the text of an input file into a table for read_input_arrays()
+
+    first_line is the line number of the first line of text, which is more
+    than 1 when a header has already been removed.
+    """
+    if text == "":
+        return _empty_table(num_columns)
+    num_lines = text.count("\n") + (not text.endswith("\n"))
+    table = _load_clean_rows(io.StringIO(text), num_lines, first_line,
+                             num_columns)
+    if table is not None:
+        return table
+    lines = text.split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    blocks = list()
+    for start in range(0, len(lines), block_rows):
+        blocks.append(_parse_table(lines[start:start + block_rows],
+                                   num_columns, first_line + start))
+    return tuple(np.concatenate(arrays) for arrays in zip(*blocks))
+
+
+def _is_header(line):
+    """Return True if none of the fields of a csv line are numbers"""
+    for field in line.split(","):
+        try:
+            float(field.strip(" "))
+        except ValueError:
+            continue
+        return False
+    return True
+
+
+def read_input_leads(filename, block_rows=65536):
+    """This function reads a multi-lead ECG file into a 2-D array
+
+    The first column of the file is time and every other column is the
+    voltage of one lead. If none of the fields on the first line are
+    numbers it is taken to be a header and the lead names are read from
+    it; otherwise the leads are named 'lead1', 'lead2' and so on. The rest
+    of the file is parsed the same way as read_input_arrays(), except that
+    a row is bad if it does not have a value for every column. The skipped
+    rows are logged once with log_bad_rows().
+
+    Args:
+        filename (str): the string of the filename to be opened
+        block_rows (int): number of lines parsed at a time if the file has
+            bad rows
+
+    Returns:
+        numpy.ndarray : float64 array of time values
+        numpy.ndarray : float64 array of voltages with a column per lead
+        list : the name of each lead
+    """
+    time, volts, names, bad_lines, bad_reasons = _read_leads(filename,
+                                                             block_rows)
+    log_bad_rows(filename, summarize_bad_rows(bad_lines, bad_reasons))
+    return time, volts, names
+
+
+def _read_leads(filename, block_rows=65536):
+    """Parse a multi-lead file for read_input_leads() without logging
+
+    The line numbers and reason codes of the bad rows are returned after
+    the time values, voltages and lead names.
+    """
+    with _stage('read') as stage:
+        with open(filename, 'r', errors='replace') as f:
+            text = f.read()
+        stage.count(characters=len(text))
+    with _stage('validate') as stage:
+        first, newline, rest = text.partition("\n")
+        num_columns = len(first.split(","))
+        if _is_header(first):
+            names = [name.strip(' "') for name in first.split(",")[1:]]
+            data, bad_lines, bad_reasons = _parse_text(rest, block_rows,
+                                                       num_columns, 2)
+        else:
+            names = ['lead{}'.format(i) for i in range(1, num_columns)]
+            data, bad_lines, bad_reasons = _parse_text(text, block_rows,
+                                                       num_columns)
+        stage.count(samples=data.shape[0], bad_rows=bad_lines.size)
+    time = np.ascontiguousarray(data[:, 0])
+    volts = np.ascontiguousarray(data[:, 1:])
+    return time, volts, names, bad_lines, bad_reasons
+
+
+def count_leads(filename):
+    """This function returns the number of leads in an ECG file
+
+    Only the first line is read. Whether it is a header or a row of data
+    it has a time column and a column per lead, so this tells multi-lead
+    files apart from single-lead ones without parsing them.
+
+    Args:
+        filename (str): the string of the filename to be opened
+
+    Returns:
+        int : the number of leads, at least 1
+    """
+    with open(filename, 'r', errors='replace') as f:
+        first = f.readline()
+    return max(len(first.split(",")) - 1, 1)
+
+
+def summarize_bad_rows(bad_lines, bad_reasons,
+                       max_lines=BAD_ROW_SAMPLE_LINES):
+    """This function sums up the bad rows that were skipped in a file
+
+    Args:
+        bad_lines (numpy.ndarray): line numbers of the skipped rows
+        bad_reasons (numpy.ndarray): reason codes of the skipped rows
+        max_lines (int): number of line numbers to keep
+
+    Returns:
+        dictionary : the total number of bad rows, the number for each
+        reason in BAD_ROW_REASONS and the first max_lines line numbers
+    """
+    counts = np.bincount(bad_reasons, minlength=len(BAD_ROW_REASONS))
+    return {"total": int(bad_lines.size),
+            "counts": {reason: int(count) for reason, count
+                       in zip(BAD_ROW_REASONS, counts)},
+            "first_lines": bad_lines[:max_lines].tolist()}
+
+
+def _merge_bad_rows(summary, bad_lines, bad_reasons,
+                    max_lines=BAD_ROW_SAMPLE_LINES):
+    """Add the bad rows of another chunk to a summarize_bad_rows() result"""
+    more = summarize_bad_rows(bad_lines, bad_reasons, max_lines)
+    summary["total"] += more["total"]
+    for reason in BAD_ROW_REASONS:
+        summary["counts"][reason] += more["counts"][reason]
+    missing = max_lines - len(summary["first_lines"])
+    summary["first_lines"].extend(more["first_lines"][:missing])
+    return summary
+
+
+def log_bad_rows(filename, summary):
+    """This function logs one error that sums up the bad rows of a file
+
+    Nothing is logged if the file had no bad rows.
+
+    Args:
+        filename (str): the name of the file that was read
+        summary (dict): the dictionary made by summarize_bad_rows()
+    """
+    if summary["total"] == 0:
+        return
+    logging.error("{}: {}".format(filename, _describe_bad_rows(summary)))
+
+
+def _describe_bad_rows(summary):
+    """Return the text log_bad_rows() logs for a summary of bad rows"""
+    counts = ", ".join("{}: {}".format(reason, summary["counts"][reason])
+                       for reason in BAD_ROW_REASONS)
+    lines = ", ".join(str(line) for line in summary["first_lines"])
+    return "skipped {} bad data points ({}); first bad lines: {}".format(
+        summary["total"], counts, lines)
+
+
 def read_input(filename):
     """This function reads the data from an input file
-    This function uses a with statement to open a file and a while loop to
-    go through the entire function. Each line is read, and the contents of
-    the line are cleaned and turned into time and voltage values where they
-    are then stored in the time and volt lists.
+
+    The file is parsed with read_input_arrays() and the arrays are
+    converted back into lists of floats. Rows that are missing a value, are
+    non-numeric or are NaN are skipped, and log_bad_rows() logs a single
+    error with the number of skipped rows for each reason and the first bad
+    line numbers.
 
     Args:
         filename (str): the string of the filename to be opened
@@ -412,38 +2446,1011 @@ def read_input(filename):
         list : a list of time values
         list : a list of voltages
     """
-    time = list()
-    volt = list()
-    with open(filename, 'r') as f:
-        temp_line = f.readline()
-        while temp_line != "":
-            temp_time, temp_volt = split_data(temp_line)
-            temp_check = check_data(temp_time, temp_volt)
-            log_if_bad_data(temp_check)
-            if temp_check is True:
-                time.append(float(temp_time))
-                volt.append(float(temp_volt))
-            temp_line = f.readline()
+    time, volt, bad_lines, bad_reasons = read_input_arrays(filename)
+    log_bad_rows(filename, summarize_bad_rows(bad_lines, bad_reasons))
+    time = time.tolist()
+    volt = volt.tolist()
     log_if_data_too_high(volt)
     return time, volt
 
 
-def interface():
+def _sniff_ranges(size, sample_bytes, strides, seed):
+    """Return the merged (start, stop) byte ranges sniff_file() reads"""
+    if size <= (strides + 2) * sample_bytes:
+        return [(0, size)]
+    rng = np.random.default_rng(seed)
+    starts = rng.integers(sample_bytes, size - 2 * sample_bytes, strides)
+    starts = sorted([0, size - sample_bytes] + starts.tolist())
+    ranges = [[starts[0], starts[0] + sample_bytes]]
+    for start in starts[1:]:
+        if start <= ranges[-1][1]:
+            ranges[-1][1] = max(ranges[-1][1], start + sample_bytes)
+        else:
+            ranges.append([start, start + sample_bytes])
+    return [tuple(byte_range) for byte_range in ranges]
+
+
+def _sniff_lines(data, start, stop, size):
+    """Return the whole lines of data[start:stop] and the bytes they take
+
+    A line cut by the start or stop of the range is left out.
+    """
+    chunk = data[start:stop]
+    if start > 0:
+        chunk = chunk[chunk.find(b"\n") + 1:]
+    if stop < size:
+        chunk = chunk[:chunk.rfind(b"\n") + 1]
+    lines = chunk.decode('utf-8', errors='replace').split("\n")
+    if lines[-1] == '':
+        lines.pop()
+    return [line.rstrip("\r") for line in lines], len(chunk)
+
+
+def sniff_file(filename, sample_bytes=SNIFF_BYTES, strides=SNIFF_STRIDES,
+               seed=0):
+    """This function checks a csv file quickly without parsing all of it
+
+    The file is opened with mmap and only the first and last sample_bytes
+    and strides more blocks of sample_bytes at random places are read, so
+    a file of any size is checked in a few milliseconds. A file no larger
+    than all of the blocks is read whole. The whole lines in each block are
+    parsed the same way as read_input_leads(), with the number of columns
+    and any header taken from the first line. The file is then classified
+    by its worst problem into one of SNIFF_STATUSES:
+
+    * 'unusable': the file is empty, is not text, has only one column or
+      has fewer than two usable rows in the blocks read
+    * 'suspicious': more than SNIFF_BAD_FRACTION of the rows read are bad,
+      time does not always increase, the voltage is outside +/- 300 mV or
+      the sample rate at the end of the file is not the one at the start
+    * 'ok': none of the above were found
+
+    Because only part of the file is read, a problem that is not in any
+    of the blocks is not found, so 'ok' does not guarantee the full parse
+    will find nothing. The number of rows is estimated from the size of
+    the file and the mean length of the lines read, and the sample rate
+    by estimate_sample_rate() on the first block.
+
+    Args:
+        filename (str): the string of the filename to be opened
+        sample_bytes (int): number of bytes in each block read
+        strides (int): number of blocks read at random places
+        seed (int): seed of the random places, so a file is always read
+            at the same places
+
+    Returns:
+        dictionary : the "status", a list of the "issues" found, the
+        estimated number of "rows", "sample_rate" and "duration", the
+        number of "columns", whether there is a "header", the number of
+        rows read as "sampled_rows" and how many were "bad_rows", the
+        "voltage_range" of the rows read and the "seconds" taken
+    """
+    start_time = perf_counter()
+    report = {"status": 'ok', "issues": list(), "rows": 0,
+              "sample_rate": None, "duration": None, "columns": 0,
+              "header": False, "sampled_rows": 0, "bad_rows": 0,
+              "voltage_range": None, "seconds": 0.0}
+
+    def finish(status, issue=None):
+        if issue is not None:
+            report["issues"].append(issue)
+        if SNIFF_STATUSES.index(status) > SNIFF_STATUSES.index(
+                report["status"]):
+            report["status"] = status
+        report["seconds"] = perf_counter() - start_time
+        return report
+
+    size = os.path.getsize(filename)
+    if size == 0:
+        return finish('unusable', "the file is empty")
+    with _stage('sniff') as stage, open(filename, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        blocks = list()
+        num_bytes = 0
+        for start, stop in _sniff_ranges(size, sample_bytes, strides, seed):
+            if b"\0" in data[start:stop]:
+                return finish('unusable', "the file is not text")
+            lines, block_bytes = _sniff_lines(data, start, stop, size)
+            blocks.append(lines)
+            num_bytes += block_bytes
+        stage.count(characters=num_bytes)
+    if not blocks[0]:
+        return finish('unusable', "the file has no complete lines")
+    num_lines = sum(len(lines) for lines in blocks)
+    report["rows"] = int(round(size * num_lines / max(num_bytes, 1)))
+    first = blocks[0][0]
+    report["columns"] = num_columns = len(first.split(","))
+    if _is_header(first):
+        report["header"] = True
+        report["rows"] -= 1
+        blocks[0] = blocks[0][1:]
+    if num_columns < 2:
+        return finish('unusable', "the file has only one column")
+    tables = list()
+    for lines in blocks:
+        table, bad_lines, bad_reasons = _parse_table(lines, num_columns, 1)
+        tables.append(table)
+        report["sampled_rows"] += len(lines)
+        report["bad_rows"] += bad_lines.size
+    good = [table for table in tables if len(table)]
+    num_good = sum(len(table) for table in good)
+    if num_good < 2:
+        return finish('unusable', "fewer than two of the {} rows read are "
+                      "usable".format(report["sampled_rows"]))
+    if report["bad_rows"] > SNIFF_BAD_FRACTION * report["sampled_rows"]:
+        finish('suspicious', "{} of the {} rows read are bad".format(
+            report["bad_rows"], report["sampled_rows"]))
+    volts = np.concatenate([table[:, 1:].ravel() for table in good])
+    report["voltage_range"] = (float(volts.min()), float(volts.max()))
+    if volts.max() > 300 or volts.min() < -300:
+        finish('suspicious', "voltages are outside the normal operating "
+               "range of +/- 300 mV")
+    starts = [table[0, 0] for table in good]
+    if (any(np.any(np.diff(table[:, 0]) <= 0) for table in good) or
+            np.any(np.diff(starts) <= 0)):
+        finish('suspicious', "time does not always increase")
+    try:
+        if len(good[0]) > 1:
+            report["sample_rate"] = estimate_sample_rate(good[0][:, 0])
+            report["duration"] = float(good[-1][-1, 0] - good[0][0, 0])
+        end_rate = None
+        if len(good) > 1 and len(good[-1]) > 1 and report["sample_rate"]:
+            end_rate = estimate_sample_rate(good[-1][:, 0])
+    except ValueError as error:
+        return finish('unusable', str(error))
+    if end_rate is not None:
+        if abs(end_rate / report["sample_rate"] - 1) > 0.01:
+            finish('suspicious', "the sample rate changes from {:g} Hz to "
+                   "{:g} Hz".format(report["sample_rate"], end_rate))
+    return finish(report["status"])
+
+
+def _cache_key(filename):
+    """Return the cache key of a file from its path, size and mtime"""
+    stat = os.stat(filename)
+    text = "{}|{}|{}".format(os.path.abspath(filename), stat.st_size,
+                             stat.st_mtime_ns)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def _cache_paths(cache_dir, key):
+    """Return the .npy filenames of one cache entry"""
+    return [os.path.join(cache_dir, "{}.{}.npy".format(key, name))
+            for name in CACHE_ARRAYS]
+
+
+def evict_cache(cache_dir, max_bytes=DEFAULT_CACHE_BYTES):
+    """This function removes the least recently used cache entries
+
+    Each entry is made of the .npy files that share a key. The entry's last
+    use is the newest modification time of its files, which
+    read_input_cached() updates on every hit. Entries are removed oldest
+    first until the files in cache_dir take up no more than max_bytes.
+
+    Args:
+        cache_dir (str): the cache directory
+        max_bytes (int): the size budget of the cache in bytes
+
+    Returns:
+        list : the keys of the entries that were removed
+    """
+    entries = dict()
+    for path in glob.glob(os.path.join(cache_dir, "*.npy")):
+        key = os.path.basename(path).split(".")[0]
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        size, last_used = entries.get(key, (0, 0))
+        entries[key] = (size + stat.st_size, max(last_used, stat.st_mtime))
+    total = sum(size for size, last_used in entries.values())
+    removed = list()
+    for key in sorted(entries, key=lambda key: entries[key][1]):
+        if total <= max_bytes:
+            break
+        for path in _cache_paths(cache_dir, key):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        total -= entries[key][0]
+        removed.append(key)
+    return removed
+
+
+def read_input_cached(filename, cache_dir=None,
+                      max_bytes=DEFAULT_CACHE_BYTES):
+    """This function reads an input file through a cache of parsed arrays
+
+    The arrays returned by read_input_arrays() are saved as .npy files in
+    cache_dir, keyed by the path, size and modification time of the csv
+    file, so an edited file is parsed again. When the file is read again
+    the arrays are loaded with numpy.load(mmap_mode='r'), which maps the
+    files into memory instead of copying them. Files are written to a
+    temporary name and renamed, so a half-written entry is never read.
+    After a new entry is written, evict_cache() keeps the cache within
+    max_bytes.
+
+    Args:
+        filename (str): the string of the filename to be opened
+        cache_dir (str): the cache directory, None uses a '.ecg_cache'
+        directory next to the csv file
+        max_bytes (int): the size budget of the cache in bytes
+
+    Returns:
+        numpy.ndarray : float64 array of time values
+        numpy.ndarray : float64 array of voltages
+        numpy.ndarray : line numbers (starting at 1) of the skipped rows
+        numpy.ndarray : reason codes of the skipped rows, see parse_rows()
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(filename)),
+                                 ".ecg_cache")
+    key = _cache_key(filename)
+    paths = _cache_paths(cache_dir, key)
+    if all(os.path.exists(path) for path in paths):
+        try:
+            arrays = tuple(np.load(path, mmap_mode='r') for path in paths)
+            for path in paths:
+                os.utime(path)
+            return arrays
+        except (OSError, ValueError):
+            logging.warning('Cache entry for {} could not be read'
+                            .format(filename))
+    arrays = read_input_arrays(filename)
+    os.makedirs(cache_dir, exist_ok=True)
+    for path, array in zip(paths, arrays):
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+    evict_cache(cache_dir, max_bytes)
+    return arrays
+
+
+class IncrementalBeatDetector:
+    """This class finds heart beats in ECG data that arrives a block at a time
+
+    Blocks of samples are given to push(). The samples are filtered with the
+    same band-pass filter as filter_data(), but only over a window that
+    keeps lookahead seconds of already-filtered samples on the left and
+    holds back the newest lookahead seconds, whose filtered values still
+    depend on samples that have not arrived. Samples leave the window once
+    they are final, so each push costs the same no matter how long the
+    recording has been running. A sample is part of a beat if it is greater
+    than half of the largest filtered voltage seen so far, including the
+    held back samples. The above-threshold times are grouped like
+    group_similar_values() and a beat is reported as soon as its group can
+    no longer grow. The mean heart rate is kept up to date from running sums
+    of the heart rates between beats.
+
+    Because the threshold only knows about the data seen so far, the beats
+    found before the largest filtered voltage of the recording arrives can
+    differ from calc_metrics(); the beats after it are the same. If the
+    size of the beats is known ahead of time, for example from an earlier
+    recording of the same patient, it can be given as initial_maximum so
+    the threshold starts out at half of it. Giving the largest value of
+    filter_data() over the whole recording makes the beats the same as
+    calc_metrics().
+
+    Attributes:
+        sample_rate (float): samples per second, estimated with
+        estimate_sample_rate() from the first times pushed if not given
+        lookahead (float): seconds of data held back before a sample is
+        filtered for the last time
+        band (tuple): (low, high) cutoff frequencies of the filter in Hz
+        order (int): the order of the filter
+        beats (list): time values of all the beats found so far
+        initial_maximum (float): largest filtered voltage assumed before
+        any data arrives, None to start from the data alone
+    """
+
+    def __init__(self, sample_rate=None, lookahead=2.0, band=FILTER_BAND,
+                 order=FILTER_ORDER, initial_maximum=None):
+        self.sample_rate = sample_rate
+        self.lookahead = lookahead
+        self.band = tuple(band)
+        self.order = order
+        self.beats = list()
+        self._filter = None
+        self._time = np.empty(0, dtype=np.float64)
+        self._volt = np.empty(0, dtype=np.float64)
+        self._num_done = 0
+        self.initial_maximum = initial_maximum
+        self._maximum = (-np.inf if initial_maximum is None
+                         else float(initial_maximum))
+        self._pending = np.empty(0, dtype=np.float64)
+        self._hr_sum = 0.0
+        self._hr_count = 0
+
+    @property
+    def num_beats(self):
+        """int: the number of beats found so far"""
+        return len(self.beats)
+
+    @property
+    def mean_hr_bpm(self):
+        """float: the mean heart rate of the beats found so far"""
+        if self._hr_count == 0:
+            return np.nan
+        return self._hr_sum / self._hr_count
+
+    def _setup(self):
+        """Design the filter once the sample rate is known"""
+        if self.sample_rate is None:
+            self.sample_rate = estimate_sample_rate(self._time)
+        b, a = filter_coefficients(self.sample_rate, self.band, self.order)
+        self._filter = (b, a)
+        self._margin = max(int(round(self.lookahead * self.sample_rate)),
+                           3 * max(len(a), len(b)))
+
+    def _add_beats(self, beats):
+        """Store new beats and update the running heart rate"""
+        for beat in beats.tolist():
+            if len(self.beats) > 0:
+                self._hr_sum += (1 / (beat - self.beats[-1])) * 60
+                self._hr_count += 1
+            self.beats.append(beat)
+
+    def _detect(self, final):
+        """Filter the window and threshold the samples that are final"""
+        from scipy.signal import filtfilt
+        b, a = self._filter
+        if final:
+            stop = self._time.size
+        else:
+            stop = self._time.size - self._margin
+        padlen = 3 * max(len(a), len(b))
+        if stop <= self._num_done or self._time.size <= padlen:
+            return np.empty(0, dtype=np.float64)
+        filtered = filtfilt(b, a, self._volt)
+        self._maximum = max(self._maximum, filtered[self._num_done:].max())
+        done = slice(self._num_done, stop)
+        threshold = self._maximum * BEAT_THRESHOLD
+        above = self._time[done][filtered[done] > threshold]
+        beat_times = np.concatenate((self._pending, above))
+        new_beats = list()
+        if beat_times.size > 0:
+            starts = np.flatnonzero(np.diff(beat_times) > BEAT_GAP) + 1
+            if starts.size > 0:
+                new_beats.append(_group_similar_times(
+                    beat_times[:starts[-1]]))
+                beat_times = beat_times[starts[-1]:]
+            if final or self._time[stop - 1] - beat_times[-1] > BEAT_GAP:
+                new_beats.append(_group_similar_times(beat_times))
+                beat_times = beat_times[:0]
+        self._pending = beat_times
+        keep = max(stop - self._margin, 0)
+        self._time = self._time[keep:]
+        self._volt = self._volt[keep:]
+        self._num_done = stop - keep
+        if len(new_beats) == 0:
+            return np.empty(0, dtype=np.float64)
+        new_beats = np.concatenate(new_beats)
+        self._add_beats(new_beats)
+        return new_beats
+
+    def push(self, time, volt):
+        """This function adds a block of samples and returns any new beats
+
+        Args:
+            time (list): time values of the new samples
+            volt (list): ECG voltages of the new samples
+
+        Returns:
+            numpy.ndarray : times of the beats that were completed
+            float : the mean heart rate of all beats found so far
+        """
+        time = np.asarray(time, dtype=np.float64)
+        volt = np.asarray(volt, dtype=np.float64)
+        self._time = np.concatenate((self._time, time))
+        self._volt = np.concatenate((self._volt, volt))
+        if self._filter is None:
+            if self._time.size < 2:
+                return np.empty(0, dtype=np.float64), self.mean_hr_bpm
+            self._setup()
+        return self._detect(final=False), self.mean_hr_bpm
+
+    def flush(self):
+        """This function finishes the samples that are still held back
+
+        This is called when the feed ends so that the last lookahead seconds
+        of data are also searched for beats.
+
+        Returns:
+            numpy.ndarray : times of the beats that were completed
+            float : the mean heart rate of all beats found
+        """
+        if self._filter is None:
+            return np.empty(0, dtype=np.float64), self.mean_hr_bpm
+        return self._detect(final=True), self.mean_hr_bpm
+
+
+def iter_input_chunks(filename, chunk_rows=65536):
+    """This function reads an input file a fixed number of lines at a time
+
+    Each block of chunk_rows lines is parsed by parse_rows(), so only one
+    block of the file is held in memory at a time.
+
+    Args:
+        filename (str): the string of the filename to be opened
+        chunk_rows (int): number of lines in each chunk
+
+    Yields:
+        tuple : (time, volt, bad_lines, bad_reasons) arrays for each chunk,
+        with line numbers counted from the start of the file
+    """
+    first_line = 1
+    with open(filename, 'r', errors='replace') as f:
+        while True:
+            lines = list(itertools.islice(f, chunk_rows))
+            if len(lines) == 0:
+                return
+            lines = [line.rstrip("\n") for line in lines]
+            yield parse_rows(lines, first_line)
+            first_line += len(lines)
+
+
+def _spill_input(filename, chunk_rows, time_file, volt_file):
+    """Parse the input file in chunks and append the values to raw files
+
+    Returns the number of samples, the summary of the bad rows and the raw
+    voltage extremes.
+    """
+    num_samples = 0
+    bad_rows = summarize_bad_rows(*_empty_rows()[2:])
+    minimum = np.inf
+    maximum = -np.inf
+    for time, volt, bad_lines, bad_reasons in iter_input_chunks(filename,
+                                                                chunk_rows):
+        time.tofile(time_file)
+        volt.tofile(volt_file)
+        num_samples += time.size
+        bad_rows = _merge_bad_rows(bad_rows, bad_lines, bad_reasons)
+        if volt.size > 0:
+            minimum = min(minimum, volt.min())
+            maximum = max(maximum, volt.max())
+    return num_samples, bad_rows, minimum, maximum
+
+
+def _filtfilt_chunked(b, a, raw_volt, out, chunk_rows):
+    """Run the same forward-backward filter as scipy's filtfilt in chunks
+
+    The signal is extended at both ends with the odd extension filtfilt
+    uses and is filtered forwards into out chunk by chunk, carrying the
+    filter state across chunk boundaries. out is then filtered backwards in
+    place, again carrying the state, so the result matches filtfilt exactly
+    while only one chunk is held in memory. out must have room for the
+    extension at both ends.
+    """
+    from scipy.signal import lfilter, lfilter_zi
+    edge = 3 * max(len(a), len(b))
+    num_samples = raw_volt.size
+    if num_samples <= edge:
+        raise ValueError("The length of the input vector x must be greater "
+                         "than padlen, which is {}.".format(edge))
+    left = 2 * raw_volt[0] - raw_volt[edge:0:-1]
+    right = 2 * raw_volt[-1] - raw_volt[-2:-(edge + 2):-1]
+    zi = lfilter_zi(b, a)
+    state = zi * left[0]
+    out[:edge], state = lfilter(b, a, left, zi=state)
+    for start in range(0, num_samples, chunk_rows):
+        stop = min(start + chunk_rows, num_samples)
+        out[edge + start:edge + stop], state = lfilter(
+            b, a, raw_volt[start:stop], zi=state)
+    out[edge + num_samples:], state = lfilter(b, a, right, zi=state)
+    state = zi * out[-1]
+    for stop in range(out.size, 0, -chunk_rows):
+        start = max(stop - chunk_rows, 0)
+        backward, state = lfilter(b, a, out[start:stop][::-1], zi=state)
+        out[start:stop] = backward[::-1]
+    return out[edge:edge + num_samples]
+
+
+def _stream_beats(time, volt, threshold, chunk_rows):
+    """Find the beat times chunk by chunk
+
+    The above-threshold times of the last group in each chunk are carried
+    into the next chunk, so a beat that is split across two chunks is still
+    found as one group.
+    """
+    beats = list()
+    pending = np.empty(0, dtype=np.float64)
+    for start in range(0, volt.size, chunk_rows):
+        stop = start + chunk_rows
+        beat_index = np.flatnonzero(volt[start:stop] > threshold)
+        beat_times = np.concatenate((pending, time[start:stop][beat_index]))
+        if beat_times.size == 0:
+            continue
+        starts = np.flatnonzero(np.diff(beat_times) > BEAT_GAP) + 1
+        if starts.size > 0:
+            beats.append(_group_similar_times(beat_times[:starts[-1]]))
+            beat_times = beat_times[starts[-1]:]
+        pending = beat_times
+    beats.append(_group_similar_times(pending))
+    return np.concatenate(beats)
+
+
+def stream_metrics(filename, chunk_rows=65536, workdir=None,
+                   band=FILTER_BAND, order=FILTER_ORDER, hrv_window=None,
+                   hrv_step=HRV_STEP):
+    """This function calculates the ECG metrics without loading the whole
+    file into memory
+
+    The file is parsed chunk_rows lines at a time and the time and voltage
+    values are written to temporary binary files that are read back with
+    numpy.memmap. The voltages are filtered with the same band-pass filter
+    as filter_data() one chunk at a time, carrying the filter state across
+    chunk boundaries. Because the beat threshold is half of the maximum
+    filtered voltage, the extremes are found in one pass and the beats in a
+    second pass. The duration, voltage extremes, number of beats, mean
+    heart rate, beats and gaps are the same as calc_metrics() gives for the
+    file, and so are the windowed heart rate variability metrics if
+    hrv_window is given.
+
+    Args:
+        filename (str): the string of the filename to be opened
+        chunk_rows (int): number of samples held in memory at a time
+        workdir (str): directory for the temporary files, None uses the
+        system default
+        band (tuple): (low, high) cutoff frequencies of the filter in Hz
+        order (int): the order of the filter
+        hrv_window (float): length in seconds of the heart rate variability
+            windows, or None to leave them out
+        hrv_step (float): seconds between the starts of the windows
+
+    Returns:
+        dictionary : dictionary containing ecg metrics
+    """
+    logging.info('Beginning streaming analysis of {}'.format(filename))
+    with tempfile.TemporaryDirectory(dir=workdir) as tmp:
+        time_name = os.path.join(tmp, "time.f8")
+        volt_name = os.path.join(tmp, "volt.f8")
+        filt_name = os.path.join(tmp, "filtered.f8")
+        with _stage('validate') as stage, \
+                open(time_name, 'wb') as time_file, \
+                open(volt_name, 'wb') as volt_file:
+            num_samples, bad_rows, minimum, maximum = _spill_input(
+                filename, chunk_rows, time_file, volt_file)
+            stage.count(samples=num_samples, bad_rows=bad_rows["total"])
+        log_bad_rows(filename, bad_rows)
+        if maximum > 300 or minimum < -300:
+            logging.warning("This file contains a value outside the "
+                            "normal operating range of +/- 300 mV.")
+        if num_samples < 2:
+            raise ValueError("{} has fewer than two data points"
+                             .format(filename))
+        time = np.memmap(time_name, dtype=np.float64, mode='r')
+        raw_volt = np.memmap(volt_name, dtype=np.float64, mode='r')
+        logging.info('Filtering Data')
+        with _stage('filter') as stage:
+            sample_rate = estimate_sample_rate(time)
+            b, a = filter_coefficients(sample_rate, tuple(band), order)
+            edge = 3 * max(len(a), len(b))
+            out = np.memmap(filt_name, dtype=np.float64, mode='w+',
+                            shape=(num_samples + 2 * edge,))
+            volt = _filtfilt_chunked(b, a, raw_volt, out, chunk_rows)
+            stage.count(samples=num_samples)
+        gaps = np.concatenate(
+            [find_gaps(time[start:start + chunk_rows + 1], sample_rate)
+             for start in range(0, num_samples - 1, chunk_rows)])
+        with _stage('detect') as stage:
+            minimum = np.inf
+            maximum = -np.inf
+            for start in range(0, num_samples, chunk_rows):
+                minimum = min(minimum, volt[start:start + chunk_rows].min())
+                maximum = max(maximum, volt[start:start + chunk_rows].max())
+            beats = _stream_beats(time, volt, maximum * BEAT_THRESHOLD,
+                                  chunk_rows)
+            stage.count(samples=num_samples, beats=beats.size)
+        duration = calc_duration(time)
+        first_time = time[0]
+        last_time = time[-1]
+        del time, raw_volt, volt, out
+    with _stage('aggregate') as stage:
+        detection = BeatDetection(beats.tolist(), np.diff(beats),
+                                  (minimum, maximum))
+        hrv = None
+        if hrv_window is not None:
+            hrv = calc_hrv(beats, hrv_window, hrv_step, first_time,
+                           last_time)
+        metrics = make_dictionary(duration, detection.voltage_extremes,
+                                  detection.num_beats, detection.mean_hr_bpm,
+                                  detection.beats, hrv,
+                                  gaps.tolist() if len(gaps) else None)
+        stage.count(beats=detection.num_beats)
+    return metrics
+
+
+def interface(plot='interactive', hrv_window=None, hrv_step=HRV_STEP):
     """This function calls the functions that read the data and write json
     files
 
     This funcion is called when the module is ran. It requests that the
     user type in the filename that stores the ECG data. This function
-    then calls the function read_input() that reads the data inside the
-    given filename and creates a dictionary of ECG metrics. This dictionary
-    of metrics is then sent to the function output_file() which creates the
-    json to store the data.
+    then calls Recording.from_file(), or read_input_leads() for a file with
+    more than one lead, to read the data inside the given filename and
+    calc_metrics() to create a dictionary of ECG metrics. This
+    dictionary of metrics is then sent to the function output_file() which
+    creates the json to store the data.
+
+    Args:
+        plot (str): one of 'none', 'png' or 'interactive'
+        hrv_window (float): length in seconds of the heart rate variability
+            windows, or None to leave "hrv" out of the metrics
+        hrv_step (float): seconds between the starts of the windows
     """
     filename = input("Please enter the filename: ")
-    ecg_time, ecg_volt = read_input(filename)
-    metrics = calc_metrics(ecg_time, ecg_volt, filename)
+    metrics = file_metrics(filename, plot, hrv_window=hrv_window,
+                           hrv_step=hrv_step)
     output_file(metrics, filename)
 
 
+def file_metrics(filename, plot='none', engine=DEFAULT_ENGINE, name=None,
+                 band=FILTER_BAND, order=FILTER_ORDER, hrv_window=None,
+                 hrv_step=HRV_STEP):
+    """This function reads a file and calculates its metrics, one lead or
+    many
+
+    A file with more than one lead according to count_leads() is read like
+    read_input_leads() and its metrics have a dictionary for each lead.
+    Any other file is read with Recording.from_file(). The skipped rows are
+    logged by log_bad_rows() in both cases, and a file without enough good
+    rows to analyze is reported with a ValueError that sums them up
+    instead of failing somewhere inside calc_metrics(). The windowed heart
+    rate variability is only calculated for single-lead files.
+
+    Args:
+        filename (str): the string of the filename to be opened
+        plot (str): one of 'none', 'png' or 'interactive'
+        engine (str): the name of the beat detector in DETECTORS
+        name (str): the name of the recording in the metrics and plots, by
+            default filename
+        band (tuple): (low, high) cutoff frequencies of the filter in Hz
+        order (int): the order of the filter
+        hrv_window (float): length in seconds of the heart rate variability
+            windows, or None to leave "hrv" out of the metrics
+        hrv_step (float): seconds between the starts of the windows
+
+    Returns:
+        dictionary : dictionary containing ecg metrics
+
+    Raises:
+        ValueError: if the file has fewer than two good data points
+    """
+    name = name or filename
+    if count_leads(filename) > 1:
+        time, volt, names, bad_lines, bad_reasons = _read_leads(filename)
+        bad_rows = summarize_bad_rows(bad_lines, bad_reasons)
+        log_bad_rows(filename, bad_rows)
+        log_if_data_too_high(volt)
+    else:
+        recording = Recording.from_file(filename)
+        time, volt, names = recording, None, None
+        bad_rows = recording.metadata["bad_rows"]
+    if len(time) < 2:
+        message = "{} has fewer than two good data points".format(name)
+        if bad_rows["total"]:
+            message += "; " + _describe_bad_rows(bad_rows)
+        raise ValueError(message)
+    return calc_metrics(time, volt, name, plot=plot, band=band, order=order,
+                        names=names, hrv_window=hrv_window,
+                        hrv_step=hrv_step, engine=engine)
+
+
+def analyze_file(filename, plot='none', policy='overwrite', write=True,
+                 engine=DEFAULT_ENGINE, store=None, hrv_window=None,
+                 hrv_step=HRV_STEP):
+    """This function runs the whole analysis for one input file
+
+    The data is read with Recording.from_file(), which keeps it in numpy
+    arrays instead of lists, or with read_input_leads() if count_leads()
+    finds more than one lead, the metrics are calculated with
+    calc_metrics() and the json output file is written with output_file()
+    using the output policy. With the 'skip' policy a file whose json
+    output already exists is not analyzed at all. If write is False no json
+    file is written and the metrics are only returned. This is the work
+    done for each file in batch mode.
+
+    If a ResultsStore is given the file is hashed and its metrics are
+    looked up in the store before anything else. If they are found the
+    file is not parsed or plotted and its json output file is only written
+    if it does not exist yet, whatever the policy, because an existing one
+    already holds these metrics. Otherwise the metrics are calculated and
+    added to the store.
+
+    Args:
+        filename (str): the string of the filename to be opened
+        plot (str): one of 'none', 'png' or 'interactive'
+        policy (str): one of 'overwrite', 'skip' or 'error'
+        write (bool): write the json output file
+        engine (str): the name of the beat detector in DETECTORS
+        store (ResultsStore): the store to look the metrics up in, or None
+        hrv_window (float): length in seconds of the heart rate variability
+            windows, or None to leave "hrv" out of the metrics
+        hrv_step (float): seconds between the starts of the windows
+
+    Returns:
+        dictionary : dictionary containing ecg metrics, or None if the
+        file was skipped
+    """
+    if store is not None:
+        params = analysis_params(engine=engine, hrv_window=hrv_window,
+                                 hrv_step=hrv_step)
+        digest = file_digest(filename)
+        key = results_key(digest, params)
+        metrics = store.get(key)
+        if metrics is not None:
+            if write:
+                _write_stored(filename, metrics, None, policy)
+            return metrics
+    if write and _check_policy(policy, output_filename(filename)):
+        return None
+    metrics = file_metrics(filename, plot, engine, hrv_window=hrv_window,
+                           hrv_step=hrv_step)
+    if write:
+        output_file(metrics, filename, policy)
+    if store is not None:
+        store.put(key, digest, params, filename, metrics)
+    return metrics
+
+
+def _sniff_usable(filename, failures):
+    """Check a file with sniff_file() before it is sent to a worker
+
+    An unusable file, or one that cannot be read, is logged and added to
+    failures. Returns True if the file should still be analyzed.
+    """
+    try:
+        report = sniff_file(filename)
+    except Exception as error:
+        report = {"status": 'unusable', "issues": [repr(error)]}
+    issues = "; ".join(report["issues"])
+    if report["status"] == 'unusable':
+        logging.error('{} is unusable: {}'.format(filename, issues))
+        failures.append((filename, "unusable: " + issues))
+        return False
+    if report["status"] == 'suspicious':
+        logging.warning('{} is suspicious: {}'.format(filename, issues))
+    return True
+
+
+def _write_stored(filename, metrics, writer, policy):
+    """Write the metrics of a file found in the ResultsStore
+
+    The metrics go to the NDJSON writer if there is one. Otherwise the
+    json output file is only written if it does not exist yet, because an
+    existing one already holds these metrics.
+    """
+    if writer is not None:
+        writer.write(filename, metrics)
+    elif not os.path.exists(output_filename(filename)):
+        output_file(metrics, filename, policy)
+
+
+def find_input_files(target):
+    """This function returns the csv files to analyze in batch mode
+
+    If target is a directory, every '.csv' file directly inside it is
+    returned. Otherwise target is treated as a glob pattern such as
+    'recordings/*.csv'.
+
+    Args:
+        target (str): a directory or a glob pattern
+
+    Returns:
+        list : sorted list of filenames
+    """
+    if os.path.isdir(target):
+        target = os.path.join(target, "*.csv")
+    return sorted(glob.glob(target))
+
+
+def batch_analysis(target, workers=None, plot='none', results=None,
+                   policy='overwrite', engine=DEFAULT_ENGINE, store=None,
+                   sniff=False, hrv_window=None, hrv_step=HRV_STEP):
+    """This function analyzes many ECG files using a pool of processes
+
+    Each file found by find_input_files() is sent to analyze_file() in a
+    concurrent.futures.ProcessPoolExecutor. A file that raises an error is
+    logged and recorded as a failure and the rest of the files are still
+    analyzed. When all files are done a summary report is logged and
+    returned. Plots can only be skipped or saved as png files in batch mode.
+
+    By default a json file is written next to each csv file using the
+    output policy. If results is given the metrics are instead sent back
+    from the workers and written as they finish to that one NDJSON file by
+    a ResultsWriter, with the policy applied to the NDJSON file.
+
+    If store is given it is the name of a ResultsStore database. Every file
+    is hashed and looked up in it first, and only the files whose metrics
+    are not there are sent to the workers, so a nightly run over files that
+    have mostly not changed only analyzes the changed ones. The metrics of
+    the files that were found are written to the NDJSON file, or to a json
+    file if there is none yet, without being plotted, and the metrics of
+    the analyzed files are added to the store.
+
+    If sniff is True every file is first checked by sniff_file(). A file
+    that is unusable is recorded as a failure without being parsed and a
+    suspicious one is logged as a warning and still analyzed.
+
+    Args:
+        target (str): a directory or a glob pattern of csv files
+        workers (int): number of worker processes, None uses one per CPU
+        plot (str): either 'none' or 'png'
+        results (str): name of an NDJSON file for all of the metrics
+        policy (str): one of 'overwrite', 'skip' or 'error'
+        engine (str): the name of the beat detector in DETECTORS
+        store (str): name of a ResultsStore database, or None
+        sniff (bool): check every file with sniff_file() first
+        hrv_window (float): length in seconds of the heart rate variability
+            windows, or None to leave "hrv" out of the metrics
+        hrv_step (float): seconds between the starts of the windows
+
+    Returns:
+        dictionary : the number of files, successes, skipped files, files
+        found in the store and failures, the failed filenames with their
+        errors, the elapsed seconds and the number of files analyzed per
+        second
+    """
+    if plot not in ('none', 'png'):
+        raise ValueError("batch plots must be 'none' or 'png'")
+    filenames = find_input_files(target)
+    num_files = len(filenames)
+    logging.info('Starting batch analysis of {} files'.format(num_files))
+    failures = list()
+    skipped = 0
+    cached = 0
+    start = perf_counter()
+    writer = None
+    params = analysis_params(engine=engine, hrv_window=hrv_window,
+                             hrv_step=hrv_step)
+    if results is not None:
+        writer = ResultsWriter(results, policy)
+        if writer.skipped:
+            skipped = num_files
+            filenames = list()
+    initargs = _log_config if _log_config is not None else ()
+    initializer = _init_worker_logging if _log_config is not None else None
+    results_store = ResultsStore(store) if store is not None else None
+    finished = False
+    try:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=initializer,
+                                 initargs=initargs) as pool:
+            futures = dict()
+            for filename in filenames:
+                key = digest = None
+                if sniff and not _sniff_usable(filename, failures):
+                    continue
+                if results_store is not None:
+                    try:
+                        digest = file_digest(filename)
+                        key = results_key(digest, params)
+                        metrics = results_store.get(key)
+                        if metrics is not None:
+                            _write_stored(filename, metrics, writer, policy)
+                            cached += 1
+                            continue
+                    except Exception as error:
+                        logging.error('Analysis of {} failed: {!r}'.format(
+                            filename, error))
+                        failures.append((filename, repr(error)))
+                        continue
+                future = pool.submit(analyze_file, filename, plot, policy,
+                                     writer is None, engine, None,
+                                     hrv_window, hrv_step)
+                futures[future] = (filename, key, digest)
+            for future in as_completed(futures):
+                filename, key, digest = futures[future]
+                try:
+                    metrics = future.result()
+                except Exception as error:
+                    logging.error('Analysis of {} failed: {!r}'.format(
+                        filename, error))
+                    failures.append((filename, repr(error)))
+                    continue
+                if metrics is None:
+                    skipped += 1
+                    continue
+                if writer is not None:
+                    writer.write(filename, metrics)
+                if results_store is not None:
+                    results_store.put(key, digest, params, filename, metrics)
+        finished = True
+    finally:
+        if writer is not None:
+            writer.close(commit=finished)
+        if results_store is not None:
+            results_store.close()
+    elapsed = perf_counter() - start
+    failures.sort()
+    report = {"files": num_files,
+              "succeeded": num_files - len(failures) - skipped,
+              "skipped": skipped,
+              "cached": cached,
+              "failed": len(failures),
+              "failures": failures,
+              "seconds": elapsed,
+              "files_per_second": num_files / elapsed}
+    logging.info('Batch analysis finished: {files} files, {succeeded} '
+                 'succeeded, {skipped} skipped, {cached} found in the '
+                 'results store, {failed} failed, '
+                 '{files_per_second:.2f} files per second'.format(**report))
+    return report
+
+
+def print_batch_report(report):
+    """This function prints the summary report of a batch analysis
+
+    Args:
+        report (dict): the dictionary returned by batch_analysis()
+    """
+    print("Analyzed {files} files in {seconds:.2f} s "
+          "({files_per_second:.2f} files per second)".format(**report))
+    print("{succeeded} succeeded ({cached} found in the results store), "
+          "{skipped} skipped, {failed} failed".format(**report))
+    for filename, error in report["failures"]:
+        print("  {}: {}".format(filename, error))
+
+
+def main(argv=None):
+    """This function is the command line entry point of the module
+
+    With no arguments the user is asked for a single file by interface().
+    With --batch a directory or glob pattern of csv files is analyzed by
+    batch_analysis() and the summary report is printed. --plot chooses the
+    plot mode, which is 'interactive' for a single file and 'none' for
+    batch mode unless it is given. --hrv-window and --hrv-step add the
+    windowed heart rate variability to the metrics in both modes.
+
+    Args:
+        argv (list): command line arguments, None uses sys.argv
+    """
+    parser = argparse.ArgumentParser(description="Analyze ECG csv files")
+    parser.add_argument("--batch", metavar="PATH",
+                        help="directory or glob pattern of csv files")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of worker processes for --batch")
+    parser.add_argument("--plot", choices=PLOT_MODES, default=None,
+                        help="how to plot the ECG data")
+    parser.add_argument("--results", metavar="FILE", default=None,
+                        help="write the --batch metrics to one NDJSON file")
+    parser.add_argument("--output-policy", choices=OUTPUT_POLICIES,
+                        default='overwrite',
+                        help="what --batch does if an output file exists")
+    parser.add_argument("--engine", choices=sorted(DETECTORS),
+                        default=DEFAULT_ENGINE,
+                        help="the beat detector to use with --batch")
+    parser.add_argument("--sniff", action='store_true',
+                        help="check --batch files quickly first and skip "
+                        "the unusable ones")
+    parser.add_argument("--store", metavar="FILE", default=None,
+                        help="SQLite results store that --batch looks files "
+                        "up in and adds them to")
+    parser.add_argument("--hrv-window", type=float, default=None,
+                        metavar="SECONDS",
+                        help="add the heart rate variability in windows of "
+                        "this many seconds to the metrics of single-lead "
+                        "files")
+    parser.add_argument("--hrv-step", type=float, default=HRV_STEP,
+                        metavar="SECONDS",
+                        help="seconds between the starts of the "
+                        "--hrv-window windows")
+    args = parser.parse_args(argv)
+    configure_logging()
+    if args.batch is None:
+        interface(args.plot or 'interactive', args.hrv_window,
+                  args.hrv_step)
+        return
+    if args.plot == 'interactive':
+        parser.error("--plot interactive cannot be used with --batch")
+    report = batch_analysis(args.batch, args.workers, args.plot or 'none',
+                            args.results, args.output_policy, args.engine,
+                            args.store, args.sniff, args.hrv_window,
+                            args.hrv_step)
+    print_batch_report(report)
+
+
 if __name__ == '__main__':
-    interface()
+    main()
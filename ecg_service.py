@@ -0,0 +1,460 @@
+"""A local HTTP service for analyzing ECG recordings
+
+The service wraps file_metrics() from ecg_analysis so that recordings,
+with one lead or many, can be submitted over HTTP instead of through
+interface(). It is built on asyncio and only listens on a local
+address or a Unix socket.
+
+Requests:
+    POST /jobs      submit a recording, returns the job with its id
+    GET /jobs/<id>  poll a job, returns its status and metrics when done
+    POST /analyze   submit a recording and wait for its metrics
+    GET /health     the number of pending jobs and cached results
+
+A recording is submitted either as the raw CSV in the request body, with
+its name in an X-Filename header, or as a JSON body {"path": "file.csv"}
+naming a file the service can read. The metrics are the dictionary made by
+calc_metrics(). A recording without enough good rows to analyze fails with
+the summary of its bad rows, and POST /analyze answers it with 400.
+"""
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import logging
+import os
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import ecg_analysis
+
+
+STATUS_TEXT = {200: 'OK', 202: 'Accepted', 400: 'Bad Request',
+               404: 'Not Found', 405: 'Method Not Allowed',
+               413: 'Payload Too Large', 500: 'Internal Server Error',
+               503: 'Service Unavailable'}
+MAX_BODY_BYTES = 256 * 1024 ** 2
+
+
+class ServiceBusy(Exception):
+    """Raised when a job is submitted while too many jobs are pending"""
+
+
+class RequestError(Exception):
+    """Raised for a request the service cannot handle
+
+    Attributes:
+        status (int): the HTTP status code to respond with
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def content_key(content, band=ecg_analysis.FILTER_BAND,
+                order=ecg_analysis.FILTER_ORDER):
+    """This function makes the results cache key of a recording
+
+    Args:
+        content (bytes): the contents of the CSV file
+        band (tuple): (low, high) cutoff frequencies of the filter in Hz
+        order (int): the order of the filter
+
+    Returns:
+        str : a hash of the contents and the analysis parameters
+    """
+    digest = hashlib.blake2b(content)
+    digest.update(repr((tuple(band), order)).encode())
+    return digest.hexdigest()
+
+
+def analyze_recording(filename, name=None, band=ecg_analysis.FILTER_BAND,
+                      order=ecg_analysis.FILTER_ORDER):
+    """This function calculates the metrics of one recording file
+
+    The file is analyzed by file_metrics(), so a file with more than one
+    lead gets the metrics of every lead.
+
+    Args:
+        filename (str): the CSV file to analyze
+        name (str): the name of the recording, by default filename
+        band (tuple): (low, high) cutoff frequencies of the filter in Hz
+        order (int): the order of the filter
+
+    Returns:
+        dictionary : dictionary containing ecg metrics
+
+    Raises:
+        ValueError: if the file has fewer than two good data points
+    """
+    return ecg_analysis.file_metrics(filename, name=name, band=band,
+                                     order=order)
+
+
+def _analyze_upload(content, name, band, order):
+    """Save an uploaded recording to a temporary file and analyze it"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = os.path.join(tmp_dir, os.path.basename(name))
+        with open(filename, 'wb') as f:
+            f.write(content)
+        return analyze_recording(filename, name, band, order)
+
+
+def _read_file(filename):
+    """Return the contents of a file as bytes"""
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+class ECGService:
+    """This class is an asyncio HTTP service that analyzes ECG recordings
+
+    Recordings are analyzed by analyze_recording() in an executor, at most
+    max_workers at a time. Jobs waiting for a worker are queued, and once
+    max_pending jobs are queued or running new submissions are refused
+    with 503 Service Unavailable so that clients back off instead of
+    piling up work. The check is made as soon as the headers of a
+    submission are read, and a submission whose body is still being read
+    counts as pending, so a busy service never reads uploads it will refuse
+    and at most max_pending bodies are read at once. Results are cached by
+    content_key(), so submitting the same recording again returns the
+    cached metrics without analyzing it. The last max_jobs finished jobs
+    can be polled.
+
+    Args:
+        max_workers (int): number of recordings analyzed at the same time
+        max_pending (int): number of jobs that can be queued or running
+        cache_size (int): number of results kept in the cache
+        max_jobs (int): number of finished jobs that can still be polled
+        max_body (int): largest request body accepted, in bytes
+        band (tuple): (low, high) cutoff frequencies of the filter in Hz
+        order (int): the order of the filter
+        executor (concurrent.futures.Executor): executor to analyze the
+            recordings in, by default a thread pool of max_workers threads
+    """
+
+    def __init__(self, max_workers=2, max_pending=8, cache_size=128,
+                 max_jobs=1024, max_body=MAX_BODY_BYTES,
+                 band=ecg_analysis.FILTER_BAND,
+                 order=ecg_analysis.FILTER_ORDER, executor=None):
+        if max_pending < max_workers:
+            raise ValueError("max_pending must be at least max_workers")
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.cache_size = cache_size
+        self.max_jobs = max_jobs
+        self.max_body = max_body
+        self.band = tuple(band)
+        self.order = order
+        self.address = None
+        self._executor = executor
+        self._own_executor = executor is None
+        self._semaphore = None
+        self._server = None
+        self._pending = 0
+        self._reading = 0
+        self._cache = OrderedDict()
+        self._jobs = OrderedDict()
+        self._tasks = dict()
+        self._ids = itertools.count(1)
+
+    @property
+    def pending(self):
+        """int: the number of jobs that are queued or running"""
+        return self._pending
+
+    async def start(self, host='127.0.0.1', port=0, path=None):
+        """Start listening on a local TCP port or on a Unix socket
+
+        Args:
+            host (str): the address to listen on
+            port (int): the port to listen on, 0 picks a free port
+            path (str): listen on this Unix socket instead of TCP
+
+        Returns:
+            the (host, port) being listened on, or the socket path
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.max_workers)
+        self._semaphore = asyncio.Semaphore(self.max_workers)
+        if path is not None:
+            self._server = await asyncio.start_unix_server(self._handle,
+                                                           path)
+            self.address = path
+        else:
+            self._server = await asyncio.start_server(self._handle, host,
+                                                      port)
+            self.address = self._server.sockets[0].getsockname()[:2]
+        logging.info('ECG service listening on {}'.format(self.address))
+        return self.address
+
+    async def close(self):
+        """Stop listening and wait for the running jobs to finish"""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self._tasks:
+            await asyncio.wait(list(self._tasks.values()))
+        if self._own_executor and self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def job(self, job_id):
+        """Return the job with the given id, or None if it is not known"""
+        return self._jobs.get(job_id)
+
+    async def submit(self, content=None, path=None, name=None):
+        """Submit a recording to be analyzed
+
+        Exactly one of content and path must be given. Uploaded content
+        whose metrics are in the cache makes a job that is already done,
+        even when the service is busy.
+
+        Args:
+            content (bytes): the contents of a CSV file
+            path (str): the name of a CSV file the service can read
+            name (str): the name of the recording
+
+        Returns:
+            dictionary : the job, with its "id" and "status"
+
+        Raises:
+            ServiceBusy: if max_pending jobs are already queued or running
+        """
+        if (content is None) == (path is None):
+            raise ValueError("give either the content or the path")
+        job = {"id": str(next(self._ids)), "status": "queued",
+               "name": name or path or "upload.csv"}
+        key = None
+        if content is not None:
+            key = content_key(content, self.band, self.order)
+            if self._cached(job, key):
+                self._jobs[job["id"]] = job
+                self._forget_old_jobs()
+                return job
+        if self._pending >= self.max_pending:
+            raise ServiceBusy("{} jobs are already pending".format(
+                self._pending))
+        self._jobs[job["id"]] = job
+        self._pending += 1
+        self._tasks[job["id"]] = asyncio.ensure_future(
+            self._run(job, content, path, key))
+        return job
+
+    def _cached(self, job, key):
+        """Finish a job from the cache, returning False on a miss"""
+        result = self._cache.get(key)
+        if result is None:
+            return False
+        self._cache.move_to_end(key)
+        job.update(status="done", cached=True, result=result)
+        return True
+
+    async def wait(self, job_id):
+        """Wait for a job to finish and return it
+
+        The job is returned by its task, so it is returned even if it has
+        been dropped from the finished jobs by the time this wakes up.
+        None is returned for a job that is not known.
+        """
+        task = self._tasks.get(job_id)
+        if task is not None:
+            return await asyncio.shield(task)
+        return self._jobs.get(job_id)
+
+    async def _run(self, job, content, path, key):
+        """Analyze the recording of a job in the executor and return it"""
+        loop = asyncio.get_running_loop()
+        try:
+            async with self._semaphore:
+                job["status"] = "running"
+                if key is None:
+                    content = await loop.run_in_executor(
+                        self._executor, _read_file, path)
+                    key = content_key(content, self.band, self.order)
+                    if self._cached(job, key):
+                        return job
+                if path is not None:
+                    result = await loop.run_in_executor(
+                        self._executor, analyze_recording, path,
+                        job["name"], self.band, self.order)
+                else:
+                    result = await loop.run_in_executor(
+                        self._executor, _analyze_upload, content,
+                        job["name"], self.band, self.order)
+            self._cache[key] = result
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            job["result"] = result
+            job["status"] = "done"
+        except ValueError as error:
+            logging.warning('Job {} is not a usable recording: {}'.format(
+                job["id"], error))
+            job["error"] = str(error)
+            job["invalid"] = True
+            job["status"] = "failed"
+        except Exception as error:
+            logging.error('Job {} failed: {!r}'.format(job["id"], error))
+            job["error"] = repr(error)
+            job["status"] = "failed"
+        finally:
+            self._pending -= 1
+            del self._tasks[job["id"]]
+            self._forget_old_jobs()
+        return job
+
+    def _forget_old_jobs(self):
+        """Drop the oldest finished jobs beyond max_jobs"""
+        finished = [job_id for job_id, job in self._jobs.items()
+                    if job["status"] in ("done", "failed")]
+        for job_id in finished[:max(len(finished) - self.max_jobs, 0)]:
+            del self._jobs[job_id]
+
+    async def _handle(self, reader, writer):
+        """Answer one HTTP request and close the connection"""
+        try:
+            try:
+                method, target, headers, body = await self._read_request(
+                    reader)
+                status, payload = await self._route(method, target,
+                                                    headers, body)
+            except RequestError as error:
+                status, payload = error.status, {"error": str(error)}
+            except ServiceBusy as error:
+                status, payload = 503, {"error": str(error)}
+            except (ConnectionError, asyncio.IncompleteReadError):
+                raise
+            except Exception as error:
+                logging.error('Request failed: {!r}'.format(error))
+                status, payload = 500, {"error": "internal server error"}
+            body = json.dumps(payload).encode()
+            head = ["HTTP/1.1 {} {}".format(status, STATUS_TEXT[status]),
+                    "Content-Type: application/json",
+                    "Content-Length: {}".format(len(body)),
+                    "Connection: close"]
+            if status == 503:
+                head.append("Retry-After: 1")
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        """Read the request line, headers and body of an HTTP request"""
+        try:
+            request_line = await reader.readline()
+            method, target, version = request_line.decode().split()
+        except (UnicodeDecodeError, ValueError):
+            raise RequestError(400, "malformed request line")
+        headers = dict()
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode('latin-1').partition(":")
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            raise RequestError(400, "bad Content-Length")
+        if length < 0:
+            raise RequestError(400, "bad Content-Length")
+        if length > self.max_body:
+            raise RequestError(413, "the body is larger than {} bytes"
+                               .format(self.max_body))
+        if method == "POST" and target.split("?")[0] in ("/jobs",
+                                                         "/analyze"):
+            if self._pending + self._reading >= self.max_pending:
+                raise ServiceBusy("{} jobs are already pending".format(
+                    self._pending + self._reading))
+            self._reading += 1
+            try:
+                body = await reader.readexactly(length)
+            finally:
+                self._reading -= 1
+        else:
+            body = await reader.readexactly(length)
+        return method, target, headers, body
+
+    async def _route(self, method, target, headers, body):
+        """Return the status and JSON payload for a request"""
+        target = target.split("?")[0]
+        if target == "/health":
+            if method != "GET":
+                raise RequestError(405, "use GET")
+            return 200, {"pending": self._pending,
+                         "max_pending": self.max_pending,
+                         "cached": len(self._cache)}
+        if target.startswith("/jobs/"):
+            if method != "GET":
+                raise RequestError(405, "use GET")
+            job = self.job(target[len("/jobs/"):])
+            if job is None:
+                raise RequestError(404, "no such job")
+            return 200, job
+        if target not in ("/jobs", "/analyze"):
+            raise RequestError(404, "no such resource")
+        if method != "POST":
+            raise RequestError(405, "use POST")
+        job = await self.submit(**self._recording(headers, body))
+        if target == "/analyze":
+            job = await self.wait(job["id"])
+            if job is None:
+                raise RequestError(404, "no such job")
+            if job["status"] == "done":
+                return 200, job
+            return (400 if job.get("invalid") else 500), job
+        return (200 if job["status"] == "done" else 202), job
+
+    def _recording(self, headers, body):
+        """Return the submit() arguments for the body of a request"""
+        if headers.get("content-type", "").startswith("application/json"):
+            try:
+                path = json.loads(body.decode())["path"]
+            except (UnicodeDecodeError, ValueError, KeyError, TypeError):
+                raise RequestError(400, 'expected {"path": "file.csv"}')
+            return {"path": path}
+        name = headers.get("x-filename", "upload.csv")
+        return {"content": body, "name": name}
+
+
+async def serve(service, host='127.0.0.1', port=8547, path=None):
+    """Run a service until the task is cancelled"""
+    await service.start(host, port, path)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await service.close()
+
+
+def main(argv=None):
+    """This function runs the ECG service from the command line"""
+    parser = argparse.ArgumentParser(
+        description="Serve ECG analysis over local HTTP.")
+    parser.add_argument("--host", default='127.0.0.1',
+                        help="address to listen on")
+    parser.add_argument("--port", type=int, default=8547,
+                        help="port to listen on")
+    parser.add_argument("--unix", default=None,
+                        help="listen on this Unix socket instead")
+    parser.add_argument("--workers", type=int, default=2,
+                        help="number of recordings analyzed at once")
+    parser.add_argument("--max-pending", type=int, default=8,
+                        help="number of jobs that can be queued or running")
+    args = parser.parse_args(argv)
+    ecg_analysis.configure_logging()
+    service = ECGService(max_workers=args.workers,
+                         max_pending=args.max_pending)
+    try:
+        asyncio.run(serve(service, args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,274 @@
+"""A synthetic ECG generator for testing ecg_analysis at scale
+
+Recordings of any length and sample rate are made block by block with
+known beat times, so they can be written straight to a csv file in the
+format read by read_input() without being held in memory, for example:
+
+    python ecg_synthetic.py big.csv --samples 100000000 --truth big.json
+
+Each beat is a PQRST complex made of Gaussian waves with the R wave at the
+beat time. The time between beats varies randomly around the heart rate,
+and white noise, a slow baseline wander, tall artifacts and bad rows can
+be added. Every random value comes from the seed and the position in the
+recording, so the same arguments always give the same recording.
+"""
+import argparse
+import json
+import math
+import numpy as np
+
+
+BLOCK_SAMPLES = 65536
+# (offset from the R wave in s, amplitude in mV, width in s) of each wave
+PQRST = ((-0.2, 0.15, 0.025), (-0.03, -0.1, 0.01), (0.0, 1.0, 0.012),
+         (0.03, -0.2, 0.01), (0.3, 0.3, 0.05))
+ARTIFACT_WIDTH = 0.012
+BAD_ROWS = ("{time:.6f},", ",{volt:.6f}", "{time:.6f}, abc",
+            "{time:.6f}, NaN")
+
+
+def _gaussian_waves(offsets, waves):
+    """Return the sum of the waves at offsets seconds from their centre"""
+    total = np.zeros(offsets.shape)
+    for centre, amplitude, width in waves:
+        total += amplitude * np.exp(-0.5 * ((offsets - centre) / width) ** 2)
+    return total
+
+
+def _add_waves(volt, first, sample_rate, times, waves, before, after):
+    """Add the waves centred on times to the block of volt starting at
+    sample first
+
+    Every wave is only worked out from before seconds ahead of its time to
+    after seconds after it, and all of them are added by one bincount.
+    """
+    if len(times) == 0:
+        return
+    span = np.arange(-int(math.ceil(before * sample_rate)),
+                     int(math.ceil(after * sample_rate)) + 1)
+    index = np.ceil(np.asarray(times) * sample_rate).astype(np.int64)
+    index = index[:, np.newaxis] + span
+    offsets = index / sample_rate - np.asarray(times)[:, np.newaxis]
+    index -= first
+    inside = (index >= 0) & (index < volt.size)
+    volt += np.bincount(index[inside],
+                        _gaussian_waves(offsets[inside], waves),
+                        minlength=volt.size)
+
+
+def _event_times(rng, mean_gap, jitter, first_gap):
+    """Yield increasing event times with random gaps between them
+
+    The gaps are mean_gap times one plus jitter times a standard normal
+    value, kept between half and one and a half times mean_gap, or drawn
+    from an exponential distribution if jitter is None.
+    """
+    now = first_gap
+    while True:
+        if jitter is None:
+            gaps = rng.exponential(mean_gap, 1024)
+        else:
+            gaps = mean_gap * np.clip(1 + jitter * rng.standard_normal(1024),
+                                      0.5, 1.5)
+        for gap in gaps:
+            yield now
+            now += gap
+
+
+def _events_until(events, pending, stop):
+    """Move the events before stop from the generator onto pending"""
+    while not pending or pending[-1] < stop:
+        pending.append(next(events))
+
+
+def synthetic_chunks(num_samples, sample_rate=360.0, heart_rate=72.0,
+                     hrv=0.05, noise=0.02, wander=0.1,
+                     artifacts_per_minute=0.0, artifact_scale=10.0, seed=0):
+    """This function makes a synthetic ECG recording block by block
+
+    The recording is made BLOCK_SAMPLES samples at a time, so only one
+    block is in memory however long the recording is. The time between
+    beats is 60 / heart_rate seconds times one plus hrv times a standard
+    normal value. The baseline wander is two slow sine waves with a total
+    size of about wander, and artifacts are single spikes shaped like an R
+    wave but artifact_scale times as tall, at random times with on average
+    artifacts_per_minute of them a minute.
+
+    Args:
+        num_samples (int): number of samples in the recording
+        sample_rate (float): samples per second
+        heart_rate (float): mean beats per minute
+        hrv (float): relative standard deviation of the time between beats
+        noise (float): standard deviation of the white noise in mV
+        wander (float): size of the baseline wander in mV
+        artifacts_per_minute (float): mean number of artifacts a minute
+        artifact_scale (float): height of the artifacts in mV
+        seed (int): seed of all of the random values
+
+    Yields:
+        numpy.ndarray : time values of the block
+        numpy.ndarray : voltages of the block
+        numpy.ndarray : true beat times in the block
+        numpy.ndarray : artifact times in the block
+    """
+    if sample_rate <= 0 or heart_rate <= 0:
+        raise ValueError("sample_rate and heart_rate must be positive")
+    period = 60.0 / heart_rate
+    beat_times = _event_times(np.random.default_rng([seed, 2]), period,
+                              hrv, period / 2)
+    artifact_times = None
+    if artifacts_per_minute > 0:
+        gap = 60.0 / artifacts_per_minute
+        artifact_times = _event_times(np.random.default_rng([seed, 3]), gap,
+                                      None, gap / 2)
+    before = -min(wave[0] - 4 * wave[2] for wave in PQRST)
+    after = max(wave[0] + 4 * wave[2] for wave in PQRST)
+    beats = list()
+    spikes = list()
+    for block, first in enumerate(range(0, num_samples, BLOCK_SAMPLES)):
+        stop = min(first + BLOCK_SAMPLES, num_samples)
+        time = np.arange(first, stop) / sample_rate
+        rng = np.random.default_rng([seed, 0, block])
+        volt = noise * rng.standard_normal(time.size)
+        volt += wander * (0.7 * np.sin(2 * np.pi * 0.3 * time) +
+                          0.3 * np.sin(2 * np.pi * 0.05 * time + 1.0))
+        end = stop / sample_rate
+        _events_until(beat_times, beats, end + before)
+        _add_waves(volt, first, sample_rate, beats, PQRST, before, after)
+        block_artifacts = np.empty(0)
+        if artifact_times is not None:
+            _events_until(artifact_times, spikes, end + 4 * ARTIFACT_WIDTH)
+            _add_waves(volt, first, sample_rate, spikes,
+                       ((0.0, artifact_scale, ARTIFACT_WIDTH),),
+                       4 * ARTIFACT_WIDTH, 4 * ARTIFACT_WIDTH)
+            block_artifacts = np.array([spike for spike in spikes
+                                        if time[0] <= spike < end])
+            spikes = [spike for spike in spikes
+                      if spike >= end - 4 * ARTIFACT_WIDTH]
+        block_beats = np.array([beat for beat in beats
+                                if time[0] <= beat < end])
+        beats = [beat for beat in beats if beat >= end - after]
+        yield time, volt, block_beats, block_artifacts
+
+
+def synthetic_recording(num_samples, sample_rate=360.0, heart_rate=72.0,
+                        **kwargs):
+    """This function makes a whole synthetic ECG recording in memory
+
+    Args:
+        num_samples (int): number of samples in the recording
+        sample_rate (float): samples per second
+        heart_rate (float): mean beats per minute
+        **kwargs: the other arguments of synthetic_chunks()
+
+    Returns:
+        numpy.ndarray : time values
+        numpy.ndarray : voltages
+        numpy.ndarray : true beat times
+    """
+    chunks = list(synthetic_chunks(num_samples, sample_rate, heart_rate,
+                                   **kwargs))
+    if not chunks:
+        return np.empty(0), np.empty(0), np.empty(0)
+    return tuple(np.concatenate([chunk[i] for chunk in chunks])
+                 for i in range(3))
+
+
+def _format_rows(time, volt):
+    """Format time and voltage pairs as csv lines with one % operation"""
+    rows = np.empty(2 * time.size)
+    rows[0::2] = time
+    rows[1::2] = volt
+    return ("%.6f, %.6f\n" * time.size) % tuple(rows)
+
+
+def write_synthetic_csv(filename, num_samples, sample_rate=360.0,
+                        heart_rate=72.0, bad_rows=0.0, seed=0, **kwargs):
+    """This function writes a synthetic ECG recording to a csv file
+
+    The blocks made by synthetic_chunks() are formatted and written one at
+    a time, so files far larger than memory can be made. Each row is
+    replaced by a bad row with a chance of bad_rows, cycling at random
+    between an empty voltage, an empty time, a non-numeric voltage and a
+    NaN voltage, which read_input() skips.
+
+    Args:
+        filename (str): name of the csv file to write
+        num_samples (int): number of samples in the recording
+        sample_rate (float): samples per second
+        heart_rate (float): mean beats per minute
+        bad_rows (float): fraction of the rows that are bad
+        seed (int): seed of all of the random values
+        **kwargs: the other arguments of synthetic_chunks()
+
+    Returns:
+        dictionary : the ground truth, with the "samples", "sample_rate",
+        "duration", the true "beats", the "artifacts" and the line numbers
+        of the "bad_lines"
+    """
+    beats = list()
+    artifacts = list()
+    bad_lines = list()
+    with open(filename, 'w') as f:
+        for block, chunk in enumerate(synthetic_chunks(
+                num_samples, sample_rate, heart_rate, seed=seed, **kwargs)):
+            time, volt, block_beats, block_artifacts = chunk
+            beats.append(block_beats)
+            artifacts.append(block_artifacts)
+            first = block * BLOCK_SAMPLES
+            bad = kinds = np.empty(0, dtype=np.int64)
+            if bad_rows > 0:
+                rng = np.random.default_rng([seed, 1, block])
+                bad = np.flatnonzero(rng.random(time.size) < bad_rows)
+                kinds = rng.integers(0, len(BAD_ROWS), bad.size)
+            start = 0
+            for row, kind in zip(bad.tolist(), kinds.tolist()):
+                f.write(_format_rows(time[start:row], volt[start:row]))
+                f.write(BAD_ROWS[kind].format(time=time[row],
+                                              volt=volt[row]) + "\n")
+                start = row + 1
+            f.write(_format_rows(time[start:], volt[start:]))
+            bad_lines.extend((first + bad + 1).tolist())
+    return {"samples": num_samples,
+            "sample_rate": sample_rate,
+            "duration": (num_samples - 1) / sample_rate,
+            "beats": np.concatenate(beats).tolist() if beats else [],
+            "artifacts": (np.concatenate(artifacts).tolist()
+                          if artifacts else []),
+            "bad_lines": bad_lines}
+
+
+def main(argv=None):
+    """This function writes a synthetic recording from the command line
+
+    Args:
+        argv (list): command line arguments, None uses sys.argv
+    """
+    parser = argparse.ArgumentParser(
+        description="Write a synthetic ECG csv file")
+    parser.add_argument("filename", help="csv file to write")
+    parser.add_argument("--samples", type=int, default=1000000,
+                        help="number of samples")
+    parser.add_argument("--sample-rate", type=float, default=360.0)
+    parser.add_argument("--heart-rate", type=float, default=72.0)
+    parser.add_argument("--hrv", type=float, default=0.05)
+    parser.add_argument("--noise", type=float, default=0.02)
+    parser.add_argument("--wander", type=float, default=0.1)
+    parser.add_argument("--artifacts-per-minute", type=float, default=0.0)
+    parser.add_argument("--bad-rows", type=float, default=0.0,
+                        help="fraction of the rows that are bad")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--truth", metavar="FILE",
+                        help="json file to save the ground truth in")
+    args = parser.parse_args(argv)
+    truth = write_synthetic_csv(
+        args.filename, args.samples, args.sample_rate, args.heart_rate,
+        args.bad_rows, args.seed, hrv=args.hrv, noise=args.noise,
+        wander=args.wander, artifacts_per_minute=args.artifacts_per_minute)
+    if args.truth is not None:
+        with open(args.truth, 'w') as f:
+            json.dump(truth, f)
+
+
+if __name__ == '__main__':
+    main()
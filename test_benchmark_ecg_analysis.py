@@ -0,0 +1,65 @@
+import pytest
+
+
+def test_benchmark_import():
+    from benchmark_ecg_analysis import benchmark_import
+    answer = benchmark_import(repeats=1)
+    assert answer["repeats"] == 1
+    assert answer["interpreter_seconds"] > 0
+    assert "import_seconds_median" in answer
+
+
+def test_run_benchmarks():
+    from benchmark_ecg_analysis import run_benchmarks, STAGES
+    results = run_benchmarks(sizes=[2000], include_test_data=False)
+    assert [result["stage"] for result in results] == list(STAGES)
+    for result in results:
+        assert result["source"] == "synthetic_2000.csv"
+        assert result["samples"] == 2000
+        assert result["samples_per_second"] > 0
+        assert result["peak_bytes"] > 0
+
+
+def test_compare_results():
+    from benchmark_ecg_analysis import compare_results
+    old = {"stages": [{"source": "a", "stage": "read_input",
+                       "seconds": 2.0}]}
+    new = {"stages": [{"source": "a", "stage": "read_input", "seconds": 1.0},
+                      {"source": "b", "stage": "read_input", "seconds": 1.0}]}
+    assert compare_results(old, new) == [("a", "read_input", 2.0, 1.0, 2.0)]
+
+
+def test_benchmark_writer():
+    from benchmark_ecg_analysis import benchmark_writer
+    answer = benchmark_writer(num_records=50, num_beats=10, json_files=5)
+    assert answer["records"] == 50
+    assert answer["json_files"] == 5
+    assert answer["records_per_second"] > 0
+    assert answer["bytes_per_second"] > 0
+
+
+@pytest.mark.parametrize("found, expected, exp", [
+    ([1.0, 2.01, 3.5], [1.0, 2.0, 3.0], (2 / 3, 2 / 3)),
+    ([1.0, 2.0], [1.02, 2.0, 3.0, 4.0], (0.5, 1.0)),
+    ([], [1.0], (0.0, 0.0)),
+    ([1.0, 5.0], [1.03], (1.0, 0.5))])
+def test_beat_accuracy(found, expected, exp):
+    from benchmark_ecg_analysis import beat_accuracy
+    assert beat_accuracy(found, expected) == pytest.approx(exp)
+
+
+def test_benchmark_engines():
+    from benchmark_ecg_analysis import benchmark_engines
+    results = benchmark_engines(sizes=[5000])
+    scores = {(result["source"], result["engine"]): result
+              for result in results}
+    assert len(scores) == 4
+    clean = scores[("synthetic_5000", "threshold")]
+    assert clean["positive_predictivity"] == 1
+    assert clean["sensitivity"] > 0.9
+    assert scores[("synthetic_5000_artifact", "threshold")][
+        "sensitivity"] == 0
+    spiked = scores[("synthetic_5000_artifact", "adaptive")]
+    assert spiked["sensitivity"] > 0.6
+    assert spiked["positive_predictivity"] > 0.9
+    assert spiked["samples_per_second"] > 0
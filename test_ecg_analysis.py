@@ -1,3 +1,4 @@
+import os
 import pytest
 import numpy as np
 from testfixtures import LogCapture
@@ -38,6 +39,55 @@ def test_is_a_number(test_num, exp):
     assert answer == exp
 
 
+@pytest.mark.parametrize("lines, exp_time, exp_volt, exp_bad, exp_reasons", [
+    (['0, 1', '1, 2'], [0, 1], [1, 2], [], []),
+    (['0, 1', '1, ', '2, 3'], [0, 2], [1, 3], [2], [0]),
+    (['0, 1', 'abc, 2', '2, NaN'], [0], [1], [2, 3], [1, 2]),
+    (['0, 1', '', '1, 2, 3', '4'], [0], [1], [2, 3, 4], [0, 0, 0]),
+    (['0, 1', 'nan, 2'], [0], [1], [2], [2]),
+    ([], [], [], [], [])])
+def test_parse_rows(lines, exp_time, exp_volt, exp_bad, exp_reasons):
+    from ecg_analysis import parse_rows
+    time, volt, bad_lines, bad_reasons = parse_rows(lines)
+    assert time.tolist() == exp_time
+    assert volt.tolist() == exp_volt
+    assert bad_lines.tolist() == exp_bad
+    assert bad_reasons.tolist() == exp_reasons
+
+
+@pytest.mark.parametrize("block_rows", [65536, 2])
+def test_read_input_arrays(tmp_path, block_rows):
+    from ecg_analysis import read_input_arrays
+    filename = tmp_path / "data.csv"
+    filename.write_text("0, 1\n0.5, \n1, 2\n, 3\n1.5, nan\n2, 4\n")
+    time, volt, bad_lines, bad_reasons = read_input_arrays(str(filename),
+                                                           block_rows)
+    assert time.dtype == np.float64
+    assert time.tolist() == [0, 1, 2]
+    assert volt.tolist() == [1, 2, 4]
+    assert bad_lines.tolist() == [2, 4, 5]
+    assert bad_reasons.tolist() == [0, 0, 2]
+
+
+@pytest.mark.parametrize("filename", [
+    "test_data/test_data2.csv",
+    "test_data/test_data31.csv",
+    "test_data/test_data32.csv"])
+def test_read_input_matches_line_parser(filename):
+    from ecg_analysis import read_input, split_data, check_data
+    exp_time = list()
+    exp_volt = list()
+    with open(filename, 'r') as f:
+        for line in f:
+            temp_time, temp_volt = split_data(line)
+            if check_data(temp_time, temp_volt):
+                exp_time.append(float(temp_time))
+                exp_volt.append(float(temp_volt))
+    time, volt = read_input(filename)
+    assert time == exp_time
+    assert volt == exp_volt
+
+
 # def test_filter_data():
 #     from ecg_analysis import filter_data
 #     time = np.linspace(0, 0.05, 20)
@@ -47,6 +97,37 @@ def test_is_a_number(test_num, exp):
 #     answer = filter_data(time, volt_w_noise)
 #     assert answer[3] == sample_data[3]
 
+def test_filter_data_is_memoized():
+    from ecg_analysis import filter_data, clear_filter_cache
+    clear_filter_cache()
+    time = np.arange(0, 5, 0.004)
+    volt = np.sin(2 * np.pi * 10 * time) + np.sin(2 * np.pi * 0.2 * time)
+    first = filter_data(time, volt)
+    second = filter_data(time, volt.tolist())
+    assert second is first
+    assert not first.flags.writeable
+    wide = filter_data(time, volt, band=(0.1, 40), order=3)
+    assert wide is not first
+    assert not np.allclose(wide, first)
+    clear_filter_cache()
+    assert filter_data(time, volt) is not first
+
+
+def test_filter_coefficients():
+    from ecg_analysis import filter_coefficients
+    from scipy.signal import filtfilt
+    import heartpy as hp
+    time = np.arange(0, 5, 0.004)
+    volt = np.sin(2 * np.pi * 10 * time) + np.sin(2 * np.pi * 0.2 * time)
+    b, a = filter_coefficients(250.0, (5, 20), 2)
+    expected = hp.filter_signal(volt, [5, 20], 250.0, 2, 'bandpass')
+    assert np.array_equal(filtfilt(b, a, volt), expected)
+    assert not b.flags.writeable and not a.flags.writeable
+    hits = filter_coefficients.cache_info().hits
+    assert filter_coefficients(250.0, (5, 20), 2)[0] is b
+    assert filter_coefficients.cache_info().hits == hits + 1
+
+
 def test_calc_duration():
     from ecg_analysis import calc_duration
     time = np.linspace(0, 1, 200)
@@ -84,6 +165,17 @@ def test_calc_mean_hr_bpm():
     assert answer == expected
 
 
+@pytest.mark.parametrize("beat_list, expected", [
+    ([1, 1.05, 1.1, 2, 2.05, 3], [1.05, 2.05, 3]),
+    ([1, 1.05, 2, 2.05], [1.05, 2.05]),
+    ([5], [5]),
+    ([], [])])
+def test_group_similar_values(beat_list, expected):
+    from ecg_analysis import group_similar_values
+    answer = group_similar_values(beat_list)
+    assert answer == expected
+
+
 def test_calc_beats():
     from ecg_analysis import calc_beats
     time = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14,
@@ -96,6 +188,27 @@ def test_calc_beats():
     assert answer == expected
 
 
+def test_detect_beats():
+    from ecg_analysis import detect_beats
+    time = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11]
+    volts = [0, 5, 0, 0, 4, 0, 0, 0, 5, 0, -1, 0]
+    detection = detect_beats(time, volts)
+    assert detection.beats == [1, 4, 8]
+    assert detection.rr_intervals.tolist() == [3, 4]
+    assert detection.voltage_extremes == (-1, 5)
+    assert detection.num_beats == 3
+    assert detection.mean_hr_bpm == pytest.approx(17.5)
+
+
+def test_calc_functions_use_detection():
+    from ecg_analysis import (BeatDetection, calc_beats, calc_num_beats,
+                              calc_mean_hr_bpm)
+    detection = BeatDetection([1, 3, 5], np.array([2, 2]), (0, 1))
+    assert calc_beats(None, None, detection) == [1, 3, 5]
+    assert calc_num_beats(None, None, detection) == 3
+    assert calc_mean_hr_bpm(None, None, detection) == 30
+
+
 # def test_calc_metrics():
 #     from ecg_analysis import calc_metrics
 #     time = [0, .01, .02, .03, .04, .05, .06, .07, .08, .09,
@@ -115,6 +228,84 @@ def test_calc_beats():
 #     assert answer == expected
 
 
+@pytest.mark.parametrize("mode, exp_png", [
+    ('none', False),
+    ('png', True)])
+def test_plot_data(tmp_path, mode, exp_png):
+    from ecg_analysis import plot_data
+    filename = str(tmp_path / "data.csv")
+    answer = plot_data([0, 1, 2], [0, 1, 0], filename, mode)
+    assert (tmp_path / "data.png").exists() is exp_png
+    assert (answer is not None) is exp_png
+
+
+def test_plot_data_bad_mode():
+    from ecg_analysis import plot_data
+    with pytest.raises(ValueError):
+        plot_data([0, 1], [0, 1], "data.csv", "screen")
+
+
+def test_decimation_pyramid_envelope():
+    from ecg_analysis import DecimationPyramid
+    time = np.arange(100000) / 100.0
+    volt = np.sin(time)
+    volt[54321] = 5
+    pyramid = DecimationPyramid(time, volt)
+    assert len(pyramid.levels) == 9
+    assert pyramid.levels[-1][0].tolist() == [volt.min()]
+    times, volts = pyramid.envelope(width=500)
+    assert len(times) <= 1000
+    assert volts.max() == 5
+    assert volts.min() == volt.min()
+    assert times[0] == 0
+    times, volts = pyramid.envelope(543.2, 543.3, width=500)
+    np.testing.assert_array_equal(times, time[54320:54331])
+    np.testing.assert_array_equal(volts, volt[54320:54331])
+
+
+def test_decimation_pyramid_leads():
+    from ecg_analysis import DecimationPyramid
+    time = np.arange(10000) / 100.0
+    volts = np.column_stack((np.sin(time), 2 * np.cos(time)))
+    times, answer = DecimationPyramid(time, volts).envelope(10, 90, 100)
+    assert answer.shape == (len(times), 2)
+    assert answer.max(axis=0) == pytest.approx([1, 2], abs=1e-3)
+    assert answer.min(axis=0) == pytest.approx([-1, -2], abs=1e-3)
+
+
+def test_save_plots(tmp_path):
+    from ecg_analysis import save_plots
+    time = np.arange(200000) / 360.0
+    filename = str(tmp_path / "data.csv")
+    answer = save_plots(time, np.sin(time), filename, beats=time[::300],
+                        zooms=[(10, 20), (0.5, 1.25)])
+    assert answer == [str(tmp_path / "data.png"),
+                      str(tmp_path / "data_10-20s.png"),
+                      str(tmp_path / "data_0.5-1.25s.png")]
+    assert all(os.path.exists(name) for name in answer)
+
+
+def test_calc_metrics_png_without_filename(tmp_path, monkeypatch):
+    from ecg_analysis import read_input, calc_metrics, Recording
+    time, volt = read_input("test_data/test_data2.csv")
+    monkeypatch.chdir(tmp_path)
+    calc_metrics(time, volt, plot='png')
+    calc_metrics(Recording(time, volt), plot='png', zooms=[(1, 2.5)])
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "ecg.png", "ecg_1-2.5s.png"]
+
+
+def test_calc_metrics_plot_in_background(tmp_path):
+    from ecg_analysis import read_input, calc_metrics, wait_for_plots
+    time, volt = read_input("test_data/test_data2.csv")
+    filename = str(tmp_path / "test_data2.csv")
+    metrics = calc_metrics(time, volt, filename, plot='png',
+                           plot_in_background=True)
+    assert metrics["num_beats"] == 32
+    assert wait_for_plots() == [str(tmp_path / "test_data2.png")]
+    assert (tmp_path / "test_data2.png").exists()
+
+
 def test_log_if_bad_data_is_made():
     from ecg_analysis import log_if_bad_data
     with LogCapture() as log_c:
@@ -130,6 +321,79 @@ def test_log_if_bad_data_is_not_made():
     log_c.check()
 
 
+def test_summarize_bad_rows():
+    from ecg_analysis import summarize_bad_rows
+    bad_lines = np.array([3, 8, 9, 20, 21])
+    bad_reasons = np.array([0, 1, 2, 2, 0], dtype=np.int8)
+    answer = summarize_bad_rows(bad_lines, bad_reasons, max_lines=3)
+    assert answer == {"total": 5,
+                      "counts": {"empty": 2, "non-numeric": 1, "nan": 2},
+                      "first_lines": [3, 8, 9]}
+
+
+def test_log_bad_rows():
+    from ecg_analysis import log_bad_rows
+    summary = {"total": 3, "counts": {"empty": 1, "non-numeric": 2,
+                                      "nan": 0},
+               "first_lines": [4, 7, 9]}
+    with LogCapture() as log_c:
+        log_bad_rows("data.csv", summary)
+        log_bad_rows("clean.csv", {"total": 0})
+    log_c.check(('root', 'ERROR', 'data.csv: skipped 3 bad data points '
+                 '(empty: 1, non-numeric: 2, nan: 0); first bad lines: '
+                 '4, 7, 9'))
+
+
+def test_read_input_logs_bad_rows_once():
+    from ecg_analysis import read_input
+    with LogCapture() as log_c:
+        read_input("test_data/test_data31.csv")
+    log_c.check(('root', 'ERROR', 'test_data/test_data31.csv: skipped 4 bad '
+                 'data points (empty: 4, non-numeric: 0, nan: 0); first bad '
+                 'lines: 29, 39, 58, 100'))
+
+
+def test_configure_logging(tmp_path):
+    import subprocess
+    import sys
+    code = ("import logging, ecg_analysis; "
+            "ecg_analysis.configure_logging('run.log'); "
+            "ecg_analysis.read_input('{}')".format(
+                os.path.abspath("test_data/test_data31.csv")))
+    subprocess.run([sys.executable, "-c", code], cwd=str(tmp_path),
+                   env={"PYTHONPATH": os.getcwd()}, check=True)
+    text = (tmp_path / "run.log").read_text()
+    assert text.startswith("ERROR:root:")
+    assert "skipped 4 bad data points" in text
+
+
+@pytest.mark.parametrize("asynchronous", [True, False])
+def test_configure_logging_batch(tmp_path, asynchronous):
+    import shutil
+    import subprocess
+    import sys
+    data = tmp_path / "data"
+    data.mkdir()
+    for i in range(4):
+        shutil.copy("test_data/test_data31.csv",
+                    str(data / "bad{}.csv".format(i)))
+    (tmp_path / "run.log").write_text("old run\n" * 1000)
+    code = ("import ecg_analysis; "
+            "ecg_analysis.configure_logging('run.log', asynchronous={}); "
+            "ecg_analysis.batch_analysis('data', workers=2)".format(
+                asynchronous))
+    subprocess.run([sys.executable, "-c", code], cwd=str(tmp_path),
+                   env={"PYTHONPATH": os.getcwd()}, check=True)
+    lines = (tmp_path / "run.log").read_text().splitlines()
+    assert "old run" not in lines
+    assert all(line.split(":")[0] in ("INFO", "WARNING", "ERROR")
+               for line in lines)
+    bad_rows = [line for line in lines if "skipped 4 bad data points" in line]
+    assert sorted(line.split(":")[2] for line in bad_rows) == [
+        os.path.join("data", "bad{}.csv".format(i)) for i in range(4)]
+    assert lines[-1].startswith("INFO:root:Batch analysis finished: 4 files")
+
+
 def test_log_if_data_too_high_is_made():
     from ecg_analysis import log_if_data_too_high
     with LogCapture() as log_c:
@@ -143,3 +407,845 @@ def test_log_if_data_too_high_is_not_made():
     with LogCapture() as log_c:
         log_if_data_too_high([24, 25, 26, 27, 28, 29, 30])
     log_c.check()
+
+
+@pytest.mark.parametrize("pattern, expected", [
+    ("", ["a.csv", "b.csv"]),
+    ("b*.csv", ["b.csv"])])
+def test_find_input_files(tmp_path, pattern, expected):
+    from ecg_analysis import find_input_files
+    for name in ["a.csv", "b.csv", "c.txt"]:
+        (tmp_path / name).write_text("0, 1\n")
+    answer = find_input_files(str(tmp_path / pattern))
+    assert answer == [str(tmp_path / name) for name in expected]
+
+
+def test_batch_analysis(tmp_path):
+    import json
+    import shutil
+    from ecg_analysis import batch_analysis
+    shutil.copy("test_data/test_data2.csv", str(tmp_path / "good1.csv"))
+    shutil.copy("test_data/test_data31.csv", str(tmp_path / "good2.csv"))
+    (tmp_path / "empty.csv").write_text("")
+    report = batch_analysis(str(tmp_path), workers=2, plot='png')
+    assert report["files"] == 3
+    assert report["succeeded"] == 2
+    assert report["failed"] == 1
+    assert report["failures"][0][0] == str(tmp_path / "empty.csv")
+    assert report["files_per_second"] > 0
+    with open(str(tmp_path / "good1.json"), 'r') as f:
+        metrics = json.load(f)
+    assert metrics["num_beats"] == 32
+    assert (tmp_path / "good2.png").exists()
+
+
+def test_import_is_lazy(tmp_path):
+    import os
+    import subprocess
+    import sys
+    code = ("import sys, ecg_analysis; "
+            "print('heartpy' in sys.modules, "
+            "'matplotlib' in sys.modules)")
+    env = {"PYTHONPATH": os.getcwd()}
+    answer = subprocess.run([sys.executable, "-c", code], cwd=str(tmp_path),
+                            env=env, stdout=subprocess.PIPE,
+                            universal_newlines=True, check=True)
+    assert answer.stdout.split() == ["False", "False"]
+    assert not (tmp_path / "bad_data.log").exists()
+
+
+def test_filter_data_does_not_import_heartpy(tmp_path):
+    import subprocess
+    import sys
+    code = ("import sys, numpy, ecg_analysis; "
+            "ecg_analysis.filter_data(numpy.arange(1000) / 360.0, "
+            "numpy.ones(1000)); "
+            "print('heartpy' in sys.modules, "
+            "'matplotlib.pyplot' in sys.modules)")
+    answer = subprocess.run([sys.executable, "-c", code], cwd=str(tmp_path),
+                            env={"PYTHONPATH": os.getcwd()},
+                            stdout=subprocess.PIPE, universal_newlines=True,
+                            check=True)
+    assert answer.stdout.split() == ["False", "False"]
+
+
+def test_iter_input_chunks(tmp_path):
+    from ecg_analysis import iter_input_chunks
+    filename = tmp_path / "data.csv"
+    filename.write_text("0, 1\n1, 2\nbad\n3, 4\n4, \n5, 6\n6, 7\n")
+    chunks = list(iter_input_chunks(str(filename), chunk_rows=3))
+    assert len(chunks) == 3
+    assert [chunk[0].tolist() for chunk in chunks] == [[0, 1], [3, 5], [6]]
+    assert [chunk[2].tolist() for chunk in chunks] == [[3], [5], []]
+
+
+@pytest.mark.parametrize("filename, chunk_rows", [
+    ("test_data/test_data2.csv", 1000),
+    ("test_data/test_data23.csv", 777),
+    ("test_data/test_data31.csv", 64)])
+def test_stream_metrics(tmp_path, filename, chunk_rows):
+    from ecg_analysis import read_input, calc_metrics, stream_metrics
+    time, volt = read_input(filename)
+    expected = calc_metrics(time, volt, filename, plot='none')
+    answer = stream_metrics(filename, chunk_rows, workdir=str(tmp_path))
+    assert answer == expected
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.parametrize("filename, block_rows", [
+    ("test_data/test_data2.csv", 250),
+    ("test_data/test_data16.csv", 500),
+    ("test_data/test_data22.csv", 37),
+    ("test_data/test_data31.csv", 250),
+    ("test_data1.csv", 100)])
+def test_incremental_beat_detector(filename, block_rows):
+    from ecg_analysis import (read_input, calc_metrics,
+                              IncrementalBeatDetector)
+    time, volt = read_input(filename)
+    expected = calc_metrics(time, volt, filename, plot='none')
+    detector = IncrementalBeatDetector()
+    beats = list()
+    for start in range(0, len(time), block_rows):
+        stop = start + block_rows
+        new_beats, mean_hr_bpm = detector.push(time[start:stop],
+                                               volt[start:stop])
+        beats.extend(new_beats.tolist())
+    new_beats, mean_hr_bpm = detector.flush()
+    beats.extend(new_beats.tolist())
+    assert beats == detector.beats
+    assert len(beats) == expected["num_beats"]
+    assert beats == pytest.approx(expected["beats"], abs=0.005)
+    assert mean_hr_bpm == pytest.approx(expected["mean_hr_bpm"], rel=1e-3)
+
+
+@pytest.mark.parametrize("filename", [
+    "test_data/test_data5.csv",
+    "test_data/test_data10.csv",
+    "test_data/test_data23.csv"])
+def test_incremental_beat_detector_late_maximum(filename):
+    from ecg_analysis import (read_input, calc_metrics, filter_data,
+                              IncrementalBeatDetector)
+    time, volt = read_input(filename)
+    expected = calc_metrics(time, volt, filename, plot='none')
+    filtered = np.asarray(filter_data(time, volt))
+    peak_time = time[np.argmax(filtered)]
+    detectors = [IncrementalBeatDetector(),
+                 IncrementalBeatDetector(initial_maximum=filtered.max())]
+    for detector in detectors:
+        for start in range(0, len(time), 250):
+            detector.push(time[start:start + 250], volt[start:start + 250])
+        detector.flush()
+    streaming, primed = detectors
+    assert streaming.num_beats > expected["num_beats"]
+    late = [beat for beat in expected["beats"] if beat >= peak_time]
+    assert streaming.beats[-len(late):] == pytest.approx(late, abs=0.005)
+    assert primed.num_beats == expected["num_beats"]
+    assert primed.beats == pytest.approx(expected["beats"], abs=0.005)
+    assert primed.mean_hr_bpm == pytest.approx(expected["mean_hr_bpm"],
+                                               rel=1e-3)
+
+
+def test_incremental_beat_detector_reports_beats_early():
+    from ecg_analysis import IncrementalBeatDetector
+    time = np.arange(0, 10, 0.004)
+    volt = np.where(np.abs((time % 1) - 0.5) < 0.02, 1.0, 0.0)
+    detector = IncrementalBeatDetector(lookahead=1.0)
+    new_beats, mean_hr_bpm = detector.push(time[:1000], volt[:1000])
+    assert new_beats.size > 0
+    assert time[999] - new_beats[-1] < 2.0
+    assert detector.num_beats == new_beats.size
+
+
+def test_read_input_cached(tmp_path):
+    import os
+    import shutil
+    from ecg_analysis import read_input_arrays, read_input_cached
+    filename = str(tmp_path / "data.csv")
+    shutil.copy("test_data/test_data31.csv", filename)
+    cache_dir = str(tmp_path / "cache")
+    expected = read_input_arrays(filename)
+    first = read_input_cached(filename, cache_dir)
+    assert len(os.listdir(cache_dir)) == 4
+    second = read_input_cached(filename, cache_dir)
+    for answer in (first, second):
+        for array, exp in zip(answer, expected):
+            assert np.array_equal(array, exp)
+    assert isinstance(second[0], np.memmap)
+    with open(filename, 'a') as f:
+        f.write("\n100, 1\n")
+    third = read_input_cached(filename, cache_dir)
+    assert third[0][-1] == 100
+    assert not isinstance(third[0], np.memmap)
+
+
+def test_evict_cache(tmp_path):
+    import os
+    from ecg_analysis import evict_cache
+    for i, key in enumerate(["old", "mid", "new"]):
+        for name in ["time", "volt", "bad_lines", "bad_reasons"]:
+            path = tmp_path / "{}.{}.npy".format(key, name)
+            path.write_bytes(b"x" * 100)
+            os.utime(str(path), (1000 + i, 1000 + i))
+    removed = evict_cache(str(tmp_path), max_bytes=450)
+    assert removed == ["old", "mid"]
+    assert sorted(os.listdir(str(tmp_path)))[0] == "new.bad_lines.npy"
+
+
+def test_stage_hooks(tmp_path):
+    import shutil
+    from ecg_analysis import (add_stage_hook, remove_stage_hook, StageStats,
+                              analyze_file, clear_filter_cache)
+    filename = str(tmp_path / "data.csv")
+    shutil.copy("test_data/test_data31.csv", filename)
+    calls = list()
+
+    def hook(stage, seconds, counts):
+        calls.append((stage, seconds, counts))
+
+    stats = StageStats()
+    add_stage_hook(stats)
+    add_stage_hook(hook)
+    clear_filter_cache()
+    try:
+        analyze_file(filename)
+    finally:
+        remove_stage_hook(stats)
+        remove_stage_hook(hook)
+    stages = [call[0] for call in calls]
+    assert stages == ['read', 'validate', 'filter', 'detect', 'aggregate',
+                      'write']
+    assert stats.stages['validate']['bad_rows'] == 4
+    assert stats.stages['validate']['samples'] == 9996
+    assert stats.stages['detect']['beats'] == 19
+    assert stats.stages['write']['calls'] == 1
+    assert all(call[1] >= 0 for call in calls)
+
+
+def test_stage_stats_dumps():
+    import json
+    from ecg_analysis import StageStats
+    stats = StageStats()
+    stats('filter', 0.5, {'samples': 100})
+    stats('filter', 0.25, {'samples': 50})
+    stats('detect', 0.125, {'beats': 3})
+    assert json.loads(stats.to_json()) == {
+        'detect': {'calls': 1, 'seconds': 0.125, 'beats': 3},
+        'filter': {'calls': 2, 'seconds': 0.75, 'samples': 150}}
+    text = stats.to_prometheus()
+    assert 'ecg_stage_seconds_total{stage="filter"} 0.75' in text
+    assert 'ecg_stage_beats_total{stage="detect"} 3' in text
+    assert '# TYPE ecg_stage_samples_total counter' in text
+    assert 'ecg_stage_samples_total{stage="detect"}' not in text
+
+
+def _write_leads(filename, time, volts, header=None):
+    with open(filename, 'w') as f:
+        if header is not None:
+            f.write(header + "\n")
+        for t, row in zip(time, volts):
+            f.write(",".join(str(float(x)) for x in (t,) + tuple(row)))
+            f.write("\n")
+
+
+@pytest.mark.parametrize("header, exp_names", [
+    ("time, I, II, V1", ['I', 'II', 'V1']),
+    (None, ['lead1', 'lead2', 'lead3'])])
+def test_read_input_leads(tmp_path, header, exp_names):
+    from ecg_analysis import read_input_leads
+    filename = str(tmp_path / "leads.csv")
+    volts = np.arange(12, dtype=np.float64).reshape(4, 3)
+    _write_leads(filename, [0, 0.1, 0.2, 0.3], volts, header)
+    with open(filename, 'a') as f:
+        f.write("0.4,1,2\n0.5,1,a,3\n")
+    with LogCapture() as log_c:
+        time, answer, names = read_input_leads(filename)
+    assert names == exp_names
+    assert time.tolist() == [0, 0.1, 0.2, 0.3]
+    assert answer.shape == (4, 3)
+    assert np.array_equal(answer, volts)
+    assert 'empty: 1, non-numeric: 1' in log_c.records[0].getMessage()
+
+
+@pytest.mark.parametrize("argv, stdin", [
+    (["--batch", "."], None),
+    ([], "leads.csv\n")])
+def test_main_leads(tmp_path, argv, stdin):
+    import json
+    import shutil
+    import subprocess
+    import sys
+    from ecg_analysis import read_input, calc_metrics
+    time, volt = read_input("test_data/test_data16.csv")
+    volts = np.column_stack([volt, 2 * np.array(volt)])
+    _write_leads(str(tmp_path / "leads.csv"), time, volts, "time,I,II")
+    shutil.copy("test_data/test_data16.csv", str(tmp_path / "single.csv"))
+    code = "import ecg_analysis; ecg_analysis.main({!r})".format(
+        argv + ["--plot", "none"])
+    subprocess.run([sys.executable, "-c", code], cwd=str(tmp_path),
+                   env={"PYTHONPATH": os.getcwd()}, input=stdin,
+                   universal_newlines=True, check=True)
+    answer = json.loads((tmp_path / "leads.json").read_text())
+    assert sorted(answer["leads"]) == ["I", "II"]
+    assert answer["leads"]["I"]["num_beats"] == 19
+    if stdin is None:
+        single = json.loads((tmp_path / "single.json").read_text())
+        assert "leads" not in single
+        assert single["num_beats"] == calc_metrics(
+            time, volt, "single.csv", plot='none')["num_beats"]
+
+
+def test_main_hrv_window(tmp_path):
+    import json
+    import shutil
+    import subprocess
+    import sys
+    from ecg_analysis import read_input, calc_metrics, analysis_params
+    shutil.copy("test_data/test_data16.csv", str(tmp_path / "data.csv"))
+    code = ("import ecg_analysis; ecg_analysis.main(['--batch', '.', "
+            "'--hrv-window', '10', '--hrv-step', '5', '--store', 'db'])")
+    for i in range(2):
+        subprocess.run([sys.executable, "-c", code], cwd=str(tmp_path),
+                       env={"PYTHONPATH": os.getcwd()}, check=True)
+    answer = json.loads((tmp_path / "data.json").read_text())
+    time, volt = read_input("test_data/test_data16.csv")
+    expected = calc_metrics(time, volt, plot='none', hrv_window=10,
+                            hrv_step=5)
+    assert answer["hrv"] == json.loads(json.dumps(expected["hrv"]))
+    assert analysis_params(hrv_window=10) != analysis_params()
+    assert "hrv" not in analysis_params()
+
+
+def test_calc_metrics_leads(tmp_path):
+    from ecg_analysis import read_input, read_input_leads, calc_metrics
+    time, volt = read_input("test_data/test_data16.csv")
+    volt = np.array(volt)
+    volts = np.column_stack([volt, 2 * volt, -volt])
+    filename = str(tmp_path / "leads.csv")
+    _write_leads(filename, time, volts, "time,I,II,III")
+    time, volts, names = read_input_leads(filename)
+    answer = calc_metrics(time, volts, filename, plot='none', names=names)
+    for i, name in enumerate(names):
+        expected = calc_metrics(time, volts[:, i].copy(), filename,
+                                plot='none')
+        assert answer["leads"][name] == expected
+    assert answer["leads"]["I"]["num_beats"] == 19
+    assert answer["leads"]["III"]["num_beats"] == 20
+    assert answer["consensus"]["beats"] == answer["leads"]["I"]["beats"]
+    assert answer["duration"] == answer["leads"]["I"]["duration"]
+
+
+@pytest.mark.parametrize("lead_beats, min_leads, expected", [
+    ([[1, 2, 3], [1.02, 2.01, 3], [0.5, 2, 3.05]], None, [1.02, 2, 3]),
+    ([[1, 2], [1.05], []], 1, [1.05, 2]),
+    ([[1, 2], [1.05], []], 3, []),
+    ([[], []], None, [])])
+def test_consensus_beats(lead_beats, min_leads, expected):
+    from ecg_analysis import consensus_beats
+    answer = consensus_beats(lead_beats, min_leads)
+    assert answer.tolist() == expected
+
+
+def test_output_file_policies(tmp_path):
+    import json
+    from ecg_analysis import output_file
+    directory = tmp_path / "run.d"
+    directory.mkdir()
+    filename = str(directory / "run.1.csv")
+    expected = str(directory / "run.1.json")
+    metrics = {"num_beats": 2, "beats": np.array([0.5, 1.25])}
+    assert output_file(metrics, filename) == expected
+    assert output_file({"num_beats": 3}, filename, 'skip') is None
+    with open(expected, 'r') as f:
+        assert json.load(f) == {"num_beats": 2, "beats": [0.5, 1.25]}
+    with pytest.raises(FileExistsError):
+        output_file({"num_beats": 3}, filename, 'error')
+    assert output_file({"num_beats": 3}, filename, 'overwrite') == expected
+    with open(expected, 'r') as f:
+        assert json.load(f) == {"num_beats": 3}
+    assert sorted(os.listdir(str(directory))) == ["run.1.json"]
+    with pytest.raises(ValueError):
+        output_file(metrics, filename, 'append')
+
+
+def test_results_writer(tmp_path):
+    import json
+    from ecg_analysis import ResultsWriter
+    filename = str(tmp_path / "results.ndjson")
+    with ResultsWriter(filename, flush_records=2) as writer:
+        for i in range(5):
+            writer.write("file{}.csv".format(i),
+                         {"num_beats": i, "beats": np.arange(i) * 0.5})
+        assert not os.path.exists(filename)
+        temp_name = [name for name in os.listdir(str(tmp_path))][0]
+        with open(str(tmp_path / temp_name), 'r') as f:
+            assert len(f.readlines()) == 4
+    with open(filename, 'r') as f:
+        records = [json.loads(line) for line in f]
+    assert [record["file"] for record in records] == [
+        "file{}.csv".format(i) for i in range(5)]
+    assert records[3]["beats"] == [0, 0.5, 1.0]
+    assert os.listdir(str(tmp_path)) == ["results.ndjson"]
+    writer = ResultsWriter(filename, 'skip')
+    writer.write("file.csv", {"num_beats": 0})
+    writer.close()
+    assert writer.skipped
+    with pytest.raises(FileExistsError):
+        ResultsWriter(filename, 'error')
+
+
+def test_results_writer_discarded(tmp_path):
+    from ecg_analysis import ResultsWriter
+    filename = tmp_path / "results.ndjson"
+    filename.write_text("old results\n")
+    with pytest.raises(RuntimeError):
+        with ResultsWriter(str(filename), flush_records=2) as writer:
+            for i in range(5):
+                writer.write("file{}.csv".format(i), {"num_beats": i})
+                if i == 3:
+                    raise RuntimeError("crashed part way")
+    assert filename.read_text() == "old results\n"
+    assert os.listdir(str(tmp_path)) == ["results.ndjson"]
+    writer = ResultsWriter(str(filename))
+    writer.write("file.csv", {"num_beats": 1})
+    writer.close(commit=False)
+    assert filename.read_text() == "old results\n"
+    assert os.listdir(str(tmp_path)) == ["results.ndjson"]
+
+
+def test_batch_analysis_results_interrupted(tmp_path, monkeypatch):
+    import shutil
+    import ecg_analysis
+    data = tmp_path / "data"
+    data.mkdir()
+    shutil.copy("test_data/test_data2.csv", str(data / "good1.csv"))
+    shutil.copy("test_data/test_data31.csv", str(data / "good2.csv"))
+    results = tmp_path / "results.ndjson"
+    results.write_text("old results\n")
+
+    def interrupted(self, name, metrics):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(ecg_analysis.ResultsWriter, "write", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        ecg_analysis.batch_analysis(str(data), workers=1,
+                                    results=str(results))
+    assert results.read_text() == "old results\n"
+    assert sorted(os.listdir(str(tmp_path))) == ["data", "results.ndjson"]
+
+
+def test_batch_analysis_results(tmp_path):
+    import json
+    import shutil
+    from ecg_analysis import batch_analysis
+    data = tmp_path / "data"
+    data.mkdir()
+    shutil.copy("test_data/test_data2.csv", str(data / "good1.csv"))
+    shutil.copy("test_data/test_data31.csv", str(data / "good2.csv"))
+    results = str(tmp_path / "results.ndjson")
+    report = batch_analysis(str(data), workers=2, results=results)
+    assert report["succeeded"] == 2
+    assert sorted(os.listdir(str(data))) == ["good1.csv", "good2.csv"]
+    with open(results, 'r') as f:
+        records = sorted((json.loads(line) for line in f),
+                         key=lambda record: record["file"])
+    assert [record["num_beats"] for record in records] == [32, 19]
+    assert records[0]["file"] == str(data / "good1.csv")
+    report = batch_analysis(str(data), workers=2, results=results,
+                            policy='skip')
+    assert (report["skipped"], report["succeeded"]) == (2, 0)
+    report = batch_analysis(str(data), workers=2)
+    assert report["succeeded"] == 2
+    report = batch_analysis(str(data), workers=2, policy='skip')
+    assert (report["files"], report["skipped"]) == (2, 2)
+
+
+@pytest.mark.parametrize("constant, value", [
+    ("BEAT_THRESHOLD", 0.6),
+    ("BEAT_GAP", 0.2),
+    ("GAP_FACTOR", 2.0)])
+def test_analysis_params_constants(monkeypatch, constant, value):
+    import ecg_analysis
+    from ecg_analysis import analysis_params, results_key
+    before = results_key("digest", analysis_params())
+    monkeypatch.setattr(ecg_analysis, constant, value)
+    assert results_key("digest", analysis_params()) != before
+
+
+def test_results_store(tmp_path):
+    from ecg_analysis import (ResultsStore, analysis_params, results_key,
+                              file_digest)
+    filename = str(tmp_path / "results.db")
+    digest = file_digest("test_data/test_data2.csv")
+    params = analysis_params()
+    key = results_key(digest, params)
+    assert key != results_key(digest, analysis_params(engine='adaptive'))
+    metrics = {"duration": 27.775, "voltage_extremes": (-0.68, 1.05),
+               "num_beats": 2, "mean_hr_bpm": np.float64(60.0),
+               "beats": [1.0, 2.0]}
+    with ResultsStore(filename) as store:
+        assert store.get(key) is None
+        store.put(key, digest, params, "a.csv", metrics)
+        store.put("other", digest, params, "b.csv",
+                  dict(metrics, mean_hr_bpm=90.0, num_beats=3))
+    with ResultsStore(filename) as store:
+        assert len(store) == 2
+        assert store.get(key)["voltage_extremes"] == [-0.68, 1.05]
+        fast = store.query("mean_hr_bpm > ?", (70,))
+        assert [result["filename"] for result in fast] == ["b.csv"]
+        assert fast[0]["metrics"]["num_beats"] == 3
+        assert fast[0]["params"]["engine"] == 'threshold'
+        assert len(store.query()) == 2
+        assert store.query(version=0) == []
+
+
+def test_analyze_file_store(tmp_path, monkeypatch):
+    import shutil
+    import ecg_analysis
+    from ecg_analysis import ResultsStore, analyze_file
+    filename = str(tmp_path / "data.csv")
+    shutil.copy("test_data/test_data2.csv", filename)
+    with ResultsStore(str(tmp_path / "results.db")) as store:
+        expected = analyze_file(filename, write=False, store=store)
+
+        def not_parsed(filename):
+            raise AssertionError("the file should not be parsed")
+
+        monkeypatch.setattr(ecg_analysis.Recording, "from_file", not_parsed)
+        answer = analyze_file(filename, policy='error', store=store)
+        assert answer["beats"] == expected["beats"]
+        assert (tmp_path / "data.json").exists()
+        assert analyze_file(filename, policy='error', store=store) == answer
+        with open(filename, 'a') as f:
+            f.write("28.0,0.0\n")
+        with pytest.raises(AssertionError):
+            analyze_file(filename, write=False, store=store)
+
+
+def test_batch_analysis_store(tmp_path):
+    import shutil
+    from ecg_analysis import batch_analysis, ResultsStore
+    data = tmp_path / "data"
+    data.mkdir()
+    shutil.copy("test_data/test_data2.csv", str(data / "good1.csv"))
+    shutil.copy("test_data/test_data31.csv", str(data / "good2.csv"))
+    store = str(tmp_path / "results.db")
+    report = batch_analysis(str(data), workers=2, store=store)
+    assert (report["succeeded"], report["cached"]) == (2, 0)
+    report = batch_analysis(str(data), workers=2, policy='error',
+                            store=store)
+    assert (report["succeeded"], report["cached"]) == (2, 2)
+    assert report["failed"] == 0
+    with open(str(data / "good1.csv"), 'a') as f:
+        f.write("28.0,0.0\n")
+    report = batch_analysis(str(data), workers=2, store=store)
+    assert (report["succeeded"], report["cached"]) == (2, 1)
+    with ResultsStore(store) as results:
+        assert len(results) == 3
+        names = [result["filename"] for result in results.query(
+            "num_beats < ?", (30,))]
+    assert names == [str(data / "good2.csv")]
+
+
+def test_calc_hrv():
+    from ecg_analysis import calc_hrv
+    rng = np.random.default_rng(1)
+    beats = np.cumsum(0.8 + 0.1 * rng.standard_normal(400))
+    beats = np.concatenate((beats[:150], beats[200:]))
+    answer = calc_hrv(beats, window=30, step=7, start=0, stop=beats[-1] + 40)
+    assert len(answer["start"]) == int((beats[-1] + 10) // 7) + 1
+    for i, start in enumerate(answer["start"]):
+        window = beats[(beats >= start) & (beats < start + 30)]
+        rr = np.diff(window)
+        diffs = np.diff(rr)
+        assert answer["num_beats"][i] == window.size
+        if rr.size < 2:
+            assert np.isnan(answer["sdnn_ms"][i])
+            continue
+        assert answer["mean_hr_bpm"][i] == pytest.approx(np.mean(60 / rr))
+        assert answer["sdnn_ms"][i] == pytest.approx(np.std(rr, ddof=1)
+                                                     * 1000)
+        assert answer["rmssd_ms"][i] == pytest.approx(
+            np.sqrt(np.mean(diffs ** 2)) * 1000)
+        assert answer["pnn50"][i] == pytest.approx(
+            np.mean(np.abs(diffs) > 0.05) * 100)
+
+
+def test_calc_hrv_short():
+    from ecg_analysis import calc_hrv
+    assert calc_hrv([1.0, 2.0, 3.0], window=300)["start"] == []
+    answer = calc_hrv([1.0, 2.0], window=10, step=5, start=0, stop=20)
+    assert answer["num_beats"] == [2, 0, 0]
+    assert answer["mean_hr_bpm"][0] == 60
+    assert np.isnan(answer["rmssd_ms"][0])
+
+
+def test_calc_metrics_hrv(tmp_path):
+    from ecg_analysis import read_input, calc_metrics, stream_metrics
+    filename = "test_data/test_data2.csv"
+    time, volt = read_input(filename)
+    assert "hrv" not in calc_metrics(time, volt, filename, plot='none')
+    metrics = calc_metrics(time, volt, filename, plot='none', hrv_window=10,
+                           hrv_step=5)
+    assert metrics["hrv"]["start"] == [0, 5, 10, 15]
+    assert sum(metrics["hrv"]["num_beats"][::2]) <= metrics["num_beats"]
+    streamed = stream_metrics(filename, chunk_rows=1000,
+                              workdir=str(tmp_path), hrv_window=10,
+                              hrv_step=5)
+    assert streamed["hrv"] == metrics["hrv"]
+
+
+def test_register_detector():
+    from ecg_analysis import DETECTORS, register_detector, detect_beats
+
+    @register_detector('every_second')
+    def every_second(time, volts):
+        return time[::2]
+
+    try:
+        answer = detect_beats([0, 1, 2, 3, 4], [1, 2, 3, 2, 1],
+                              engine='every_second')
+    finally:
+        del DETECTORS['every_second']
+    assert answer.beats == [0, 2, 4]
+    assert answer.voltage_extremes == (1, 3)
+    with pytest.raises(ValueError):
+        detect_beats([0, 1], [1, 2], engine='every_second')
+
+
+def _spiky_recording():
+    sample_rate = 250.0
+    time = np.arange(int(20 * sample_rate)) / sample_rate
+    beats = 0.4 + 0.8 * np.arange(24)
+    volt = np.zeros(time.size)
+    for beat in beats:
+        volt += np.exp(-0.5 * ((time - beat) / 0.012) ** 2)
+    volt[int(10.1 * sample_rate)] = 40
+    return time, volt, beats
+
+
+def test_detect_engines_with_artifact():
+    from ecg_analysis import filter_data, detect_beats
+    time, volt, beats = _spiky_recording()
+    filtered = filter_data(time, volt)
+    threshold = np.array(detect_beats(time, filtered).beats)
+    adaptive = np.array(detect_beats(time, filtered, 'adaptive').beats)
+    assert threshold.tolist() == [10.1]
+    far = beats[np.abs(beats - 10.1) > 2]
+    assert all(np.min(np.abs(adaptive - beat)) < 0.02 for beat in far)
+    assert adaptive.size <= far.size + 1
+
+
+def test_detect_adaptive_matches_threshold():
+    from ecg_analysis import read_input, calc_metrics
+    time, volt = read_input("test_data/test_data2.csv")
+    expected = calc_metrics(time, volt, "test_data2.csv", plot='none')
+    answer = calc_metrics(time, volt, "test_data2.csv", plot='none',
+                          engine='adaptive')
+    assert answer["num_beats"] == expected["num_beats"]
+    assert np.allclose(answer["beats"], expected["beats"], atol=0.02)
+
+
+def test_recording_does_not_copy():
+    from ecg_analysis import Recording, as_recording
+    time = np.arange(5) / 4.0
+    volt = np.array([0, 1, 0, 1, 0], dtype=np.float64)
+    recording = Recording(time, volt, metadata={"filename": "a.csv"})
+    assert recording.time is time
+    assert recording.volt is volt
+    assert recording.sample_rate == 4
+    assert len(recording) == 5
+    assert as_recording(recording) is recording
+    from_lists = as_recording([0, 0.5, 1], [1, 2, 3])
+    assert from_lists.time.dtype == np.float64
+    assert from_lists.to_lists() == ([0, 0.5, 1], [1, 2, 3])
+    with pytest.raises(ValueError):
+        Recording([0, 1, 2], [1, 2])
+    with pytest.raises(AttributeError):
+        recording.extra = 1
+
+
+def test_recording_from_file():
+    from ecg_analysis import Recording, read_input
+    filename = "test_data/test_data31.csv"
+    with LogCapture() as log_c:
+        recording = Recording.from_file(filename)
+    assert len(log_c.records) == 1
+    time, volt = read_input(filename)
+    assert recording.to_lists() == (time, volt)
+    assert recording.metadata["filename"] == filename
+    assert recording.metadata["bad_rows"]["total"] == 4
+
+
+def test_calc_functions_accept_recording():
+    from ecg_analysis import (Recording, read_input, calc_metrics,
+                              calc_voltage_extremes, calc_duration,
+                              calc_num_beats, calc_beats, filter_data)
+    filename = "test_data/test_data2.csv"
+    recording = Recording.from_file(filename)
+    time, volt = read_input(filename)
+    assert calc_voltage_extremes(recording) == calc_voltage_extremes(volt)
+    assert calc_duration(recording) == calc_duration(time)
+    assert calc_beats(recording) == calc_beats(time, volt)
+    assert calc_num_beats(recording) == calc_num_beats(time, volt)
+    assert np.array_equal(filter_data(recording), filter_data(time, volt))
+    expected = calc_metrics(time, volt, filename, plot='none')
+    assert calc_metrics(recording, plot='none') == expected
+
+
+@pytest.mark.parametrize("time, expected", [
+    (np.arange(1000) / 250.0, 250),
+    (np.round(np.arange(10000) / 720.0, 3), 720),
+    (np.delete(np.arange(1000) / 250.0, np.s_[100:110]), 250),
+    (np.concatenate(([0], 0.011 + np.arange(999) / 500.0)), 500)])
+def test_estimate_sample_rate(time, expected):
+    from ecg_analysis import estimate_sample_rate
+    assert estimate_sample_rate(time) == pytest.approx(expected, rel=1e-3)
+
+
+def test_estimate_sample_rate_too_short():
+    from ecg_analysis import estimate_sample_rate
+    with pytest.raises(ValueError):
+        estimate_sample_rate([1.0])
+
+
+@pytest.mark.parametrize("time", [[2.0] * 100, np.arange(100)[::-1]])
+def test_estimate_sample_rate_not_increasing(time):
+    from ecg_analysis import estimate_sample_rate, find_gaps, Recording
+    with pytest.raises(ValueError):
+        estimate_sample_rate(time)
+    with pytest.raises(ValueError):
+        find_gaps(time)
+    with pytest.raises(ValueError):
+        Recording(time, np.zeros(100))
+
+
+def test_find_gaps():
+    from ecg_analysis import find_gaps
+    time = np.delete(np.round(np.arange(10000) / 720.0, 3),
+                     np.s_[100:103])
+    answer = find_gaps(time)
+    assert answer.tolist() == [[time[99], time[100]]]
+    assert find_gaps([0, 1]).shape == (0, 2)
+
+
+def test_resample_uniform():
+    from ecg_analysis import Recording, resample_uniform
+    time = np.delete(np.arange(100) / 10.0, [5, 6, 40])
+    recording = Recording(time, 2 * time, metadata={"filename": "a.csv"})
+    answer = resample_uniform(recording)
+    assert answer.sample_rate == pytest.approx(10)
+    assert np.allclose(answer.time, np.arange(100) / 10.0)
+    assert np.allclose(answer.volt, 2 * answer.time)
+    assert answer.metadata == {"filename": "a.csv", "resampled": True}
+
+
+def test_calc_metrics_gaps():
+    from ecg_analysis import read_input, calc_metrics
+    filename = "test_data/test_data31.csv"
+    time, volt = read_input(filename)
+    metrics = calc_metrics(time, volt, filename, plot='none')
+    assert len(metrics["gaps"]) == 4
+    assert metrics["gaps"][0][0] < metrics["gaps"][0][1]
+    resampled = calc_metrics(time, volt, filename, plot='none',
+                             resample=True)
+    assert resampled["gaps"] == metrics["gaps"]
+    assert resampled["num_beats"] == metrics["num_beats"]
+    assert np.allclose(resampled["beats"], metrics["beats"], atol=0.005)
+    time, volt = read_input("test_data/test_data2.csv")
+    assert "gaps" not in calc_metrics(time, volt, "a.csv", plot='none')
+
+
+@pytest.mark.parametrize("engine, segments", [
+    ('threshold', 1),
+    ('threshold', 3),
+    ('adaptive', 4)])
+def test_calc_metrics_segments(engine, segments):
+    from ecg_analysis import Recording, calc_metrics
+    recording = Recording.from_file("test_data/test_data31.csv")
+    expected = calc_metrics(recording, plot='none', engine=engine)
+    answer = calc_metrics(recording, plot='none', engine=engine,
+                          segments=segments)
+    assert answer["beats"] == expected["beats"]
+    assert answer["mean_hr_bpm"] == expected["mean_hr_bpm"]
+    assert answer["gaps"] == expected["gaps"]
+    assert answer["voltage_extremes"] == pytest.approx(
+        expected["voltage_extremes"])
+
+
+def test_detect_beats_segments_filtered():
+    from ecg_analysis import read_input, filter_data, detect_beats_segments
+    from ecg_analysis import as_recording
+    recording = as_recording(*read_input("test_data/test_data2.csv"))
+    volt, detection = detect_beats_segments(recording, 5, overlap=2.0)
+    np.testing.assert_allclose(volt, filter_data(recording), atol=1e-9)
+    assert detection.num_beats == 32
+    with pytest.raises(ValueError):
+        detect_beats_segments(recording, 0)
+    with pytest.raises(ValueError):
+        detect_beats_segments(recording, 2, engine="magic")
+
+
+@pytest.mark.parametrize("filename, status, rows, rate", [
+    ("test_data/test_data2.csv", 'ok', 10000, 360),
+    ("test_data/test_data31.csv", 'ok', 10000, 720),
+    ("test_data/test_data32.csv", 'suspicious', 10000, 720)])
+def test_sniff_file(filename, status, rows, rate):
+    from ecg_analysis import sniff_file
+    answer = sniff_file(filename, sample_bytes=4096, strides=4)
+    assert answer["status"] == status
+    assert answer["rows"] == pytest.approx(rows, rel=0.02)
+    assert answer["sample_rate"] == pytest.approx(rate, rel=0.01)
+    assert answer["columns"] == 2
+    assert answer["sampled_rows"] < 2000
+    assert answer["seconds"] < 1
+
+
+@pytest.mark.parametrize("content, status, issue", [
+    ("", 'unusable', "the file is empty"),
+    ("1\n2\n3\n", 'unusable', "the file has only one column"),
+    ("time,volt\n1,nan\n2,nan\n", 'unusable',
+     "fewer than two of the 2 rows read are usable"),
+    ("0,1\n0.1,2\n0.05,3\n0.2,1\n", 'suspicious',
+     "time does not always increase"),
+    ("0,1\n0.1,\n0.2,3\n0.3,1\n", 'suspicious',
+     "1 of the 4 rows read are bad"),
+    ("5,1\n5,2\n5,3\n", 'unusable',
+     "the time values do not increase, so there is no sample rate"),
+    ("time,volt\r\n0,1\r\n0.1,2\r\n", 'ok', None)])
+def test_sniff_file_problems(tmp_path, content, status, issue):
+    from ecg_analysis import sniff_file
+    filename = tmp_path / "data.csv"
+    filename.write_bytes(content.encode())
+    answer = sniff_file(str(filename))
+    assert answer["status"] == status
+    assert answer["issues"][-1:] == ([issue] if issue else [])
+
+
+def test_undecodable_rows(tmp_path):
+    from ecg_analysis import (sniff_file, read_input_arrays,
+                              iter_input_chunks, read_input_leads)
+    filename = tmp_path / "data.csv"
+    filename.write_bytes("temps,\xb5V\n0,1\n0.5,2\xb5\n1,2\n1.5,3\n".encode(
+        'latin-1'))
+    answer = sniff_file(str(filename))
+    assert answer["issues"] == ["1 of the 4 rows read are bad"]
+    for time, volt, bad_lines, bad_reasons in [
+            read_input_arrays(str(filename)),
+            next(iter_input_chunks(str(filename)))]:
+        assert time.tolist() == [0, 1, 1.5]
+        assert bad_lines.tolist()[-1] == 3
+        assert bad_reasons.tolist()[-1] == 1
+    time, volts, names = read_input_leads(str(filename))
+    assert time.tolist() == [0, 1, 1.5]
+    assert names == ["\ufffdV"]
+
+
+def test_batch_analysis_sniff(tmp_path):
+    import shutil
+    from ecg_analysis import batch_analysis
+    shutil.copy("test_data/test_data2.csv", str(tmp_path / "good.csv"))
+    (tmp_path / "bad.csv").write_text("1\n2\n3\n")
+    report = batch_analysis(str(tmp_path), workers=1, sniff=True)
+    assert (report["succeeded"], report["failed"]) == (1, 1)
+    assert report["failures"] == [(str(tmp_path / "bad.csv"),
+                                   "unusable: the file has only one column")]
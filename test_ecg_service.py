@@ -0,0 +1,248 @@
+import asyncio
+import json
+import threading
+import pytest
+
+
+async def _request(address, method, target, body=b'', headers=None):
+    if isinstance(address, str):
+        reader, writer = await asyncio.open_unix_connection(address)
+    else:
+        reader, writer = await asyncio.open_connection(*address)
+    head = ["{} {} HTTP/1.1".format(method, target),
+            "Content-Length: {}".format(len(body))]
+    for name, value in (headers or {}).items():
+        head.append("{}: {}".format(name, value))
+    writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, body = response.partition(b"\r\n\r\n")
+    status = int(head.split()[1])
+    return status, head.decode(), json.loads(body.decode())
+
+
+def _expected_metrics(filename):
+    from ecg_analysis import read_input, calc_metrics
+    time, volt = read_input(filename)
+    metrics = calc_metrics(time, volt, filename, plot='none')
+    return json.loads(json.dumps(metrics))
+
+
+def test_analyze_upload():
+    from ecg_service import ECGService
+    filename = "test_data/test_data2.csv"
+    with open(filename, 'rb') as f:
+        content = f.read()
+
+    async def run():
+        service = ECGService()
+        address = await service.start()
+        try:
+            first = await _request(address, "POST", "/analyze", content,
+                                   {"X-Filename": "test_data2.csv"})
+            second = await _request(address, "POST", "/jobs", content)
+            health = await _request(address, "GET", "/health")
+        finally:
+            await service.close()
+        return first, second, health
+
+    first, second, health = asyncio.run(run())
+    assert first[0] == 200
+    assert first[2]["status"] == "done"
+    assert first[2]["name"] == "test_data2.csv"
+    assert first[2]["result"] == _expected_metrics(filename)
+    assert second[0] == 200
+    assert second[2]["cached"] is True
+    assert second[2]["result"] == first[2]["result"]
+    assert health[2] == {"pending": 0, "max_pending": 8, "cached": 1}
+
+
+def test_submit_path_and_poll():
+    from ecg_service import ECGService
+    filename = "test_data/test_data31.csv"
+
+    async def run():
+        service = ECGService()
+        address = await service.start()
+        try:
+            body = json.dumps({"path": filename}).encode()
+            submitted = await _request(address, "POST", "/jobs", body,
+                                       {"Content-Type": "application/json"})
+            target = "/jobs/" + submitted[2]["id"]
+            while True:
+                polled = await _request(address, "GET", target)
+                if polled[2]["status"] not in ("queued", "running"):
+                    break
+                await asyncio.sleep(0.01)
+            missing = await _request(address, "GET", "/jobs/nope")
+            bad = await _request(address, "POST", "/jobs", b"{}",
+                                 {"Content-Type": "application/json"})
+        finally:
+            await service.close()
+        return submitted, polled, missing, bad
+
+    submitted, polled, missing, bad = asyncio.run(run())
+    assert submitted[0] == 202
+    assert polled[2]["status"] == "done"
+    assert polled[2]["result"] == _expected_metrics(filename)
+    assert missing[0] == 404
+    assert bad[0] == 400
+
+
+async def _refused_before_body(address, length):
+    reader, writer = await asyncio.open_connection(*address)
+    writer.write("POST /jobs HTTP/1.1\r\nContent-Length: {}\r\n\r\n".format(
+        length).encode())
+    await writer.drain()
+    response = await asyncio.wait_for(reader.read(), 5)
+    writer.close()
+    return response
+
+
+def test_backpressure(monkeypatch):
+    import ecg_service
+    release = threading.Event()
+
+    def blocked(*args):
+        release.wait(10)
+        return {"num_beats": 0}
+
+    monkeypatch.setattr(ecg_service, "analyze_recording", blocked)
+    body = json.dumps({"path": "test_data/test_data2.csv"}).encode()
+    headers = {"Content-Type": "application/json"}
+
+    async def run():
+        service = ecg_service.ECGService(max_workers=1, max_pending=2,
+                                         max_body=1000)
+        address = await service.start()
+        try:
+            accepted = [await _request(address, "POST", "/jobs", body,
+                                       headers) for i in range(2)]
+            refused = await _request(address, "POST", "/jobs", body,
+                                     headers)
+            statuses = [service.job(job[2]["id"])["status"]
+                        for job in accepted]
+            too_big = await _request(address, "POST", "/jobs", b"0" * 1001)
+            early = await _refused_before_body(address, 900)
+            release.set()
+            jobs = [await service.wait(job[2]["id"]) for job in accepted]
+        finally:
+            release.set()
+            await service.close()
+        return accepted, refused, statuses, too_big, early, jobs
+
+    accepted, refused, statuses, too_big, early, jobs = asyncio.run(run())
+    assert [job[0] for job in accepted] == [202, 202]
+    assert sorted(statuses) == ["queued", "running"]
+    assert refused[0] == 503
+    assert "Retry-After: 1" in refused[1]
+    assert too_big[0] == 413
+    assert early.startswith(b"HTTP/1.1 503")
+    assert [job["status"] for job in jobs] == ["done", "done"]
+
+
+def test_unix_socket(tmp_path):
+    from ecg_service import ECGService
+    path = str(tmp_path / "ecg.sock")
+
+    async def run():
+        service = ECGService()
+        await service.start(path=path)
+        try:
+            return await _request(path, "GET", "/health")
+        finally:
+            await service.close()
+
+    status, head, payload = asyncio.run(run())
+    assert status == 200
+    assert payload["pending"] == 0
+
+
+def test_analyze_after_job_forgotten():
+    from ecg_service import ECGService
+    filename = "test_data/test_data2.csv"
+
+    async def run():
+        service = ECGService(max_jobs=0)
+        address = await service.start()
+        try:
+            body = json.dumps({"path": filename}).encode()
+            return await _request(address, "POST", "/analyze", body,
+                                  {"Content-Type": "application/json"})
+        finally:
+            await service.close()
+
+    status, head, payload = asyncio.run(run())
+    assert status == 200
+    assert payload["result"] == _expected_metrics(filename)
+
+
+def test_unexpected_error(monkeypatch):
+    from ecg_service import ECGService
+
+    async def broken(*args):
+        raise ZeroDivisionError("division by zero")
+
+    async def run():
+        service = ECGService()
+        monkeypatch.setattr(service, "_route", broken)
+        address = await service.start()
+        try:
+            return await _request(address, "GET", "/health")
+        finally:
+            await service.close()
+
+    status, head, payload = asyncio.run(run())
+    assert status == 500
+    assert payload == {"error": "internal server error"}
+
+
+def test_analyze_leads_and_unusable_uploads():
+    from ecg_analysis import read_input
+    from ecg_service import ECGService
+    time, volt = read_input("test_data/test_data16.csv")
+    leads = "time,I,II\n" + "".join("{},{},{}\n".format(t, v, 2 * v)
+                                    for t, v in zip(time, volt))
+    unusable = "time,volt\n0,\n0.1,abc\n"
+
+    async def run():
+        service = ECGService()
+        address = await service.start()
+        try:
+            return [await _request(address, "POST", "/analyze",
+                                   content.encode())
+                    for content in (leads, unusable)]
+        finally:
+            await service.close()
+
+    leads, unusable = asyncio.run(run())
+    assert leads[0] == 200
+    assert sorted(leads[2]["result"]["leads"]) == ["I", "II"]
+    assert leads[2]["result"]["leads"]["I"]["num_beats"] == 19
+    assert unusable[0] == 400
+    assert unusable[2]["error"] == (
+        "upload.csv has fewer than two good data points; skipped 3 bad "
+        "data points (empty: 1, non-numeric: 2, nan: 0); first bad lines: "
+        "1, 2, 3")
+
+
+def test_negative_content_length():
+    from ecg_service import ECGService
+
+    async def run():
+        service = ECGService()
+        address = await service.start()
+        try:
+            reader, writer = await asyncio.open_connection(*address)
+            writer.write(b"POST /jobs HTTP/1.1\r\nContent-Length: -1\r\n\r\n")
+            await writer.drain()
+            response = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+            return response
+        finally:
+            await service.close()
+
+    head, _, body = asyncio.run(run()).partition(b"\r\n\r\n")
+    assert head.startswith(b"HTTP/1.1 400")
+    assert json.loads(body.decode()) == {"error": "bad Content-Length"}
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+
+def test_synthetic_recording():
+    from ecg_synthetic import synthetic_recording
+    time, volt, beats = synthetic_recording(3330, sample_rate=333.0,
+                                            heart_rate=60, hrv=0)
+    assert time.size == volt.size == 3330
+    assert time[1] - time[0] == 1 / 333.0
+    np.testing.assert_allclose(beats, np.arange(0.5, 10, 1.0))
+    assert volt.argmax() % 333 in range(160, 175)
+
+
+def test_synthetic_chunks_deterministic():
+    from ecg_synthetic import synthetic_chunks, BLOCK_SAMPLES
+    size = 2 * BLOCK_SAMPLES + 100
+    first = list(synthetic_chunks(size, artifacts_per_minute=2, seed=3))
+    second = list(synthetic_chunks(size, artifacts_per_minute=2, seed=3))
+    other = list(synthetic_chunks(size, artifacts_per_minute=2, seed=4))
+    assert [len(chunk[0]) for chunk in first] == [BLOCK_SAMPLES,
+                                                  BLOCK_SAMPLES, 100]
+    for chunk, again in zip(first, second):
+        for array, same in zip(chunk, again):
+            np.testing.assert_array_equal(array, same)
+    assert not np.array_equal(first[0][1], other[0][1])
+    beats = np.concatenate([chunk[2] for chunk in first])
+    assert np.all(np.diff(beats) > 0)
+    assert np.mean(np.diff(beats)) == pytest.approx(60 / 72, rel=0.05)
+    artifacts = np.concatenate([chunk[3] for chunk in first])
+    assert len(artifacts) > 0
+    time = np.concatenate([chunk[0] for chunk in first])
+    volt = np.concatenate([chunk[1] for chunk in first])
+    index = np.searchsorted(time, artifacts)
+    assert np.all(volt[index] > 5)
+
+
+def test_write_synthetic_csv(tmp_path):
+    from ecg_analysis import Recording, calc_metrics
+    from ecg_synthetic import write_synthetic_csv
+    filename = str(tmp_path / "synthetic.csv")
+    truth = write_synthetic_csv(filename, 100000, sample_rate=250.0,
+                                heart_rate=80, bad_rows=0.002, seed=1)
+    recording = Recording.from_file(filename)
+    assert len(recording) + len(truth["bad_lines"]) == 100000
+    assert recording.metadata["bad_rows"]["total"] == len(truth["bad_lines"])
+    assert recording.sample_rate == pytest.approx(250.0)
+    metrics = calc_metrics(recording, plot='none')
+    found = np.array(metrics["beats"])
+    expected = np.array(truth["beats"])
+    assert len(found) == pytest.approx(len(expected), abs=1)
+    nearest = np.abs(found[:, np.newaxis] - expected).min(axis=1)
+    assert np.all(nearest < 0.05)
+    assert truth["duration"] == pytest.approx(99999 / 250.0)